@@ -3,9 +3,9 @@
 # -------------------------------------------------------------------------------------------------
 
 import argparse
+import functools
 import io
 import locale
-from operator import itemgetter
 from pathlib import Path
 
 import png
@@ -32,6 +32,7 @@ ROOT_DIR = Path(__file__).parent.resolve()
 PORT = 4321
 DEFAULT_PID = 'decc8d40-cf74-4263-ae9d-a0cc68b47e86'
 DEFAULT_DSET = 'bwm'  # 'bwm' (brain wide map) or 'rs' (repeated sites)
+ITEM_DETAILS_CACHE_SIZE = 256  # number of sessions whose trial and cluster details are kept in memory
 
 
 # -------------------------------------------------------------------------------------------------
@@ -73,6 +74,9 @@ def send_png_bytes(btes):
 def send(path):
     if path.exists():
         return send_file(path)
+    # Low-resolution preview saved before the full-quality figure.
+    elif preview_path(path).exists():
+        return send_file(preview_path(path))
     else:
         logger.error(f"path {path} does not exist")
         return Response(status=404)
@@ -83,13 +87,24 @@ def send(path):
 # -------------------------------------------------------------------------------------------------
 
 def sessions():
-    CACHE_DIR.mkdir(exist_ok=True, parents=True)
-    pids = sorted([str(p.name) for p in CACHE_DIR.iterdir()])
-    pids = [pid for pid in pids if is_valid_uuid(pid)]
-    sessions = [load_json(session_details_path(pid)) for pid in pids]
-    sessions = [_ for _ in sessions if _]
-    sessions = sorted(sessions, key=itemgetter('Lab', 'Subject'))
-    return sessions
+    # The catalogue is saved at the end of each generation run.
+    if catalogue_path().exists():
+        return load_json(catalogue_path())['sessions']
+    return generated_sessions()
+
+
+@functools.lru_cache(maxsize=ITEM_DETAILS_CACHE_SIZE)
+def _load_item_details(path, version):
+    return load_json(path)
+
+
+def item_details(pid):
+    # The trial and cluster details of a session are kept in memory until the file is replaced.
+    path = item_details_path(pid)
+    if not path.exists():
+        return {}
+    stat = path.stat()
+    return _load_item_details(path, (stat.st_ino, stat.st_mtime_ns))
 
 
 # -------------------------------------------------------------------------------------------------
@@ -139,13 +154,28 @@ def make_app():
     def session_details(pid):
         return load_json(session_details_path(pid))
 
+    @app.route('/api/session/<pid>/arrays')
+    def session_arrays(pid):
+        # Binary arrays of the session, described by the _arrays field of the session details.
+        return send(session_arrays_path(pid))
+
+    @app.route('/api/session/<pid>/item_details')
+    def all_item_details(pid):
+        # The details of all the trials and clusters, indexed by id.
+        return send(item_details_path(pid))
+
+    @app.route('/api/session/<pid>/behaviour_fits')
+    def behaviour_fits(pid):
+        # Psychometric fit parameters, choices and reaction times per contrast of each block.
+        return send(behaviour_fits_path(pid))
+
     @app.route('/api/session/<pid>/trial_details/<int:trial_idx>')
     def trial_details(pid, trial_idx):
-        return load_json(trial_details_path(pid, trial_idx))
+        return item_details(pid).get('trials', {}).get(str(trial_idx), None) or {}
 
     @app.route('/api/session/<pid>/cluster_details/<int:cluster_idx>')
     def cluster_details(pid, cluster_idx):
-        return load_json(cluster_details_path(pid, cluster_idx))
+        return item_details(pid).get('clusters', {}).get(str(cluster_idx), None) or {}
 
     @app.route('/api/session/<pid>/cluster_plot_from_xy/<int:cluster_idx>/<float:x>_<float:y>')
     def cluster_from_xy(pid, cluster_idx, x, y):
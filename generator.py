@@ -2,23 +2,48 @@
 # Imports
 # -------------------------------------------------------------------------------------------------
 
+from contextlib import contextmanager, nullcontext
 from datetime import datetime, date
 # from pathlib import Path
 # from pprint import pprint
 from uuid import UUID
-# import argparse
-# import functools
+import argparse
+import functools
+import hashlib
+import inspect
 import io
 import json
 import locale
 import logging
 import logging
+import multiprocessing as mp
+from operator import itemgetter
+import os
 import os.path as op
 import png
+import queue
+import re
+import shutil
+import socket
 import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:  # the watch mode polls the data folder instead
+    INotify = None
 
 import numpy as np
-from joblib import Parallel, delayed
+import psutil
 from tqdm import tqdm
 import pandas as pd
 import matplotlib as mpl
@@ -80,6 +105,151 @@ add_default_handler(logger, level='DEBUG')
 CACHE_DIR = ROOT_DIR / 'static/cache'
 PORT = 4321
 
+# Artifacts shared by the probes of a session (eid), linked from the probe folders.
+EID_CACHE_DIR = CACHE_DIR / '_eids'
+
+# Content-addressed store: each distinct artifact is stored once under the hash of its content,
+# the artifacts of the sessions are hard links to the stored objects.
+OBJECTS_DIR = CACHE_DIR / '_objects'
+
+# Behaviour fits of the sessions (eid), stored under the fingerprint of the trials and of the
+# fitting code, and linked from the probe folders.
+FITS_DIR = CACHE_DIR / '_fits'
+
+# Content hashes of the input files of each data folder, with the inode, modification time and size
+# of the files they were computed from.
+DIGESTS_DIR = CACHE_DIR / '_digests'
+
+# Memory-mapped session data shared with the worker processes (in RAM with /dev/shm).
+SHARED_DIR = Path('/dev/shm') if Path('/dev/shm').exists() else Path(tempfile.gettempdir())
+N_JOBS = max(1, (os.cpu_count() or 1) - 2)
+
+# Input files of each kind of artifact, as glob patterns relative to DATA_DIR. Only the rows of the
+# session are fingerprinted in the tables shared by all sessions (see TABLE_DIGESTS).
+ARTIFACT_INPUTS = {
+    'session_details': ('session.table.pqt', '{pid}/spikes.*', '{pid}/clusters.*', '{eid}/trials.*'),
+    'session': ('raw_ephys_features.pqt', '{pid}/spikes.*', '{pid}/clusters.*', '{pid}/channels.*',
+                '{pid}/_iblqc_ephysChannels.*', '{pid}/raw_ephys_*'),
+    'behaviour': ('{eid}/trials.*', '{eid}/wheel.*', '{eid}/licks.*', '{eid}/leftCamera.*'),
+    'trial': ('{pid}/spikes.*', '{pid}/clusters.*', '{pid}/channels.*', '{eid}/trials.*'),
+    'trial_event': ('{pid}/spikes.*', '{pid}/clusters.*', '{pid}/channels.*', '{eid}/trials.*'),
+    'cluster': ('{pid}/spikes.*', '{pid}/clusters.*', '{pid}/channels.*', '{pid}/_iblqc_ephysChannels.*',
+                '{eid}/trials.*'),
+    'item_details': ('{pid}/spikes.*', '{pid}/clusters.*', '{eid}/trials.*'),
+    'cluster_pixels': ('{pid}/clusters.*',),
+    'behaviour_fits': ('{eid}/trials.*',),
+}
+
+# Generator method making each kind of artifact, used to fingerprint the plotting code.
+ARTIFACT_CODE = {
+    'session_details': 'save_session_details',
+    'session': 'make_session_plot',
+    'behaviour': 'make_behavior_plot',
+    'trial': 'make_trial_plot',
+    'trial_event': 'make_trial_event_plot',
+    'cluster': 'make_cluster_plot',
+    'item_details': 'save_item_details',
+    'cluster_pixels': 'save_cluster_pixels',
+    'behaviour_fits': 'save_behaviour_fits',
+}
+
+# Constants of the layout of some artifacts, fingerprinted with their code (see code_fingerprint()).
+ARTIFACT_CONSTANTS = {
+    'cluster': ('CLUSTER_FIGSIZE', 'CLUSTER_GRID'),
+    'cluster_pixels': ('CLUSTER_GRID',),
+}
+
+# Figure numbers, and figure made of each kind of artifact (0 is the session details).
+FIGURES = (1, 2, 3, 4, 5)
+FIGURE_ITEMS = (3, 5)  # figures with one plot per trial or per cluster
+ARTIFACT_FIGURES = {
+    'session_details': 0,  # saved when loading the session
+    'item_details': 0,
+    'cluster_pixels': 0,
+    'session': 1,
+    'behaviour': 2,
+    'behaviour_fits': 2,
+    'trial': 3,
+    'trial_event': 4,
+    'cluster': 5,
+}
+
+# Layout of the cluster figure (figure 5): size in inches, and grid of the panels with its margins
+# as fractions of the figure. The position of the clusters in the amplitude/depth scatter plot
+# (top left panel) is computed from this layout, see cluster_pixels().
+CLUSTER_FIGSIZE = (15, 10)
+CLUSTER_GRID = dict(
+    nrows=2, ncols=3, width_ratios=[2, 10, 3], height_ratios=[6, 2], wspace=0.2, hspace=0.2,
+    left=0.8 / CLUSTER_FIGSIZE[0], right=0.9, bottom=0.8 / CLUSTER_FIGSIZE[1], top=0.88)
+
+# Scheduler: number of trials or clusters per task, and relative cost of each figure (per item
+# for the trial and cluster figures).
+CHUNK_SIZE = 50
+FIGURE_COSTS = {0: 1, 1: 10, 2: 10, 3: .3, 4: 3, 5: 1}
+TASK_RETRIES = 1  # number of times a failed task, or the task of a worker that died, is run again
+
+# Scheduler memory admission: memory of a loaded session as a multiple of the size of its ALF
+# files, and memory left free for the rest of the system (bytes).
+SESSION_MEMORY_FACTOR = 2
+MEMORY_RESERVE = 2 ** 30
+
+# Figure made by each API route of the server (see flaskapp.py), used to prioritize the generation
+# with the access logs (0 is the session details and the trial and cluster details).
+ROUTE_FIGURES = {
+    'details': 0,
+    'arrays': 0,
+    'item_details': 0,
+    'trial_details': 0,
+    'cluster_details': 0,
+    'session_plot': 1,
+    'behaviour_plot': 2,
+    'behaviour_fits': 2,
+    'trial_plot': 3,
+    'trial_event_plot': 4,
+    'cluster_plot': 5,
+}
+_LOG_LINE_REGEX = re.compile(r'"GET (\S+)')
+_API_URL_REGEX = re.compile(r'/api/session/([^/]+)/(\w+)(?:/(\d+))?')
+
+# Resolution of the low-resolution previews saved before the full-quality figures (dots per inch),
+# and multiple of the bin sizes of their rasters and PSTHs.
+PREVIEW_DPI = 40
+PREVIEW_BIN_SCALE = 4
+
+# PNG encoding: the figures are rendered on the generating thread and compressed by a pool of
+# encoder threads, with at most PNG_QUEUE figures waiting to be encoded. zlib compression level
+# (0-9, None for the Pillow default), and optional optimization pass of Pillow shrinking the files
+# at the cost of a slower encoding. Set with `--png-level` and `--png-optimize`.
+PNG_THREADS = 2
+PNG_QUEUE = 8
+PNG_COMPRESS_LEVEL = None
+PNG_OPTIMIZE = False
+PNG_ENV = 'IBL_PNG'  # "level,optimize", set for the worker processes
+
+# Cache maintenance (`python generator.py gc`): byte budget of the cache folder, None to only remove
+# the garbage.
+CACHE_BUDGET = None
+
+# Watch mode: polling interval without inotify, and time without change before generating a new
+# or modified session (in seconds).
+WATCH_INTERVAL = 30
+WATCH_SETTLE = 60
+
+# Distributed generation: folder of the session leases shared by the nodes, lease expiry and
+# renewal intervals in seconds, and time after the last session done in a run before its done
+# markers are removed by the cache maintenance.
+LEASE_DIR = CACHE_DIR / '_leases'
+LEASE_TIMEOUT = 600
+LEASE_HEARTBEAT = 30
+LEASE_RUN_RETENTION = 7 * 24 * 3600
+
+# Tracing: functions of plots.static_plots and DataLoader methods recorded as spans (in addition to
+# the Generator methods of ARTIFACT_CODE and savefig), and RSS sampling interval in seconds.
+TRACE_FUNCTIONS = r'load_\w+'
+TRACE_METHODS = r'session_init|load_\w+|compute_\w+|plot_\w+'
+TRACE_INTERVAL = .01
+TRACE_ENV = 'IBL_TRACE'  # trace path, set for the worker processes
+
 
 # -------------------------------------------------------------------------------------------------
 # Utils
@@ -148,11 +318,68 @@ def is_valid_uuid(uuid_to_test, version=4):
     return str(uuid_obj) == uuid_to_test
 
 
+@contextmanager
+def atomic_write(path):
+    """Yield a temporary path renamed to `path` once written, so that the server never reads a
+    partially written artifact. The previous file is replaced, not modified, which leaves the
+    stored object or the figure shared by several probes it may be linked to untouched."""
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}-{threading.get_ident()}.tmp')
+    try:
+        yield tmp
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            os.remove(tmp)
+
+
 def save_json(path, dct):
-    with open(path, 'w') as f:
+    with atomic_write(path) as tmp, open(tmp, 'w') as f:
         json.dump(dct, f, sort_keys=True, cls=DateTimeEncoder)
 
 
+def link_file(src, dst):
+    """Replace a file by a hard link to another file, or by a copy on file systems without hard
+    links."""
+    # rename() does nothing when both names are links to the same file.
+    if dst.exists() and os.path.samefile(src, dst):
+        return
+    tmp = dst.with_name(f'.{dst.name}.{os.getpid()}')
+    if tmp.exists():  # left by an interrupted run
+        os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def store_object(path):
+    """Store an artifact once under the hash of its content, and return the hash. The artifact
+    becomes a hard link to the stored object, which deduplicates identical artifacts of other
+    sessions and unchanged re-renders."""
+    digest = file_hash(path)
+    obj = object_path(digest, path.suffix)
+    if not obj.exists():
+        obj.parent.mkdir(exist_ok=True, parents=True)
+        try:
+            os.link(path, obj)
+        except FileExistsError:  # stored concurrently by another worker
+            pass
+        except OSError:  # no hard links on this file system, the artifact is not deduplicated
+            return digest
+    if not os.path.samefile(obj, path):
+        link_file(obj, path)
+    return digest
+
+
 def load_json(path):
     if not path.exists():
         logger.error(f"file {path} doesn't exist")
@@ -161,6 +388,70 @@ def load_json(path):
         return json.load(f)
 
 
+def save_arrays(path, arrays):
+    """Save arrays in one little-endian binary file, aligned on 8 bytes so that the browser can
+    view them as typed arrays (see static/array.js), and return their description
+    {name: {dtype, shape, offset}}."""
+    descr = {}
+    with atomic_write(path) as tmp, open(tmp, 'wb') as f:
+        for name, arr in arrays.items():
+            arr = np.ascontiguousarray(arr, dtype=arr.dtype.newbyteorder('<'))
+            f.write(b'\0' * (-f.tell() % 8))
+            descr[name] = {'dtype': arr.dtype.name, 'shape': list(arr.shape), 'offset': f.tell()}
+            f.write(arr.tobytes())
+    return descr
+
+
+def decode_arrays(data, descr):
+    """Decode the arrays of a binary file saved with save_arrays()."""
+    out = Bunch()
+    for name, d in descr.items():
+        dtype = np.dtype(d['dtype']).newbyteorder('<')
+        count = int(np.prod(d['shape']))
+        out[name] = np.frombuffer(data, dtype=dtype, count=count, offset=d['offset']).reshape(d['shape'])
+    return out
+
+
+def load_session_arrays(pid, details):
+    """Load the arrays of a session described in its session details (trial and cluster ids,
+    trial intervals, acronym codes and colors)."""
+    path = session_arrays_path(pid)
+    if '_arrays' not in details or not path.exists():
+        return Bunch()
+    with open(path, 'rb') as f:
+        return decode_arrays(f.read(), details['_arrays'])
+
+
+def grid_cell(row, col, nrows, ncols, width_ratios, height_ratios, wspace, hspace, left, right, bottom, top):
+    """Position (x0, y0, x1, y1) of a cell of a grid of panels, as fractions of the figure from
+    the bottom left corner, computed like matplotlib's GridSpec.get_grid_positions()."""
+    def _cells(size, ratios, space):
+        n = len(ratios)
+        cell = size / (n + space * (n - 1))
+        sizes = np.asarray(ratios, dtype=np.float64) * cell * n / np.sum(ratios)
+        starts = np.r_[0, np.cumsum(sizes + space * cell)[:-1]]
+        return starts, starts + sizes
+
+    x0, x1 = _cells(right - left, width_ratios, wspace)
+    y0, y1 = _cells(top - bottom, height_ratios, hspace)
+    return left + x0[col], top - y1[row], left + x1[col], top - y0[row]
+
+
+def cluster_pixels(loader):
+    """Return the position of the good clusters in the scatter plot of the cluster figure, sorted by depth, as
+    fractions of the figure size computed from the layout without rendering it."""
+    x0, y0, x1, y1 = grid_cell(0, 0, **CLUSTER_GRID)
+    amp_lim, depth_lim = loader.amp_lim, loader.depth_lim
+    idx = np.argsort(loader.clusters_good.depths)[::-1]
+    amps = loader.clusters_good.amps[idx].astype(np.float64) * 1e6
+    depths = loader.clusters_good.depths[idx].astype(np.float64)
+    df = pd.DataFrame()
+    df['cluster_id'] = loader.clusters_good.cluster_id[idx].astype(np.int32)
+    df['x'] = x0 + (amps - amp_lim[0]) / (amp_lim[1] - amp_lim[0]) * (x1 - x0)
+    df['y'] = y0 + (depths - depth_lim[0]) / (depth_lim[1] - depth_lim[0]) * (y1 - y0)
+    return df
+
+
 def get_cluster_idx_from_xy(pid, cluster_idx, x, y):
     df = pd.read_parquet(cluster_pixels_path(pid))
     norm_dist = (df.x.values - x) ** 2 + (df.y.values - y) ** 2
@@ -191,12 +482,26 @@ def session_details_path(pid):
     return session_cache_path(pid) / 'session.json'
 
 
-def trial_details_path(pid, trial_idx):
-    return session_cache_path(pid) / f'trial-{trial_idx:04d}.json'
+def eid_cache_path(eid):
+    cp = EID_CACHE_DIR / eid
+    cp.mkdir(exist_ok=True, parents=True)
+    return cp
+
+
+def eid_manifest_path(eid):
+    return eid_cache_path(eid) / 'manifest.json'
+
+
+def object_path(digest, suffix):
+    return OBJECTS_DIR / digest[:2] / f'{digest}{suffix}'
 
 
-def cluster_details_path(pid, cluster_idx):
-    return session_cache_path(pid) / f'cluster-{cluster_idx:04d}.json'
+def session_arrays_path(pid):
+    return session_cache_path(pid) / 'session.bin'
+
+
+def item_details_path(pid):
+    return session_cache_path(pid) / 'items.json'
 
 
 def session_overview_path(pid):
@@ -207,6 +512,18 @@ def behaviour_overview_path(pid):
     return session_cache_path(pid) / 'behaviour_overview.png'
 
 
+def behaviour_shared_path(eid):
+    return eid_cache_path(eid) / 'behaviour_overview.png'
+
+
+def behaviour_fits_path(pid):
+    return session_cache_path(pid) / 'behaviour_fits.json'
+
+
+def fits_cache_path(key):
+    return FITS_DIR / f'{key}.json'
+
+
 def trial_event_overview_path(pid):
     return session_cache_path(pid) / 'trial_overview.png'
 
@@ -223,17 +540,340 @@ def cluster_pixels_path(pid):
     return session_cache_path(pid) / 'cluster_pixels.pqt'
 
 
+def preview_path(path):
+    return path.with_suffix('.preview' + path.suffix)
+
+
 def trial_intervals_path(pid):
     return session_cache_path(pid) / f'trial_intervals.pqt'
 
 
+def manifest_path(pid):
+    return session_cache_path(pid) / 'manifest.json'
+
+
+def session_shared_path(pid):
+    return SHARED_DIR / 'ibl_website' / f'{pid}-{os.getpid()}'
+
+
+def catalogue_path():
+    return CACHE_DIR / 'catalogue.json'
+
+
+def products_path(pid):
+    return session_cache_path(pid) / 'products'
+
+
+# -------------------------------------------------------------------------------------------------
+# Manifest
+# -------------------------------------------------------------------------------------------------
+
+_digests = {}  # data folder: {file name: [inode, modification time, size, hash]}
+
+
+def digests_path(folder):
+    return DIGESTS_DIR / f'{folder or "_root"}.json'
+
+
+def input_digests(paths):
+    """Return the content hashes of input files, only recomputed for the files whose inode,
+    modification time or size changed since they were last hashed."""
+    out, changed = {}, defaultdict(dict)
+    for path in paths:
+        folder = path.parent.relative_to(DATA_DIR).as_posix().strip('.')
+        if folder not in _digests:
+            _digests[folder] = load_json(digests_path(folder)) if digests_path(folder).exists() else {}
+        stat = path.stat()
+        key = [stat.st_ino, stat.st_mtime_ns, stat.st_size]
+        entry = _digests[folder].get(path.name, None)
+        if entry is None or entry[:3] != key:
+            entry = changed[folder][path.name] = _digests[folder][path.name] = key + [file_hash(path)]
+        out[path] = entry[3]
+
+    # Merge the new hashes into the files, which may be updated concurrently by other workers.
+    for folder, entries in changed.items():
+        path = digests_path(folder)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        with _file_lock(path):
+            digests = load_json(path) if path.exists() else {}
+            digests.update(entries)
+            save_json(path, digests)
+    return out
+
+
+def session_row_digest(pid):
+    """Hash of the row of a session in the session table."""
+    df = session_table()
+    return hashlib.sha1((df.loc[pid].to_json() if pid in df.index else '').encode()).hexdigest()
+
+
+def features_digest(pid):
+    """Hash of the rows of a session in the raw ephys features table."""
+    features = features_table()
+    rows = features.offsets.get(pid, None)
+    h = hashlib.sha1()
+    if rows is not None:
+        for name in sorted(features.columns):
+            h.update(f'{name}:'.encode())
+            h.update(pd.util.hash_array(features.columns[name][rows]).tobytes())
+    return h.hexdigest()
+
+
+# Tables of the data folder shared by all sessions, and hash of the rows of a session.
+TABLE_DIGESTS = {
+    'session.table.pqt': session_row_digest,
+    'raw_ephys_features.pqt': features_digest,
+}
+
+
+def inputs_fingerprint(pid, eid, kind):
+    """Fingerprint of the input files of an artifact: the hash of their names and contents, and of
+    the rows of the session in the shared tables."""
+    paths, tables = [], []
+    for pattern in ARTIFACT_INPUTS[kind]:
+        if pattern in TABLE_DIGESTS:
+            tables.extend([pattern] if DATA_DIR.joinpath(pattern).exists() else [])
+        else:
+            paths.extend(sorted(DATA_DIR.glob(pattern.format(pid=pid, eid=eid))))
+    h = hashlib.sha1()
+    for path, digest in input_digests(paths).items():
+        h.update(f'{path.relative_to(DATA_DIR)}:{digest};'.encode())
+    for name in tables:
+        h.update(f'{name}:{TABLE_DIGESTS[name](pid)};'.encode())
+    return h.hexdigest()
+
+
+def _referenced_functions(func):
+    """Return our own functions and methods called in the source code of a function."""
+    src = inspect.getsource(func)
+    module = sys.modules[func.__module__]
+    owner = getattr(module, func.__qualname__.split('.')[0], None) if '.' in func.__qualname__ else None
+    modules = (__name__, DataLoader.__module__)
+    for prefix, name in re.findall(r'(?:(\w+)\.)?(\w+)\(', src):
+        if prefix == 'self' and owner is not None:
+            obj = getattr(owner, name, None)
+        elif prefix in ('loader', 'dl'):
+            obj = getattr(DataLoader, name, None)
+        elif not prefix:
+            obj = getattr(module, name, None)
+        else:
+            obj = None
+        if inspect.isfunction(obj) and obj.__module__ in modules:
+            yield obj
+
+
+def _source_fingerprint(roots):
+    """Hash of the source code of some functions and of all the functions they call in this
+    repository."""
+    roots = list(roots)
+    funcs = {}
+    while roots:
+        func = inspect.unwrap(roots.pop())
+        name = f'{op.basename(inspect.getsourcefile(func))}:{func.__qualname__}'
+        if name in funcs:
+            continue
+        funcs[name] = func
+        roots.extend(_referenced_functions(func))
+    h = hashlib.sha1()
+    for name in sorted(funcs):
+        h.update(inspect.getsource(funcs[name]).encode())
+    return h.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def code_fingerprint(kind):
+    """Fingerprint of the plotting code of an artifact: the Generator method making it and all
+    the functions it calls, and the layout constants it uses."""
+    fingerprint = _source_fingerprint([getattr(Generator, ARTIFACT_CODE[kind]), DataLoader.session_init])
+    constants = [f'{name}={globals()[name]!r}' for name in ARTIFACT_CONSTANTS.get(kind, ())]
+    if not constants:
+        return fingerprint
+    return hashlib.sha1(';'.join([fingerprint] + constants).encode()).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def compute_code_fingerprint():
+    """Fingerprint of the code computing the data products and saving the session snapshot, which
+    excludes the rendering code."""
+    computes = [func for name, func in vars(DataLoader).items() if name.startswith('compute_')]
+    return _source_fingerprint(computes + [DataLoader.session_init, Generator.open_products])
+
+
+def products_fingerprint(inputs):
+    """Fingerprint of the data products of a session, from the fingerprints of its input files
+    (a dictionary {kind: fingerprint}) and of the compute code."""
+    h = hashlib.sha1()
+    for kind in sorted(inputs):
+        h.update(f'{kind}:{inputs[kind]};'.encode())
+    h.update(compute_code_fingerprint().encode())
+    return h.hexdigest()
+
+
+def behaviour_fits_key(inputs):
+    """Key of the behaviour fits of a session: fingerprint of its trials files (`inputs`, the
+    'behaviour_fits' fingerprint recorded in the manifest or product store) and of the fitting code."""
+    h = hashlib.sha1()
+    h.update(f"{inputs};{code_fingerprint('behaviour_fits')}".encode())
+    return h.hexdigest()
+
+
+def behaviour_fits_keys(pids, eids):
+    """Keys of the behaviour fits in use: those recorded in the manifests and product stores of
+    the sessions, and those of the trials files of the data folder."""
+    inputs = set()
+    for pid in pids:
+        if not CACHE_DIR.joinpath(pid).is_dir():
+            continue
+        entry = Manifest(pid, None).artifacts.get(behaviour_fits_path(pid).name, None)
+        inputs.add(entry['inputs'] if entry else None)
+        inputs.add(ProductStore(products_path(pid)).index().get('inputs', {}).get('behaviour_fits', None))
+    inputs |= {inputs_fingerprint(None, eid, 'behaviour_fits') for eid in eids if DATA_DIR.joinpath(eid).is_dir()}
+    return {behaviour_fits_key(fingerprint) for fingerprint in inputs - {None}}
+
+
+@contextmanager
+def _file_lock(path):
+    """Exclusive lock around read-modify-write operations on a shared file."""
+    if fcntl is None:
+        yield
+        return
+    with open(f'{path}.lock', 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class Manifest:
+    """Record of the artifacts of a session: fingerprints of their inputs and code, and hash of their content."""
+
+    def __init__(self, pid, eid, inputs=None, path=None):
+        # The artifacts shared by the probes of a session are recorded in a manifest of the
+        # session (eid) folder, without pid.
+        self.pid = pid
+        self.eid = eid
+        self.path = path or manifest_path(pid)
+        self.artifacts = self.load().get('artifacts', {})
+        # Input fingerprints can be given when the input files are not available, for example
+        # those recorded in the product store when rendering without the ALF files.
+        self._inputs = dict(inputs or {})
+        self._pending = {}
+
+    def load(self):
+        if not self.path.exists():
+            return {}
+        return load_json(self.path)
+
+    def inputs_fingerprint(self, kind):
+        if kind not in self._inputs:
+            self._inputs[kind] = inputs_fingerprint(self.pid, self.eid, kind)
+        return self._inputs[kind]
+
+    def is_stale(self, path, kind):
+        entry = self.artifacts.get(path.name, None)
+        if entry is None or not path.exists():
+            return True
+        return entry['inputs'] != self.inputs_fingerprint(kind) or entry['code'] != code_fingerprint(kind)
+
+    def add(self, path, kind):
+        entry = {
+            'kind': kind,
+            'inputs': self.inputs_fingerprint(kind),
+            'code': code_fingerprint(kind),
+            'hash': store_object(path),
+            'date': datetime.now(),
+        }
+        self.artifacts[path.name] = entry
+        self._pending[path.name] = entry
+
+    def save(self):
+        """Merge the new entries into the manifest file, which may be updated concurrently by
+        other workers generating other artifacts of the same session."""
+        if not self._pending:
+            return
+        with _file_lock(self.path):
+            manifest = self.load()
+            manifest.setdefault('artifacts', {}).update(self._pending)
+            manifest['pid'] = self.pid
+            manifest['eid'] = self.eid
+            save_json(self.path, manifest)
+        self.artifacts = manifest['artifacts']
+        self._pending = {}
+
+
+def expected_artifacts(pid, details=None):
+    """Return a dictionary {path: kind} with all the artifacts of a session, using the trial
+    and cluster ids of the session arrays."""
+    if details is None:
+        details = load_json(session_details_path(pid)) if session_details_path(pid).exists() else {}
+    # Session details of older versions without the session arrays are handled as missing.
+    if not details or '_arrays' not in details:
+        return {}
+    out = {
+        session_details_path(pid): 'session_details',
+        session_arrays_path(pid): 'session_details',
+        item_details_path(pid): 'item_details',
+        session_overview_path(pid): 'session',
+        behaviour_overview_path(pid): 'behaviour',
+        trial_event_overview_path(pid): 'trial_event',
+        trial_intervals_path(pid): 'trial_event',
+        cluster_pixels_path(pid): 'cluster_pixels',
+        behaviour_fits_path(pid): 'behaviour_fits',
+    }
+    arrays = load_session_arrays(pid, details)
+    for trial_idx in arrays.get('trial_ids', np.array([])).tolist():
+        out[trial_overview_path(pid, trial_idx)] = 'trial'
+    for cluster_idx in arrays.get('cluster_ids', np.array([])).tolist():
+        out[cluster_overview_path(pid, cluster_idx)] = 'cluster'
+    return out
+
+
+def stale_artifacts(pid, inputs=None):
+    """Return the stale artifacts of a session without loading its data, or None if it was never generated."""
+    path = session_details_path(pid)
+    details = load_json(path) if path.exists() else {}
+    artifacts = expected_artifacts(pid, details=details)
+    if not artifacts:
+        return None
+    manifest = Manifest(pid, details.get('eid', None), inputs=inputs)
+    return {path: kind for path, kind in artifacts.items() if manifest.is_stale(path, kind)}
+
+
+# -------------------------------------------------------------------------------------------------
+# Catalogue
+# -------------------------------------------------------------------------------------------------
+
+def generated_sessions():
+    """Return the details of the sessions found in the cache, sorted by lab and subject."""
+    CACHE_DIR.mkdir(exist_ok=True, parents=True)
+    pids = sorted([str(p.name) for p in CACHE_DIR.iterdir()])
+    pids = [pid for pid in pids if is_valid_uuid(pid)]
+    sessions = [load_json(session_details_path(pid)) for pid in pids]
+    sessions = [_ for _ in sessions if _]
+    sessions = sorted(sessions, key=itemgetter('Lab', 'Subject'))
+    return sessions
+
+
+def write_catalogue():
+    """Merge the details of all generated sessions into the catalogue read by the server, and
+    record the sessions that still have stale artifacts."""
+    sessions = generated_sessions()
+    incomplete = [details['ID'] for details in sessions if stale_artifacts(details['ID']) != {}]
+    for pid in incomplete:
+        logger.warning(f"session {pid} has stale artifacts")
+    path = catalogue_path()
+    with _file_lock(path):
+        save_json(path, {'sessions': sessions, 'incomplete': incomplete})
+    logger.info(f"Saved the catalogue of {len(sessions)} sessions")
+
+
 # -------------------------------------------------------------------------------------------------
 # Session iterator
 # -------------------------------------------------------------------------------------------------
 
 def get_pids():
-    df = pd.read_parquet(DATA_DIR.joinpath('session.table.pqt'))
-    pids = df.pid.values
+    pids = session_table().index.values
     # pids = sorted([str(p.name) for p in DATA_DIR.iterdir()])
     pids = [pid for pid in pids if is_valid_uuid(pid)]
     assert pids
@@ -244,32 +884,351 @@ def iter_session():
     yield from get_pids()
 
 
+# -------------------------------------------------------------------------------------------------
+# Cache maintenance
+# -------------------------------------------------------------------------------------------------
+
+def parse_size(size):
+    """Parse a size in bytes, such as `500M` or `20G`."""
+    m = re.fullmatch(r'([\d.]+)([kKMGT]?)i?B?', str(size).strip())
+    if not m:
+        raise ValueError(f"invalid size `{size}`")
+    return int(float(m.group(1)) * 1024 ** ' KMGT'.index(m.group(2).upper() or ' '))
+
+
+def format_size(size):
+    return f'{size / 2 ** 20:.1f} MB'
+
+
+def _iter_files(path):
+    if path.is_file():
+        yield path
+        return
+    for root, _, files in os.walk(path):
+        for name in files:
+            yield Path(root) / name
+
+
+def disk_usage(path):
+    """Size in bytes of the files of a folder, counting the hard links to the same file once."""
+    sizes = {}
+    for file in _iter_files(path):
+        try:
+            st = os.lstat(file)
+        except FileNotFoundError:
+            continue
+        sizes[st.st_dev, st.st_ino] = st.st_size
+    return sum(sizes.values())
+
+
+def object_inodes():
+    return {(st.st_dev, st.st_ino) for st in map(os.lstat, _iter_files(OBJECTS_DIR))} if OBJECTS_DIR.exists() else set()
+
+
+def freed_size(path, objects=()):
+    """Bytes freed by removing a file or folder: the files that are not linked from outside of
+    it, except from the content-addressed store (`objects` inodes) whose unlinked objects are
+    removed afterwards."""
+    links, files = Counter(), {}
+    for file in _iter_files(path):
+        try:
+            st = os.lstat(file)
+        except FileNotFoundError:
+            continue
+        links[st.st_dev, st.st_ino] += 1
+        files[st.st_dev, st.st_ino] = (st.st_size, st.st_nlink)
+    return sum(size for key, (size, nlink) in files.items() if nlink - links[key] - (key in objects) == 0)
+
+
+def last_access(path):
+    """Last access (or modification) time of the files of a session folder."""
+    times = [max(st.st_atime, st.st_mtime) for st in (file.stat() for file in path.iterdir() if file.is_file())]
+    return max(times, default=path.stat().st_mtime)
+
+
+def orphan_artifacts(pid):
+    """Files of a session folder that are not artifacts of the session: artifacts of older
+    versions or of an older trial and cluster numbering, and previews of saved figures."""
+    expected = expected_artifacts(pid)
+    if not expected:  # details missing or of an older version
+        return []
+    keep = {path.name for path in expected} | {manifest_path(pid).name}
+    out = []
+    for path in sorted(session_cache_path(pid).iterdir()):
+        if not path.is_file() or path.name in keep or path.suffix in ('.lock', '.tmp'):
+            continue
+        if path.name.endswith('.preview.png'):
+            full = path.with_name(path.name[:-len('.preview.png')] + '.png')
+            if full.name in keep and not full.exists():
+                continue
+        out.append(path)
+    return out
+
+
+def cache_garbage(pids, eids):
+    """Return the garbage of the cache folder, and the sessions not in the session table."""
+    garbage, sessions = [], []
+    for path in sorted(CACHE_DIR.iterdir()):
+        name = path.name
+        if name.startswith('_') or not path.is_dir():
+            continue
+        # Folders of invalid pids, or of unknown sessions without details (created by the
+        # requests of the server).
+        if not is_valid_uuid(name) or (name not in pids and not session_details_path(name).exists()):
+            garbage.append(path)
+            continue
+        garbage.extend(orphan_artifacts(name))
+        if name not in pids:
+            sessions.append(name)
+
+    # Behaviour figures of the sessions removed from the session table, and behaviour fits of
+    # older trials or fitting code.
+    if EID_CACHE_DIR.exists():
+        garbage.extend(path for path in sorted(EID_CACHE_DIR.iterdir()) if path.name not in eids)
+    if FITS_DIR.exists():
+        keys = {fits_cache_path(key).name for key in behaviour_fits_keys(pids, eids)}
+        garbage.extend(path for path in sorted(FITS_DIR.iterdir()) if path.name not in keys)
+
+    # Content hashes of the data folders that no longer exist.
+    if DIGESTS_DIR.exists():
+        garbage.extend(
+            path for path in sorted(DIGESTS_DIR.iterdir())
+            if path.name.split('.')[0] != '_root' and not DATA_DIR.joinpath(path.name.split('.')[0]).is_dir())
+
+    # Expired leases, and done markers of the past distributed runs. A run folder is modified by
+    # each session done, and a run without recent activity may still be generating long sessions.
+    if LEASE_DIR.exists():
+        garbage.extend(
+            path for path in sorted(LEASE_DIR.iterdir())
+            if time.time() - path.stat().st_mtime > (LEASE_RUN_RETENTION if path.is_dir() else LEASE_TIMEOUT))
+
+    # Session data shared by processes that no longer exist.
+    shared = SHARED_DIR / 'ibl_website'
+    if shared.exists():
+        expired = time.time() - LEASE_TIMEOUT
+        for path in sorted(shared.iterdir()):
+            orphan = not psutil.pid_exists(int(path.name.rsplit('-', 1)[-1]))
+            if orphan and path.stat().st_mtime < expired:
+                garbage.append(path)
+
+    return garbage, sessions
+
+
+def orphan_objects():
+    """Stored objects no longer linked by any artifact."""
+    return [path for path in _iter_files(OBJECTS_DIR) if os.lstat(path).st_nlink == 1] \
+        if OBJECTS_DIR.exists() else []
+
+
+def collect_garbage(budget=CACHE_BUDGET, dry_run=False):
+    """Remove the garbage of the cache folder, and evict the sessions removed from the session table (stale
+    first, then least recently accessed) over `budget` bytes. Return the bytes reclaimed."""
+    table = session_table()
+    pids, eids = set(table.index), set(table.eid)
+    size = disk_usage(CACHE_DIR)
+
+    garbage, sessions = cache_garbage(pids, eids)
+    objects = object_inodes()
+    removed = {path: freed_size(path, objects) for path in garbage}
+    if garbage:
+        logger.info(f"Found {len(garbage)} garbage files and folders ({format_size(sum(removed.values()))})")
+    left = size - sum(size for path, size in removed.items() if path.is_relative_to(CACHE_DIR))
+
+    # Evict the sessions removed from the session table.
+    evicted = []
+    if budget is not None and left > budget:
+        sessions = sorted(sessions, key=lambda pid: (
+            stale_artifacts(pid) == {}, last_access(session_cache_path(pid))))
+        for pid in sessions:
+            if left <= budget:
+                break
+            path = session_cache_path(pid)
+            removed[path] = freed_size(path, objects)
+            left -= removed[path]
+            evicted.append(pid)
+            logger.info(f"Evicting session {pid} ({format_size(removed[path])}, last accessed on "
+                        f"{datetime.fromtimestamp(last_access(path)):%Y-%m-%d})")
+        if left > budget:
+            logger.warning(f"The cache uses {format_size(left)} after the eviction of all the sessions removed from "
+                           f"the session table, more than the budget of {format_size(budget)}")
+
+    if dry_run:
+        orphans = orphan_objects()
+        reclaimed = sum(removed.values()) + sum(os.lstat(path).st_size for path in orphans)
+        logger.info(f"Would reclaim {format_size(reclaimed)} (and {len(orphans)} unlinked objects)")
+        return reclaimed
+
+    shared = sum(size for path, size in removed.items() if not path.is_relative_to(CACHE_DIR))
+    for path in removed:
+        logger.debug(f"Removing {path}")
+        if path.is_dir():
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            path.unlink(missing_ok=True)
+
+    # Remove the objects no longer linked by any artifact, and the empty fan-out folders.
+    for path in orphan_objects():
+        path.unlink(missing_ok=True)
+    if OBJECTS_DIR.exists():
+        for path in OBJECTS_DIR.iterdir():
+            if path.is_dir() and not any(path.iterdir()):
+                path.rmdir()
+
+    if evicted:
+        write_catalogue()
+    new_size = disk_usage(CACHE_DIR)
+    reclaimed = size - new_size + shared
+    within = f" (budget of {format_size(budget)})" if budget is not None else ''
+    logger.info(f"Reclaimed {format_size(reclaimed)}, the cache uses {format_size(new_size)}{within}")
+    return reclaimed
+
+
+# -------------------------------------------------------------------------------------------------
+# PNG encoding
+# -------------------------------------------------------------------------------------------------
+
+def render_rgba(fig, dpi=None):
+    """Render a figure into an RGBA array, as `fig.savefig()` does before encoding the PNG."""
+    # The figure is rendered at the resolution of the PNG, with the size of the canvas in pixels
+    # as rounded by the renderer.
+    figure_dpi, fig.dpi = fig.dpi, dpi or fig.dpi
+    buf = io.BytesIO()
+    try:
+        fig.savefig(buf, format='rgba', dpi=fig.dpi)
+        width, height = fig.canvas.get_width_height(physical=True)
+    finally:
+        fig.dpi = figure_dpi
+    return np.frombuffer(buf.getbuffer(), dtype=np.uint8).reshape(height, width, 4)
+
+
+def encode_png(rgba, path, dpi, compress_level=None, optimize=False):
+    """Encode an RGBA array into a PNG file, with the same metadata as `fig.savefig()`."""
+    pil_kwargs = {}
+    if compress_level is not None:
+        pil_kwargs['compress_level'] = compress_level
+    if optimize:
+        pil_kwargs['optimize'] = True
+    with atomic_write(path) as tmp:
+        mpl.image.imsave(tmp, memoryview(rgba), format='png', dpi=dpi, pil_kwargs=pil_kwargs)
+
+
+class PNGEncoder:
+    """Encode the figures rendered on the calling thread into PNG files in a pool of threads, with at most
+    `queue_size` buffers waiting."""
+
+    def __init__(self, n_threads=PNG_THREADS, queue_size=PNG_QUEUE):
+        self.pid = os.getpid()
+        self.pool = ThreadPoolExecutor(n_threads, thread_name_prefix='png')
+        self._slots = threading.BoundedSemaphore(queue_size)
+
+    def submit(self, fig, path, dpi=None, session=None):
+        rgba = render_rgba(fig, dpi=dpi)
+        self._slots.acquire()
+        try:
+            future = self.pool.submit(self._encode, rgba, path, dpi or fig.dpi, session)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    @staticmethod
+    def _encode(rgba, path, dpi, session):
+        with trace_span('encode_png', 'png', session=session, figure=path.name):
+            encode_png(rgba, path, dpi, compress_level=PNG_COMPRESS_LEVEL, optimize=PNG_OPTIMIZE)
+
+
+_png_encoder = None
+
+
+def png_encoder():
+    """Encoder of this process (the forked worker processes start their own threads)."""
+    global _png_encoder
+    if _png_encoder is None or _png_encoder.pid != os.getpid():
+        _png_encoder = PNGEncoder()
+    return _png_encoder
+
+
+def set_png_options(compress_level=None, optimize=False):
+    """Set the PNG compression level and optimization pass, in this process and in the worker
+    processes started afterwards."""
+    global PNG_COMPRESS_LEVEL, PNG_OPTIMIZE
+    PNG_COMPRESS_LEVEL, PNG_OPTIMIZE = compress_level, optimize
+    os.environ[PNG_ENV] = f"{'' if compress_level is None else compress_level},{int(optimize)}"
+
+
 # -------------------------------------------------------------------------------------------------
 # Plot and JSON generator
 # -------------------------------------------------------------------------------------------------
 
+def load_session(pid, store):
+    """Return the DataLoader of a session and the fingerprints of its inputs, attached to the product store
+    snapshot when it was saved from the same inputs and code."""
+    eid = store.index().get('eid', None)
+    if eid is not None:
+        inputs = {kind: inputs_fingerprint(pid, eid, kind) for kind in ARTIFACT_INPUTS}
+        with _file_lock(store.path):
+            path = store.path / 'session'
+            if store.index().get('fingerprint', None) == products_fingerprint(inputs) and \
+                    (path / 'session.pkl').exists():
+                logger.debug(f"Loading the data of session {pid} from its snapshot")
+                return DataLoader.load_snapshot(path), inputs
+    dl = DataLoader()
+    dl.session_init(pid)
+    return dl, None
+
+
 class Generator:
-    def __init__(self, pid):
-        self.dl = DataLoader()
-        self.dl.session_init(pid)
+    def __init__(self, pid, dl=None, n_jobs=1, save_details=True, render_only=False, preview=False):
+        # With render_only, the figures are rendered from the data products computed beforehand,
+        # without the ALF files. With preview, the missing figures are saved as low-resolution
+        # previews, see savefig().
+        store = ProductStore(products_path(pid))
+        inputs = store.index().get('inputs', None) if render_only else None
+        self._snapshot = None  # session snapshot the session data is attached to
+        if dl is None and render_only:
+            self._snapshot = store.path / 'session'
+            dl = DataLoader.load_snapshot(self._snapshot, exclude=SNAPSHOT_RENDER_EXCLUDE)
+        elif dl is None:
+            dl, inputs = load_session(pid, store)
+            self._snapshot = store.path / 'session' if inputs else None
+        dl.store = store
+        if preview:
+            dl.bin_scale = PREVIEW_BIN_SCALE
+        self.dl = dl
         self.pid = pid
+        self.n_jobs = n_jobs  # number of processes rendering the trial and cluster plots
+        self.render_only = render_only
+        self.preview = preview
+        self._shared = None
+        self._templates = {}  # figure templates of the trial and cluster plots, see template()
+        self._encoding = {}  # futures of the figures being encoded, see savefig()
+        self._built = []  # figures marked as built while being encoded
 
         # Ensure the session cache folder exists.
         session_cache_path(pid).mkdir(exist_ok=True, parents=True)
 
-        # Load the session details.
-        path = session_details_path(pid)
-        self.session_details = self.dl.get_session_details()
+        # Fingerprints of the artifacts already generated for this session.
+        self.manifest = Manifest(pid, self.dl.eid, inputs=inputs)
 
-        # Save the session details to a JSON file.
-        logger.debug(f"Saving session details for session {pid}")
-        save_json(path, self.session_details)
+        # Load and save the session details. Workers attached to a shared session do not rewrite
+        # the file saved by the parent process.
+        if save_details and not render_only:
+            self.open_products()
+            self.save_session_details()
+        else:
+            self.session_details = load_json(session_details_path(pid))
+            self.session_arrays = load_session_arrays(pid, self.session_details)
 
-        self.trial_idxs = self.session_details['_trial_ids']
+        self.trial_idxs = self.session_arrays['trial_ids'].tolist()
         self.n_trials = len(self.trial_idxs)
-        self.cluster_idxs = self.session_details['_cluster_ids']
+        self.cluster_idxs = self.session_arrays['cluster_ids'].tolist()
         self.n_clusters = len(self.cluster_idxs)
 
+        if save_details and not render_only:
+            self.save_item_details()
+            self.save_cluster_pixels()
+
     # Iterators
     # -------------------------------------------------------------------------------------------------
 
@@ -285,20 +1244,160 @@ class Generator:
     def iter_cluster(self):
         yield from sorted(self.cluster_idxs)
 
+    # Manifest
+    # -------------------------------------------------------------------------------------------------
+
+    def is_stale(self, path, kind, manifest=None):
+        if self.preview and path.suffix == '.png':
+            return not path.exists() and not preview_path(path).exists()
+        return (manifest or self.manifest).is_stale(path, kind)
+
+    def mark_built(self, path, kind, manifest=None):
+        # The previews are not recorded in the manifest, the full-quality figures remain stale.
+        if self.preview and path.suffix == '.png':
+            return
+        # The figures being encoded are recorded once their file is written, see wait_figures().
+        if path in self._encoding:
+            self._built.append((path, kind, manifest))
+            return
+        (manifest or self.manifest).add(path, kind)
+
+    def eid_manifest(self):
+        """Manifest of the artifacts shared by the probes of the session."""
+        inputs = {'behaviour': self.manifest.inputs_fingerprint('behaviour')}
+        return Manifest(None, self.dl.eid, inputs=inputs, path=eid_manifest_path(self.dl.eid))
+
+    # Saving figures
+    # -------------------------------------------------------------------------------------------------
+
+    def savefig(self, fig, path):
+        """Save a figure, or its low-resolution preview which is served until the full-quality
+        figure is saved. The figure is rendered immediately and encoded in the background."""
+        dpi = None
+        if self.preview:
+            path, dpi = preview_path(path), PREVIEW_DPI
+        if path in self._encoding:  # the same figure saved again
+            self.wait_figures()
+        self._encoding[path] = png_encoder().submit(fig, path, dpi=dpi, session=self.pid)
+
+    def wait_figures(self):
+        """Wait for the figures being encoded, and record the figures saved in their manifest."""
+        encoding, self._encoding = self._encoding, {}
+        built, self._built = self._built, []
+        failed = set()
+        for path, future in encoding.items():
+            try:
+                future.result()
+            except Exception as e:
+                print(f"error with session {self.pid} figure {path.name}: {str(e)}")
+                failed.add(path)
+                continue
+            if not self.preview and preview_path(path).exists():
+                os.remove(preview_path(path))
+        for path, kind, manifest in built:
+            if path not in failed:
+                (manifest or self.manifest).add(path, kind)
+
+    def link_figure(self, src, path):
+        """Link a figure shared by the probes of the session (or its preview) from the cache
+        folder of this probe."""
+        if not src.exists():
+            src, path = preview_path(src), preview_path(path)
+        elif preview_path(path).exists():
+            os.remove(preview_path(path))
+        link_file(src, path)
+
+    def save_manifest(self):
+        self.wait_figures()
+        self.manifest.save()
+
+    # Data products
+    # -------------------------------------------------------------------------------------------------
+
+    def open_products(self):
+        """Discard the data products of the session made from other input files or with other
+        compute code, and save the session snapshot, used to render the figures without the ALF
+        files and to re-initialize the session quickly (see load_session())."""
+        store = self.dl.store
+        inputs = {kind: self.manifest.inputs_fingerprint(kind) for kind in ARTIFACT_INPUTS}
+        with _file_lock(store.path):
+            if store.reset(products_fingerprint(inputs), pid=self.pid, eid=self.dl.eid, inputs=inputs):
+                logger.debug(f"Saving the session data of session {self.pid} in the product store")
+                self.dl.save_snapshot(store.path / 'session')
+
+    def compute_products(self, nums=FIGURES):
+        """Compute stage: save the data products of the figures without rendering them."""
+        loader = self.dl
+        for num in nums:
+            if num == 1:
+                loader.compute_raw_data()
+            elif num == 2:
+                for feature, zscore_flag, norm in (('paw_r_speed', False, False), ('nose_tip_speed', False, False),
+                                                   ('motion_energy', True, False), ('pupilDiameter_smooth', True, True)):
+                    loader.compute_dlc_raster('left', feature, zscore_flag, norm)
+                loader.compute_wheel_raster()
+                loader.compute_lick_raster()
+            elif num == 3:
+                for trial_idx in self.iter_trial():
+                    loader.compute_trial_raster(trial_idx)
+            elif num == 4:
+                loader.compute_event_aligned_activity()
+            elif num == 5:
+                for cluster_idx in self.iter_cluster():
+                    for event in ('stimOn_times', 'firstMovement_times', 'feedback_times'):
+                        loader.compute_cluster_raster(cluster_idx, event)
+                    loader.compute_autocorrelogram(cluster_idx)
+                    loader.compute_inter_spike_interval(cluster_idx)
+                    loader.compute_cluster_spikes(cluster_idx)
+                loader.compute_session_duration()
+
     # Saving JSON details
     # -------------------------------------------------------------------------------------------------
 
-    def save_trial_details(self, trial_idx):
-        logger.debug(f"saving trial #{trial_idx:04} details for session {self.pid}")
-        details = self.dl.get_trial_details(trial_idx)
-        path = trial_details_path(self.pid, trial_idx)
-        save_json(path, details)
+    def save_session_details(self, force=False):
+        path_arrays = session_arrays_path(self.pid)
+        path = session_details_path(self.pid)
+        if not force and not self.is_stale(path_arrays, 'session_details') and not self.is_stale(path, 'session_details'):
+            self.session_details = load_json(path)
+            self.session_arrays = load_session_arrays(self.pid, self.session_details)
+            return
+        self.session_details = self.dl.get_session_details()
+        self.session_arrays = self.dl.get_session_arrays()
 
-    def save_cluster_details(self, cluster_idx):
-        logger.debug(f"saving cluster #{cluster_idx:04} details for session {self.pid}")
-        details = self.dl.get_cluster_details(cluster_idx)
-        path = cluster_details_path(self.pid, cluster_idx)
-        save_json(path, details)
+        # Save the session arrays to a binary file, described in the session details saved to a
+        # JSON file afterwards.
+        logger.debug(f"Saving session details for session {self.pid}")
+        self.session_details['_arrays'] = save_arrays(path_arrays, self.session_arrays)
+        save_json(path, self.session_details)
+        self.mark_built(path_arrays, 'session_details')
+        self.mark_built(path, 'session_details')
+        self.save_manifest()
+
+    def save_item_details(self, force=False):
+        # The details of all the trials and clusters are saved in one file indexed by id, which
+        # the server keeps in memory.
+        path = item_details_path(self.pid)
+        if not force and not self.is_stale(path, 'item_details'):
+            return
+        logger.debug(f"Saving trial and cluster details for session {self.pid}")
+        trials = self.dl.get_all_trial_details(self.trial_idxs)
+        clusters = self.dl.get_all_cluster_details(self.cluster_idxs)
+        save_json(path, {'trials': trials, 'clusters': clusters})
+        self.mark_built(path, 'item_details')
+        self.save_manifest()
+
+    def save_cluster_pixels(self, force=False):
+        # Position of the clusters in the cluster figure, used to select the cluster clicked in
+        # the frontend (see get_cluster_idx_from_xy()).
+        path = cluster_pixels_path(self.pid)
+        if not force and not self.is_stale(path, 'cluster_pixels'):
+            return
+        logger.debug(f"Saving the cluster positions for session {self.pid}")
+        df = cluster_pixels(self.dl)
+        with atomic_write(path) as tmp:
+            df.to_parquet(tmp)
+        self.mark_built(path, 'cluster_pixels')
+        self.save_manifest()
 
     # -------------------------------------------------------------------------------------------------
     # SESSION OVERVIEW
@@ -308,7 +1407,7 @@ class Generator:
 
     def make_session_plot(self, force=False):
         path = session_overview_path(self.pid)
-        if not force and path.exists():
+        if not force and not self.is_stale(path, 'session'):
             return
         logger.debug(f"making session overview plot for session {self.pid}")
         loader = self.dl
@@ -359,17 +1458,57 @@ class Generator:
             set_figure_style(fig)
             fig.subplots_adjust(top=1.02, bottom=0.05)
 
-            fig.savefig(path)
+            self.savefig(fig, path)
             plt.close(fig)
+            self.mark_built(path, 'session')
         except Exception as e:
             print(f"error with session overview plot {self.pid}: {str(e)}")
 
     # FIGURE 2
+    def save_behaviour_fits(self, force=False):
+        # The psychometric fits and reaction times only depend on the trials: they are computed
+        # once per trials fingerprint (see fit_all_sessions()) and linked from the probe folders.
+        path = behaviour_fits_path(self.pid)
+        if not force and not self.is_stale(path, 'behaviour_fits'):
+            return
+        # The trials fingerprint is the one recorded in the product store when rendering without
+        # the ALF files.
+        shared = fits_cache_path(behaviour_fits_key(self.manifest.inputs_fingerprint('behaviour_fits')))
+        shared.parent.mkdir(exist_ok=True, parents=True)
+        with _file_lock(shared):
+            # A forced figure reuses the cached fits, whose key covers the trials and fitting code.
+            if not shared.exists():
+                logger.debug(f"fitting the behaviour of session {self.dl.eid}")
+                save_json(shared, compute_behaviour_fits(self.dl.trials))
+        link_file(shared, path)
+        self.mark_built(path, 'behaviour_fits')
+
+    def behaviour_fits(self):
+        self.save_behaviour_fits()
+        return load_json(behaviour_fits_path(self.pid))
+
     def make_behavior_plot(self, force=False):
 
         path = behaviour_overview_path(self.pid)
-        if not force and path.exists():
+        if not force and not self.is_stale(path, 'behaviour'):
             return
+
+        # The figure only depends on the session (eid) data: it is rendered once for all the
+        # probes of the session, which link to it.
+        shared = behaviour_shared_path(self.dl.eid)
+        with _file_lock(shared):
+            manifest = self.eid_manifest()
+            if force or self.is_stale(shared, 'behaviour', manifest=manifest):
+                self.render_behavior_plot(shared)
+                self.mark_built(shared, 'behaviour', manifest=manifest)
+                self.wait_figures()
+                manifest.save()
+            else:
+                logger.debug(f"linking the behavior plot of session {self.dl.eid} for session {self.pid}")
+        self.link_figure(shared, path)
+        self.mark_built(path, 'behaviour')
+
+    def render_behavior_plot(self, path):
         logger.debug(f"making behavior plot for session {self.pid}")
         loader = self.dl
 
@@ -382,9 +1521,10 @@ class Generator:
         ax2 = fig.add_subplot(gs1[0, 1])
         ax3 = fig.add_subplot(gs1[0, 2])
         ax4 = fig.add_subplot(gs1[0, 3])
-        loader.plot_psychometric_curve(ax=ax1, ax_legend=ax2)
-        loader.plot_chronometric_curve(ax=ax3)
-        loader.plot_reaction_time(ax=ax4)
+        fits = self.behaviour_fits()
+        loader.plot_psychometric_curve(ax=ax1, ax_legend=ax2, fits=fits)
+        loader.plot_chronometric_curve(ax=ax3, fits=fits)
+        loader.plot_reaction_time(ax=ax4, fits=fits)
 
         gs1 = gridspec.GridSpecFromSubplotSpec(2, 6, subplot_spec=gs[1], height_ratios=[1, 3], hspace=0, wspace=0.5)
         ax5 = fig.add_subplot(gs1[0, 0])
@@ -432,7 +1572,7 @@ class Generator:
 
         set_figure_style(fig)
 
-        fig.savefig(path)
+        self.savefig(fig, path)
         plt.close(fig)
 
     # -------------------------------------------------------------------------------------------------
@@ -441,27 +1581,37 @@ class Generator:
 
     # FIGURE 3
 
+    def make_trial_template(self):
+        loader = self.dl
+
+        fig, axs = plt.subplots(1, 3, figsize=(12, 5), gridspec_kw={'width_ratios': [5, 10, 1], 'wspace': 0.05})
+        loader.plot_session_raster(ax=axs[0], xlabel='T in session (s)')
+        axs[1].get_yaxis().set_visible(False)
+        loader.plot_brain_regions(axs[2])
+        set_figure_style(fig)
+
+        return FigureTemplate(fig, axs).freeze()
+
     def make_trial_plot(self, trial_idx, force=False):
         path = trial_overview_path(self.pid, trial_idx)
-        if not force and path.exists():
+        if not force and not self.is_stale(path, 'trial'):
             return
         logger.debug(f"making trial overview plot for session {self.pid}, trial #{trial_idx:04d}")
         loader = self.dl
 
-        fig, axs = plt.subplots(1, 3, figsize=(12, 5), gridspec_kw={'width_ratios': [5, 10, 1], 'wspace': 0.05})
-        loader.plot_session_raster(trial_idx=trial_idx, ax=axs[0], xlabel='T in session (s)')
+        template = self.template(3)
+        template.reset()
+        fig, axs = template.fig, template.axs
+        loader.plot_session_raster(trial_idx=trial_idx, ax=axs[0], layout=False)
         loader.plot_trial_raster(trial_idx=trial_idx, ax=axs[1], xlabel='T in trial(s)')
-        axs[1].get_yaxis().set_visible(False)
-        loader.plot_brain_regions(axs[2])
-        set_figure_style(fig)
 
-        fig.savefig(path)
-        plt.close(fig)
+        self.savefig(fig, path)
+        self.mark_built(path, 'trial')
 
     # FIGURE 4
     def make_trial_event_plot(self, force=False):
         path = trial_event_overview_path(self.pid)
-        if not force and path.exists():
+        if not force and not self.is_stale(path, 'trial_event'):
             return
         logger.debug(f"making trial event plot for session {self.pid}")
         loader = self.dl
@@ -479,14 +1629,18 @@ class Generator:
         loader.plot_brain_regions(ax=ax5)
         set_figure_style(fig)
 
-        fig.savefig(path)
+        self.savefig(fig, path)
         plt.close(fig)
 
         path_interval = trial_intervals_path(self.pid)
         df = pd.DataFrame()
         df['t0'] = loader.trial_intervals[:, 0]
         df['t1'] = loader.trial_intervals[:, 1]
-        df.to_parquet(path_interval)
+        with atomic_write(path_interval) as tmp:
+            df.to_parquet(tmp)
+
+        self.mark_built(path, 'trial_event')
+        self.mark_built(path_interval, 'trial_event')
 
     # -------------------------------------------------------------------------------------------------
     # SINGLE CLUSTER OVERVIEW
@@ -494,16 +1648,12 @@ class Generator:
 
     # FIGURE 5
 
-    def make_cluster_plot(self, cluster_idx, force=False):
-        path = cluster_overview_path(self.pid, cluster_idx)
-        if not force and path.exists():
-            return
-        logger.debug(f"making cluster overview plot for session {self.pid}, cluster #{cluster_idx:04d}")
+    def make_cluster_template(self):
         loader = self.dl
 
-        fig = plt.figure(figsize=(15, 10))
+        fig = plt.figure(figsize=CLUSTER_FIGSIZE)
 
-        gs = gridspec.GridSpec(2, 3, figure=fig, width_ratios=[2, 10, 3], height_ratios=[6, 2], wspace=0.2)
+        gs = gridspec.GridSpec(figure=fig, **CLUSTER_GRID)
 
         gs0 = gridspec.GridSpecFromSubplotSpec(1, 1, subplot_spec=gs[0])
         ax1 = fig.add_subplot(gs0[0, 0])
@@ -526,15 +1676,16 @@ class Generator:
         ax12 = fig.add_subplot(gs3[0, 0])
         ax13 = fig.add_subplot(gs3[0, 1])
         ax14 = fig.add_subplot(gs3[0, 2])
+        ax15 = ax14.twinx()
 
         set_figure_style(fig)
 
-        loader.plot_spikes_amp_vs_depth(cluster_idx, ax=ax1, xlabel='Amp (uV)')
+        loader.plot_spikes_amp_vs_depth(None, ax=ax1, xlabel='Amp (uV)')
 
-        loader.plot_block_single_cluster_raster(cluster_idx, axs=[ax2, ax3])
-        loader.plot_contrast_single_cluster_raster(cluster_idx, axs=[ax4, ax5], ylabel0=None, ylabel1=None)
-        loader.plot_left_right_single_cluster_raster(cluster_idx, axs=[ax6, ax7], ylabel0=None, ylabel1=None)
-        loader.plot_correct_incorrect_single_cluster_raster(cluster_idx, axs=[ax8, ax9], ylabel0=None, ylabel1=None)
+        loader.plot_block_single_cluster_raster(None, axs=[ax2, ax3])
+        loader.plot_contrast_single_cluster_raster(None, axs=[ax4, ax5], ylabel0=None, ylabel1=None)
+        loader.plot_left_right_single_cluster_raster(None, axs=[ax6, ax7], ylabel0=None, ylabel1=None)
+        loader.plot_correct_incorrect_single_cluster_raster(None, axs=[ax8, ax9], ylabel0=None, ylabel1=None)
         ax2.get_xaxis().set_visible(False)
         ax4.get_xaxis().set_visible(False)
         ax6.get_xaxis().set_visible(False)
@@ -543,17 +1694,40 @@ class Generator:
         ax7.get_yaxis().set_visible(False)
         ax9.get_yaxis().set_visible(False)
 
+        ax2.sharex(ax3)
+        ax4.sharex(ax5)
+        ax6.sharex(ax7)
+        ax8.sharex(ax9)
+
+        return FigureTemplate(fig, [ax1, ax2, ax3, ax4, ax5, ax6, ax7, ax8, ax9, ax10, ax11, ax12, ax13, ax14, ax15]).freeze()
+
+    def make_cluster_plot(self, cluster_idx, force=False):
+        path = cluster_overview_path(self.pid, cluster_idx)
+        if not force and not self.is_stale(path, 'cluster'):
+            return
+        logger.debug(f"making cluster overview plot for session {self.pid}, cluster #{cluster_idx:04d}")
+        loader = self.dl
+
+        template = self.template(5)
+        template.reset()
+        fig = template.fig
+        ax1, ax2, ax3, ax4, ax5, ax6, ax7, ax8, ax9, ax10, ax11, ax12, ax13, ax14, ax15 = template.axs
+
+        loader.plot_spikes_amp_vs_depth(cluster_idx, ax=ax1, layout=False)
+
+        loader.plot_block_single_cluster_raster(cluster_idx, axs=[ax2, ax3], layout=False)
+        loader.plot_contrast_single_cluster_raster(cluster_idx, axs=[ax4, ax5], ylabel0=None, ylabel1=None, layout=False)
+        loader.plot_left_right_single_cluster_raster(cluster_idx, axs=[ax6, ax7], ylabel0=None, ylabel1=None,
+                                                     layout=False)
+        loader.plot_correct_incorrect_single_cluster_raster(cluster_idx, axs=[ax8, ax9], ylabel0=None, ylabel1=None,
+                                                            layout=False)
+
         loader.plot_cluster_waveforms(cluster_idx, ax=ax10)
         loader.plot_channel_probe_location(cluster_idx, ax=ax11)
 
         loader.plot_autocorrelogram(cluster_idx, ax=ax12)
         loader.plot_inter_spike_interval(cluster_idx, ax=ax13)
-        loader.plot_cluster_amplitude(cluster_idx, ax=ax14)
-
-        ax2.sharex(ax3)
-        ax4.sharex(ax5)
-        ax6.sharex(ax7)
-        ax8.sharex(ax9)
+        loader.plot_cluster_amplitude(cluster_idx, ax=ax14, ax_twin=ax15)
 
         yax_to_lim = [ax2, ax4, ax6, ax8]
         max_ax = np.max([ax.get_ylim()[1] for ax in yax_to_lim])
@@ -561,105 +1735,1253 @@ class Generator:
         for ax in yax_to_lim:
             ax.set_ylim(min_ax, max_ax)
 
-        fig.savefig(path)
-
-        path_scat = cluster_pixels_path(self.pid)
-        if not path_scat.exists():
-            idx = np.argsort(loader.clusters_good.depths)[::-1]
-            pixels = ax1.transData.transform(np.vstack([loader.clusters_good.amps[idx].astype(np.float64) * 1e6,
-                                                        loader.clusters_good.depths[idx].astype(np.float64)]).T)
-            width, height = fig.canvas.get_width_height()
-            pixels[:, 0] /= width
-            pixels[:, 1] /= height
-            df = pd.DataFrame()
-            # Sort by depth so they are in the same order as the cluster selector drop down
-            df['cluster_id'] = loader.clusters_good.cluster_id[idx].astype(np.int32)
-            df['x'] = pixels[:, 0]
-            df['y'] = pixels[:, 1]
-            df.to_parquet(path_scat)
+        self.savefig(fig, path)
+        self.mark_built(path, 'cluster')
 
-        plt.close(fig)
+    # Figure templates
+    # -------------------------------------------------------------------------------------------------
+
+    def template(self, num):
+        """Return the template of the trial (3) or cluster (5) figures, built on first use and kept
+        until close_templates()."""
+        if num not in self._templates:
+            self._templates[num] = self.make_trial_template() if num == 3 else self.make_cluster_template()
+        return self._templates[num]
+
+    def close_templates(self):
+        for template in self._templates.values():
+            template.close()
+        self._templates = {}
 
     # Plot generator functions
     # -------------------------------------------------------------------------------------------------
 
-    def make_all_trial_plots(self, force=False):
+    def make_all_trial_plots(self, force=False, trial_idxs=None, progress=True):
 
-        path = trial_overview_path(self.pid, self.first_trial())
-        if not force and path.exists():
-            logger.debug("Skipping trial plot generation as they seem to already exist")
+        trial_idxs = self.iter_trial() if trial_idxs is None else trial_idxs
+        trial_idxs = [idx for idx in trial_idxs if force or self.is_stale(trial_overview_path(self.pid, idx), 'trial')]
+        if not trial_idxs:
+            logger.debug("Skipping trial plot generation as they are up to date")
             return
 
-        desc = "Making all trial plots  "
-        for trial_idx in tqdm(self.iter_trial(), total=self.n_trials, desc=desc):
-            self.save_trial_details(trial_idx)
-            try:
-                self.make_trial_plot(trial_idx, force=force)
-            except Exception as e:
-                print(f"error with session {self.pid} trial #{trial_idx}: {str(e)}")
+        if self.n_jobs > 1:
+            return self.make_items_parallel(3, trial_idxs, force=force, progress=progress)
 
-    def make_all_cluster_plots(self, force=False):
-
-        path = cluster_overview_path(self.pid, self.first_cluster())
-        if not force and path.exists():
-            logger.debug("Skipping cluster plot generation as they seem to already exist")
+        desc = "Making all trial plots  "
+        try:
+            for trial_idx in tqdm(trial_idxs, desc=desc, disable=not progress):
+                try:
+                    self.make_trial_plot(trial_idx, force=force)
+                except Exception as e:
+                    print(f"error with session {self.pid} trial #{trial_idx}: {str(e)}")
+        finally:
+            self.close_templates()
+        self.save_manifest()
+
+    def make_all_cluster_plots(self, force=False, cluster_idxs=None, progress=True):
+
+        cluster_idxs = self.iter_cluster() if cluster_idxs is None else cluster_idxs
+        cluster_idxs = [
+            idx for idx in cluster_idxs if force or self.is_stale(cluster_overview_path(self.pid, idx), 'cluster')]
+        if not cluster_idxs:
+            logger.debug("Skipping cluster plot generation as they are up to date")
             return
 
+        if self.n_jobs > 1:
+            return self.make_items_parallel(5, cluster_idxs, force=force, progress=progress)
+
         desc = "Making all cluster plots"
-        for cluster_idx in tqdm(self.iter_cluster(), total=self.n_clusters, desc=desc):
-            self.save_cluster_details(cluster_idx)
+        try:
+            for cluster_idx in tqdm(cluster_idxs, desc=desc, disable=not progress):
+                try:
+                    self.make_cluster_plot(cluster_idx, force=force)
+                except Exception as e:
+                    print(f"error with session {self.pid} cluster #{cluster_idx}: {str(e)}")
+        finally:
+            self.close_templates()
+        self.save_manifest()
+
+    # Parallel rendering
+    # -------------------------------------------------------------------------------------------------
+
+    def share(self):
+        """Publish the session data into memory-mapped files that worker processes attach to
+        read-only. The generator itself switches to the shared copy so that the session is held
+        in memory only once. A session loaded from its snapshot is already shared."""
+        if self._snapshot is not None:
+            return self._snapshot
+        if self._shared is None:
+            path = session_shared_path(self.pid)
+            logger.debug(f"Sharing the data of session {self.pid} in {path}")
+            self.dl.save_snapshot(path)
+            store, bin_scale = self.dl.store, self.dl.bin_scale
+            self.dl = DataLoader.load_snapshot(path)
+            self.dl.store, self.dl.bin_scale = store, bin_scale
+            self._shared = path
+        return self._shared
+
+    def unshare(self):
+        # NOTE: on POSIX systems, the memory-mapped arrays remain valid after removing the files.
+        if self._shared is not None:
+            shutil.rmtree(self._shared, ignore_errors=True)
+            self._shared = None
+
+    def make_items_parallel(self, num, idxs, force=False, progress=True):
+        """Render the trial (3) or cluster (5) plots with `n_jobs` processes sharing the session
+        data."""
+        path = self.share()
+        n_chunks = min(len(idxs), 4 * self.n_jobs)
+        chunks = [[int(idx) for idx in chunk] for chunk in np.array_split(idxs, n_chunks)]
+        desc = "Making all trial plots  " if num == 3 else "Making all cluster plots"
+        initargs = (self.pid, path, self.render_only, self.preview)
+        with ProcessPoolExecutor(self.n_jobs, initializer=_attach_session, initargs=initargs) as pool:
+            futures = [pool.submit(_make_items, num, chunk, force) for chunk in chunks]
+            for future in tqdm(futures, desc=desc, disable=not progress):
+                future.result()
+
+    def make_figure(self, num, force=False, idxs=None, progress=True):
+        """Make one figure, or a subset `idxs` of the trial (3) or cluster (5) figures."""
+
+        # Figure 0 (the session, trial and cluster details are saved when loading the session,
+        # and saved again when forced)
+        if num == 0:
+            if force and not self.render_only:
+                self.save_session_details(force=True)
+                self.save_item_details(force=True)
+                self.save_cluster_pixels(force=True)
+
+        # Figure 1
+        elif num == 1:
+            self.make_session_plot(force=force)
+
+        # Figure 2
+        elif num == 2:
             try:
-                self.make_cluster_plot(cluster_idx, force=force)
+                self.save_behaviour_fits(force=force)
+                self.make_behavior_plot(force=force)
             except Exception as e:
-                print(f"error with session {self.pid} cluster #{cluster_idx}: {str(e)}")
+                print(f"error with session {self.pid} behavior plot: {str(e)}")
+
+        # Figure 3 (one plot per trial)
+        elif num == 3:
+            self.make_all_trial_plots(force=force, trial_idxs=idxs, progress=progress)
+
+        # Figure 4
+        elif num == 4:
+            self.make_trial_event_plot(force=force)
+
+        # Figure 5 (one plot per cluster)
+        elif num == 5:
+            self.make_all_cluster_plots(force=force, cluster_idxs=idxs, progress=progress)
+
+        self.save_manifest()
 
     def make_all_plots(self, nums=()):
         if 0 in nums:  # used to regenerate the session.json only
+            self.make_figure(0, force=True)
             return
         # nums is a list of numbers 1-5 (figure numbers)
 
         logger.info(f"Making all session plots for session {self.pid}")
 
-        # Figure 1
-        self.make_session_plot(force=1 in nums)
+        try:
+            for num in FIGURES:
+                self.make_figure(num, force=num in nums)
+        finally:
+            self.unshare()
+
+
+def make_all_plots(pid, nums=(), n_jobs=1, render_only=False):
+    # Skip the sessions whose artifacts are all up to date, without loading their data.
+    inputs = ProductStore(products_path(pid)).index().get('inputs', None) if render_only else None
+    if not nums and stale_artifacts(pid, inputs=inputs) == {}:
+        logger.debug(f"Skipping session {pid} as all its artifacts are up to date")
+        return
+    logger.info(f"Generating all plots for session {pid}")
+    Generator(pid, n_jobs=n_jobs, render_only=render_only).make_all_plots(nums=nums)
+
+
+def compute_products(pid, nums=FIGURES):
+    logger.info(f"Computing the data products of session {pid}")
+    Generator(pid).compute_products(nums=nums)
+
+
+def fit_all_sessions(n_jobs=N_JOBS):
+    """Batch stage: compute the behaviour fits of all the sessions (eid) in parallel, except those
+    already cached with the same trials and fitting code."""
+    eids = sorted(set(session_table().loc[get_pids(), 'eid']))
+    keys = {eid: behaviour_fits_key(inputs_fingerprint(None, eid, 'behaviour_fits')) for eid in eids}
+    eids = [eid for eid in eids if not fits_cache_path(keys[eid]).exists()]
+    if not eids:
+        return
+    logger.info(f"Fitting the behaviour of {len(eids)} sessions")
+    FITS_DIR.mkdir(exist_ok=True, parents=True)
+    with ProcessPoolExecutor(min(n_jobs, len(eids))) as pool:
+        for eid, future in [(eid, pool.submit(_fit_session, eid, keys[eid])) for eid in eids]:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"error with session {eid} behaviour fits: {str(e)}")
 
-        # Figure 2
+
+def _fit_session(eid, key):
+    path = fits_cache_path(key)
+    with _file_lock(path):
+        if not path.exists():
+            save_json(path, compute_behaviour_fits(load_trials(eid)))
+    flush_trace()
+
+
+def iter_products():
+    """Iterate over the sessions with data products in the cache."""
+    for path in sorted(CACHE_DIR.glob('*/products/index.json')):
+        yield path.parent.parent.name
+
+
+# Generator attached to the shared session data in the worker processes of make_items_parallel().
+_attached = None
+
+
+def _attach_session(pid, path, render_only=False, preview=False):
+    global _attached
+    dl = DataLoader.load_snapshot(path, exclude=SNAPSHOT_RENDER_EXCLUDE if render_only else ())
+    _attached = Generator(pid, dl=dl, save_details=False, render_only=render_only, preview=preview)
+
+
+def _make_items(num, idxs, force):
+    _attached.make_figure(num, force=force, idxs=idxs, progress=False)
+    flush_trace()
+
+
+# -------------------------------------------------------------------------------------------------
+# Access priority
+# -------------------------------------------------------------------------------------------------
+
+def load_request_log(path):
+    """Return the list of GET paths of a request log, in JSON lines (with a `path` or `url` field) or in
+    the common log format."""
+    urls = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                url = entry.get('path', None) or entry.get('url', None)
+            else:
+                match = _LOG_LINE_REGEX.search(line)
+                url = match.group(1) if match else None
+            if url and url.startswith('/'):
+                urls.append(url)
+    return urls
+
+
+class AccessPriority:
+    """Number of requests of each session, figure, trial and cluster in server access logs."""
+
+    def __init__(self, paths=()):
+        self.sessions = Counter()  # pid: hits
+        self.figures = Counter()  # (pid, figure number): hits
+        self.items = defaultdict(Counter)  # (pid, figure number): {trial or cluster id: hits}
+        for path in paths:
+            for url in load_request_log(path):
+                self.add(url)
+
+    def add(self, url):
+        match = _API_URL_REGEX.fullmatch(url.split('?')[0])
+        if not match or match.group(2) not in ROUTE_FIGURES:
+            return
+        pid, route, idx = match.groups()
+        num = ROUTE_FIGURES[route]
+        self.sessions[pid] += 1
+        self.figures[pid, num] += 1
+        if num in FIGURE_ITEMS and idx is not None:
+            self.items[pid, num][int(idx)] += 1
+
+    def hot_items(self, pid, num):
+        """Requested trial or cluster ids of a session, from the most requested."""
+        return [idx for idx, _ in self.items[pid, num].most_common()] if (pid, num) in self.items else []
+
+    def item_hits(self, pid, num, idxs):
+        counts = self.items.get((pid, num), {})
+        return sum(counts.get(idx, 0) for idx in idxs)
+
+    def top(self, n):
+        """Return the `n` most requested artifacts as {pid: {figure number: ids}}, where ids is
+        the list of trial or cluster ids of the figures 3 and 5, and None for the other figures."""
+        hits = [((pid, num, None), count) for (pid, num), count in self.figures.items()
+                if num in FIGURES and num not in FIGURE_ITEMS]
+        hits += [((pid, num, idx), count) for (pid, num), counts in self.items.items()
+                 for idx, count in counts.items()]
+        out = {}
+        for (pid, num, idx), _ in sorted(hits, key=itemgetter(1), reverse=True)[:n]:
+            figs = out.setdefault(pid, {})
+            if idx is None:
+                figs[num] = None
+            else:
+                figs.setdefault(num, []).append(idx)
+        return out
+
+
+# -------------------------------------------------------------------------------------------------
+# Scheduler
+# -------------------------------------------------------------------------------------------------
+
+class Task(Bunch):
+    """Unit of work of the scheduler: one figure of a session, or a chunk of its trial or cluster figures
+    (`idxs`, or positions `start:stop` in the sorted ids minus `exclude`)."""
+
+    def resolve(self, generator):
+        if self.fig not in FIGURE_ITEMS:
+            return None
+        items = generator.trial_idxs if self.fig == 3 else generator.cluster_idxs
+        if self.get('idxs', None) is not None:
+            # The ids may come from the access logs, with trials or clusters that no longer exist.
+            items = set(items)
+            return [idx for idx in self.idxs if idx in items]
+        # Ids sent to other tasks of the same figure.
+        exclude = set(self.get('exclude', ()))
+        return [idx for idx in sorted(items)[self.start:self.stop] if idx not in exclude]
+
+
+def session_size(pid, eid=None):
+    """Estimate the number of spikes, trials and good clusters of a session from the shapes of
+    its ALF arrays, without loading them."""
+    def _count(path):
+        try:
+            return np.load(path, mmap_mode='r').shape[0]
+        except (OSError, ValueError):
+            return 0
+
+    n_spikes = _count(DATA_DIR / pid / 'spikes.times.npy')
+    n_trials = _count(DATA_DIR / eid / 'trials.stimOn_times.npy') if eid else 0
+    try:
+        n_clusters = int(np.sum(np.load(DATA_DIR / pid / 'clusters.label.npy') == 1))
+    except (OSError, ValueError):
+        n_clusters = 0
+    return n_spikes, n_trials, n_clusters
+
+
+def session_memory(pid, eid=None):
+    """Estimate the memory needed by a worker to load a session, from the size of its files."""
+    size = 0
+    for name in (pid, eid):
+        if name and DATA_DIR.joinpath(name).is_dir():
+            size += sum(path.stat().st_size for path in DATA_DIR.joinpath(name).iterdir() if path.is_file())
+    return SESSION_MEMORY_FACTOR * size
+
+
+def stale_figures(stale):
+    """Map the stale artifacts {path: kind} of a session to {figure number: ids}, where ids is
+    the sorted list of the stale trial or cluster ids, or None for the whole figure."""
+    figs = {}
+    for path, kind in stale.items():
+        num = ARTIFACT_FIGURES[kind]
+        idxs = figs.setdefault(num, set())
+        match = re.match(r'(?:trial|cluster)-(\d+)\.', path.name)
+        idxs.add(int(match.group(1)) if match else None)
+    return {num: (sorted(idxs) if num in FIGURE_ITEMS and None not in idxs else None) for num, idxs in figs.items()}
+
+
+def _scheduler_worker(wid, inbox, outbox, nums, preview=False):
+    """Worker process: run the tasks sent by the scheduler, keeping the last session loaded."""
+    generator = None
+    while True:
+        task = inbox.get()
+        if task is None:
+            return
         try:
-            self.make_behavior_plot(force=2 in nums)
+            if generator is None or generator.pid != task.pid:
+                generator = None  # release the previous session before loading the next one
+                # Only the first worker loading the session in the run saves its details.
+                generator = Generator(task.pid, save_details=task.get('details', True), preview=preview)
+            generator.make_figure(
+                task.fig, force=task.fig in nums, idxs=task.resolve(generator), progress=False)
+            flush_trace()
+            outbox.put((wid, task, None))
         except Exception as e:
-            print(f"error with session {self.pid} behavior plot: {str(e)}")
+            outbox.put((wid, task, f"{type(e).__name__}: {str(e)}"))
+
+
+class Scheduler:
+    """Generate the figures of many sessions as (session, figure, chunk) tasks in a pool of worker processes,
+    which finish their loaded session before taking the most expensive one that fits in memory."""
+
+    def __init__(self, pids, nums=(), n_jobs=None, chunk_size=CHUNK_SIZE, leases=None, priority=None, top=None,
+                 preview=False):
+        self.pids = list(pids)
+        self.nums = tuple(nums)
+        self.preview = preview
+        self.n_jobs = n_jobs or N_JOBS
+        self.chunk_size = chunk_size
+        self.leases = leases
+        self.priority = priority or AccessPriority()
+        self.hot = self.priority.top(top) if top else None  # pid: {figure number: ids}
+        self.eids = {}  # pid: eid
+        self.tasks = {}  # pid: list of tasks sorted by decreasing cost
+        self.pending = {}  # pid: number of tasks being run
+        self.resident = {}  # worker id: pid of the session loaded in the worker
+        self.memory = {}  # pid: estimated memory of the session
+        self.loading = {}  # worker id: pid of the session being loaded, until its first task is done
+        self.waiting = set()  # workers waiting for memory
+        self.failed = set()  # sessions with a task that failed after its retries
+        self.opened = set()  # sessions whose details have been saved by a worker in this run
+
+    # Tasks
+    # ---------------------------------------------------------------------------------------------
+
+    def session_tasks(self, pid, eid):
+        if 0 in self.nums:
+            figs = {0: None}
+        elif self.nums:
+            figs = {num: None for num in FIGURES}
+        else:
+            stale = stale_artifacts(pid)
+            if stale and self.preview:
+                stale = {path: kind for path, kind in stale.items()
+                         if not path.exists() and not preview_path(path).exists()}
+            figs = {num: None for num in FIGURES} if stale is None else stale_figures(stale)
+        if self.hot is not None:
+            figs = self.hot_figures(pid, figs)
+        if not figs:
+            return []
+
+        n_spikes, n_trials, n_clusters = session_size(pid, eid)
+        n_items = {3: n_trials, 5: n_clusters}
+        tasks = []
+        for num, idxs in sorted(figs.items()):
+            hot = self.priority.hot_items(pid, num)
+            if num not in FIGURE_ITEMS:
+                tasks.append(Task(pid=pid, fig=num, weight=FIGURE_COSTS[num], hits=self.priority.figures[pid, num]))
+                continue
+            if idxs is not None:
+                # Most requested trials or clusters first.
+                rank = {idx: i for i, idx in enumerate(hot)}
+                idxs = sorted(idxs, key=lambda idx: rank.get(idx, len(rank)))
+            elif hot:
+                # Explicit chunks of the requested trials or clusters, excluded from the ranges.
+                for i in range(0, len(hot), self.chunk_size):
+                    chunk = hot[i:i + self.chunk_size]
+                    tasks.append(Task(pid=pid, fig=num, idxs=chunk, weight=FIGURE_COSTS[num] * len(chunk)))
+            if idxs is not None:
+                for i in range(0, len(idxs), self.chunk_size):
+                    chunk = idxs[i:i + self.chunk_size]
+                    tasks.append(Task(pid=pid, fig=num, idxs=chunk, weight=FIGURE_COSTS[num] * len(chunk)))
+            else:
+                n = max(1, n_items[num])
+                for start in range(0, n, self.chunk_size):
+                    # The last chunk covers all remaining items in case the estimate was too low.
+                    stop = start + self.chunk_size if start + self.chunk_size < n else None
+                    size = min(self.chunk_size, n - start)
+                    tasks.append(Task(
+                        pid=pid, fig=num, start=start, stop=stop, exclude=hot, weight=FIGURE_COSTS[num] * size))
+
+        # Distribute the session cost among its tasks.
+        cost = max(1, n_spikes) * max(1, n_clusters)
+        total = sum(task.weight for task in tasks)
+        for task in tasks:
+            task.cost = cost * task.weight / total
+            if 'hits' not in task:
+                task.hits = self.priority.item_hits(pid, task.fig, task.get('idxs', None) or ())
+        return sorted(tasks, key=itemgetter('hits', 'cost'), reverse=True)
+
+    def hot_figures(self, pid, figs):
+        """Restrict the figures {figure number: ids} to be generated to the most requested ones."""
+        out = {}
+        for num, hot in self.hot.get(pid, {}).items():
+            if num not in figs:
+                continue
+            if hot is None:
+                out[num] = figs[num]
+            else:
+                out[num] = hot if figs[num] is None else [idx for idx in hot if idx in figs[num]]
+        return {num: idxs for num, idxs in out.items() if idxs is None or idxs}
+
+    def make_tasks(self):
+        df = session_table()
+        for pid in self.pids:
+            eid = df.loc[pid, 'eid'] if pid in df.index else None
+            # Sessions already generated by another node in this distributed run.
+            if self.leases is not None and self.nums and self.leases.is_done(pid):
+                continue
+            tasks = self.session_tasks(pid, eid)
+            if tasks:
+                self.eids[pid] = eid
+                self.tasks[pid] = tasks
+                self.memory[pid] = session_memory(pid, eid)
+            else:
+                logger.debug(f"Skipping session {pid} as all its artifacts are up to date")
+        return sum(len(tasks) for tasks in self.tasks.values())
+
+    def remaining_cost(self, pid):
+        return sum(task.cost for task in self.tasks[pid])
+
+    def rank(self, pid):
+        return self.priority.sessions[pid], self.remaining_cost(pid)
+
+    def claim(self, pid):
+        """Claim the lease of a session in distributed mode. The remaining tasks of the session
+        are listed again, as another node may have generated it in the meantime."""
+        if self.leases is None or pid in self.leases.held:
+            return True
+        if not self.leases.acquire(pid):
+            return False
+        done = self.nums and self.leases.is_done(pid)
+        self.tasks[pid] = [] if done else self.session_tasks(pid, self.eids[pid])
+        if not self.tasks[pid]:
+            self.leases.release(pid)
+            return False
+        return True
+
+    def retry(self, task, reason):
+        """Put a failed task back in front of the tasks of its session, or record the failure of
+        the session once the task has no retries left. Return whether the task was put back."""
+        logger.error(f"{reason} on session {task.pid} figure {task.fig}")
+        if task.get('retries', 0) < TASK_RETRIES:
+            # Item assignment: the attributes of the tasks received from the workers are not items.
+            task['retries'] = task.get('retries', 0) + 1
+            self.tasks[task.pid].insert(0, task)
+            return True
+        self.failed.add(task.pid)
+        return False
 
-        # Figure 3 (one plot per trial)
-        self.make_all_trial_plots(force=3 in nums)
+    def finish(self, task):
+        """Record the end of a task, and release the lease of the session when it is done. A
+        session with failed tasks is not recorded as done in the run."""
+        self.pending[task.pid] -= 1
+        if self.leases is not None and not self.tasks[task.pid] and not self.pending[task.pid]:
+            self.leases.release(task.pid, done=bool(self.nums) and task.pid not in self.failed)
+
+    def fits(self, wid, pid):
+        """Whether a worker can load a session in the available memory. The sessions being loaded
+        by the other workers are not fully accounted for by the system yet, and the session
+        currently loaded by the worker is released first."""
+        available = psutil.virtual_memory().available - MEMORY_RESERVE
+        available -= sum(self.memory[p] for w, p in self.loading.items() if w != wid)
+        available += self.memory.get(self.resident.get(wid, None), 0)
+        return self.memory[pid] <= available
+
+    def drop_lost(self):
+        """Stop the work on the sessions whose lease was taken over by another node."""
+        if self.leases is None:
+            return
+        for pid in self.leases.pop_lost():
+            if self.tasks.get(pid, None):
+                logger.warning(f"Dropping the {len(self.tasks[pid])} remaining tasks of session {pid}")
+                self.tasks[pid] = []
+
+    def next_task(self, wid):
+        """Return the next task of a worker, or None when all tasks have been dispatched or when
+        the worker has to wait for memory."""
+        self.drop_lost()
+        pids = [pid for pid, tasks in self.tasks.items() if tasks]
+        if not pids:
+            return None
+
+        # Continue with the session already loaded in the worker.
+        pid = self.resident.get(wid, None)
+        if pid not in pids:
+            # Otherwise take another probe of the session (eid) of the previous session, whose data
+            # is still in the eid cache of the worker, then the most requested, then most expensive
+            # session that no worker has loaded, or steal from the session with the largest
+            # remaining cost, among the sessions fitting in memory.
+            # A session loaded for the first time is left to its worker, which saves the session
+            # details, until one of its tasks is done.
+            opening = {p for w, p in self.resident.items() if w != wid and p not in self.opened}
+            pids = [pid for pid in pids if pid not in opening]
+            busy = set(self.resident.values())
+            free = [pid for pid in pids if pid not in busy]
+            eid = self.eids.get(self.resident.get(wid, None), None)
+            siblings = [pid for pid in free if eid is not None and self.eids.get(pid, None) == eid]
+            others = sorted(set(free) - set(siblings), key=self.rank, reverse=True)
+            taken = sorted(set(pids) - set(free), key=self.rank, reverse=True)
+            candidates = sorted(siblings, key=self.rank, reverse=True) + others + taken
+            pid = next((pid for pid in candidates if self.tasks[pid] and self.fits(wid, pid) and self.claim(pid)), None)
+            if pid is None:
+                if any(task is not None for w, task in self.running.items() if w != wid):
+                    return None
+                # No other worker will release memory.
+                pid = next((pid for pid in candidates if self.tasks[pid] and self.claim(pid)), None)
+                if pid is None:
+                    return None
+                logger.warning(f"loading session {pid} in worker {wid} although it may not fit in memory")
+            self.loading[wid] = pid
+        task = self.tasks[pid].pop(0)
+        task['details'] = pid not in self.opened
+        self.resident[wid] = pid
+        self.pending[pid] = self.pending.get(pid, 0) + 1
+        return task
+
+    # Workers
+    # ---------------------------------------------------------------------------------------------
+
+    def start_worker(self, wid):
+        inbox = self.ctx.Queue()
+        proc = self.ctx.Process(
+            target=_scheduler_worker, args=(wid, inbox, self.outbox, self.nums, self.preview), daemon=True)
+        proc.start()
+        self.workers[wid] = (proc, inbox)
+
+    def dispatch(self, wid):
+        task = self.next_task(wid)
+        self.running[wid] = task
+        if task is None and any(self.tasks.values()):
+            if wid not in self.waiting:
+                logger.debug(f"worker {wid} waits for memory to load a new session")
+            self.waiting.add(wid)
+        else:
+            self.waiting.discard(wid)
+            self.workers[wid][1].put(task)
+        return task
+
+    def dispatch_waiting(self):
+        for wid in sorted(self.waiting):
+            self.dispatch(wid)
+
+    def run(self):
+        n_tasks = self.make_tasks()
+        if not n_tasks:
+            return
+        logger.info(f"Scheduling {n_tasks} tasks from {len(self.tasks)} sessions on {self.n_jobs} workers")
+        if self.leases is not None:
+            self.leases.start()
+            try:
+                self._run(n_tasks)
+            finally:
+                self.leases.close()
+        else:
+            self._run(n_tasks)
+
+    def _run(self, n_tasks):
+
+        self.ctx = mp.get_context()
+        self.outbox = self.ctx.Queue()
+        self.workers = {}
+        self.running = {}  # worker id: task being run, None if the worker waits or was told to stop
+        for wid in range(self.n_jobs):
+            self.start_worker(wid)
+            self.dispatch(wid)
+
+        with tqdm(total=n_tasks, desc="Generating") as pbar:
+            while self.waiting or any(task is not None for task in self.running.values()):
+                try:
+                    wid, task, error = self.outbox.get(timeout=5)
+                except queue.Empty:
+                    self.check_workers(pbar)
+                    self.dispatch_waiting()
+                    continue
+                retried = error is not None and self.retry(task, f"error {error}")
+                if error is None:
+                    self.opened.add(task.pid)
+                self.loading.pop(wid, None)
+                self.finish(task)
+                pbar.update(0 if retried else 1)
+                self.dispatch(wid)
+                self.dispatch_waiting()
+
+        for proc, _ in self.workers.values():
+            proc.join()
+        if self.failed:
+            logger.warning(f"{len(self.failed)} sessions have failed tasks: {', '.join(sorted(self.failed))}")
+
+    def check_workers(self, pbar):
+        """Restart the workers that died (for example killed by the OOM killer)."""
+        for wid, (proc, _) in list(self.workers.items()):
+            task = self.running.get(wid, None)
+            if proc.is_alive() or task is None:
+                continue
+            retried = self.retry(task, f"worker {wid} died (exit code {proc.exitcode})")
+            pbar.update(0 if retried else 1)
+            self.resident.pop(wid, None)
+            self.loading.pop(wid, None)
+            self.finish(task)
+            self.start_worker(wid)
+            self.dispatch(wid)
 
-        # Figure 4
-        self.make_trial_event_plot(force=4 in nums)
 
-        # Figure 5 (one plot per cluster)
-        self.make_all_cluster_plots(force=5 in nums)
+# -------------------------------------------------------------------------------------------------
+# Watch mode
+# -------------------------------------------------------------------------------------------------
 
+def _signature(path):
+    """Names, sizes and modification times of a file or of the files of a folder."""
+    paths = sorted(path.iterdir()) if path.is_dir() else [path]
+    out = []
+    for p in paths:
+        try:
+            stat = p.stat()
+        except FileNotFoundError:
+            continue
+        out.append((p.name, stat.st_size, stat.st_mtime_ns))
+    return tuple(out)
+
+
+class Watcher:
+    """Generate the sessions added to or modified in the data folder once their files have not changed for
+    `WATCH_SETTLE` seconds, watched with inotify if available and polled otherwise."""
+
+    def __init__(self, interval=WATCH_INTERVAL, settle=WATCH_SETTLE):
+        self.interval = interval
+        self.settle = settle
+        self.signatures = {}  # name of a folder or table in the data folder: signature
+        self.changed = {}  # name: time of the last change, until the files are stable
+        self.rows, self.eids = self.table()
+        self.features = self.features_digests()
+        self.inotify = None
+        self.watches = {}  # inotify watch descriptor: name ('' for the data folder)
+        if INotify is not None:
+            self.inotify = INotify()
+            self.watch('')
+
+    def table(self):
+        """Rows of the session table (as JSON strings) and eids, as {pid: row} and {pid: eid}."""
+        df = session_table()
+        df = df[[is_valid_uuid(pid) for pid in df.index]]
+        return {pid: row.to_json() for pid, row in df.iterrows()}, df['eid'].to_dict()
+
+    def features_digests(self):
+        """Hash of the rows of each session in the raw ephys features table, as {pid: hash}."""
+        if not DATA_DIR.joinpath('raw_ephys_features.pqt').exists():
+            return {}
+        return {pid: features_digest(pid) for pid in self.eids}
+
+    def watch(self, name):
+        moves = inotify_flags.MOVED_TO | inotify_flags.MOVED_FROM
+        mask = inotify_flags.CREATE | inotify_flags.CLOSE_WRITE | moves | inotify_flags.DELETE
+        self.watches[self.inotify.add_watch(DATA_DIR / name, mask)] = name
+        if not name:
+            for path in DATA_DIR.iterdir():
+                if path.is_dir():
+                    self.watch(path.name)
+
+    def wait(self):
+        """Wait for changes and return the names of the modified folders and tables, or None
+        when polling."""
+        if self.inotify is None:
+            time.sleep(self.interval)
+            return None
+        names = set()
+        for event in self.inotify.read(timeout=int(1000 * self.interval)):
+            name = self.watches.get(event.wd, None)
+            if name is None:
+                continue
+            if name:
+                names.add(name)
+            elif event.name:
+                names.add(event.name)
+                if event.mask & inotify_flags.ISDIR and event.mask & (inotify_flags.CREATE | inotify_flags.MOVED_TO):
+                    self.watch(event.name)
+        return names
+
+    def scan(self, names=None):
+        """Record the folders and tables whose files changed."""
+        if names is None:
+            names = [path.name for path in DATA_DIR.iterdir()]
+        now = time.time()
+        for name in names:
+            signature = _signature(DATA_DIR / name) if DATA_DIR.joinpath(name).exists() else ()
+            if signature != self.signatures.get(name, None):
+                self.signatures[name] = signature
+                self.changed[name] = now
+
+    def stable(self):
+        """Return the changed folders and tables whose files have not changed for a while."""
+        now = time.time()
+        names = {name for name, t in self.changed.items() if now - t >= self.settle}
+        for name in names:
+            del self.changed[name]
+        return names
+
+    def affected(self, names):
+        """Return the sessions affected by changes in some folders and tables."""
+        pids = set()
+        if 'session.table.pqt' in names:
+            rows, self.eids = self.table()
+            pids |= {pid for pid, row in rows.items() if self.rows.get(pid, None) != row}
+            self.rows = rows
+        if 'raw_ephys_features.pqt' in names:
+            features = self.features_digests()
+            pids |= {pid for pid, digest in features.items() if self.features.get(pid, None) != digest}
+            self.features = features
+        pids |= {pid for pid, eid in self.eids.items() if pid in names or eid in names}
+        return sorted(pids)
+
+    def run(self):
+        logger.info(f"Watching {DATA_DIR} for new or modified sessions")
+        self.scan()
+        self.changed.clear()
+        Scheduler(self.rows).run()
+        write_catalogue()
+        while True:
+            self.scan(self.wait())
+            pids = self.affected(self.stable())
+            if pids:
+                logger.info(f"Generating {len(pids)} new or modified sessions")
+                Scheduler(pids).run()
+                write_catalogue()
 
-def make_all_plots(pid, nums=()):
-    logger.info(f"Generating all plots for session {pid}")
-    Generator(pid).make_all_plots(nums=nums)
 
+# -------------------------------------------------------------------------------------------------
+# Leases
+# -------------------------------------------------------------------------------------------------
 
-if __name__ == '__main__':
+class Leases:
+    """Lease files claiming the sessions of a distributed run (`<pid>.lease`, reclaimed after `LEASE_TIMEOUT`),
+    and markers of the sessions done in the run (`<run>/<pid>.done`)."""
 
-    # Regenerate all figures.
-    if len(sys.argv) == 1:
-        Parallel(n_jobs=-3)(delayed(make_all_plots)(pid) for pid in iter_session())
+    def __init__(self, path=LEASE_DIR, node=None, run=None):
+        self.path = Path(path)
+        self.node = node or f'{socket.gethostname()}-{os.getpid()}'
+        self.run = run
+        self.held = set()
+        self.lost = set()  # sessions whose lease was taken over by another node
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
 
-    # Regenerate some figures for all sessions.
-    elif len(sys.argv) == 2 and not is_valid_uuid(sys.argv[1]):
-        which = sys.argv[1]
+    def _file(self, pid, ext='lease'):
+        return self.path / f'{pid}.{ext}'
 
-        # which figure numbers to regenerate
-        nums = list(map(int, which.split(',')))
-        logger.info(f"Regenerating figures {', '.join('#%d' % _ for _ in nums)}")
+    def _expired(self, path):
+        try:
+            return time.time() - path.stat().st_mtime > LEASE_TIMEOUT
+        except FileNotFoundError:
+            return True
+
+    def _owner(self, pid):
+        try:
+            return json.loads(self._file(pid).read_text())['node']
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def _lose(self, pid):
+        logger.warning(f"Node {self.node} lost the lease of session {pid}")
+        with self._lock:
+            self.held.discard(pid)
+            self.lost.add(pid)
+
+    def pop_lost(self):
+        """Return the sessions whose lease was lost since the last call."""
+        with self._lock:
+            lost, self.lost = self.lost, set()
+        return lost
+
+    def acquire(self, pid):
+        path = self._file(pid)
+        self.path.mkdir(parents=True, exist_ok=True)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return self._expired(path) and self._reclaim(path) and self.acquire(pid)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'node': self.node, 'date': datetime.now().isoformat()}, f)
+        with self._lock:
+            self.held.add(pid)
+        logger.debug(f"Node {self.node} claimed session {pid}")
+        return True
+
+    def _reclaim(self, path):
+        """Remove an expired lease: only one node succeeds in moving it away, and a lease that
+        was renewed in the meantime is put back."""
+        tmp = path.with_name(f'{path.name}.{self.node}')
+        try:
+            os.rename(path, tmp)
+        except FileNotFoundError:
+            return True
+        if not self._expired(tmp):
+            try:
+                os.link(tmp, path)
+            except FileExistsError:
+                pass
+            os.remove(tmp)
+            return False
+        logger.warning(f"Reclaiming the expired lease {path.name}: {tmp.read_text()}")
+        os.remove(tmp)
+        return True
+
+    def _done_file(self, pid):
+        return self.path / self.run / f'{pid}.done'
+
+    def is_done(self, pid):
+        return self.run is not None and self._done_file(pid).exists()
+
+    def release(self, pid, done=False):
+        """Remove the lease of a session. A lease reclaimed by another node is left in place and
+        the session is not marked as done. Return whether the lease was still held."""
+        with self._lock:
+            if pid not in self.held:
+                return False
+        if self._owner(pid) != self.node:
+            self._lose(pid)
+            return False
+        with self._lock:
+            self.held.discard(pid)
+        if done and self.run is not None:
+            self._done_file(pid).parent.mkdir(parents=True, exist_ok=True)
+            self._done_file(pid).touch()
+        try:
+            os.remove(self._file(pid))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def renew(self):
+        """Renew the leases still owned by this node, and drop the others."""
+        with self._lock:
+            pids = list(self.held)
+        for pid in pids:
+            if self._owner(pid) != self.node:
+                self._lose(pid)
+                continue
+            try:
+                os.utime(self._file(pid))
+            except FileNotFoundError:
+                self._lose(pid)
 
-        Parallel(n_jobs=-3)(delayed(make_all_plots)(pid, nums=nums) for pid in iter_session())
+    def _heartbeat(self):
+        while not self._stop.wait(LEASE_HEARTBEAT):
+            self.renew()
 
-    # Regenerate figures for 1 session.
-    elif len(sys.argv) == 2 and is_valid_uuid(sys.argv[1]):
-        make_all_plots(sys.argv[1])
+    def start(self):
+        self._stop.clear()
+        threading.Thread(target=self._heartbeat, daemon=True).start()
+
+    def close(self):
+        """Stop renewing the leases and release those still held."""
+        self._stop.set()
+        for pid in list(self.held):
+            self.release(pid)
+
+
+# -------------------------------------------------------------------------------------------------
+# Tracing
+# -------------------------------------------------------------------------------------------------
+
+class Tracer:
+    """Record the duration and peak memory of the generation steps as a Chrome trace, from one events file per
+    process merged by `finish()`."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.parts = self.path.with_name(self.path.name + '.parts')
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.process = psutil.Process()
+        self.events = [dict(name='process_name', ph='M', pid=self.pid, tid=0, args=dict(name=f'generator {self.pid}'))]
+        self.stacks = defaultdict(list)  # thread id: [peak RSS, session] of the open spans
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+
+    def rss(self):
+        return self.process.memory_info().rss
+
+    def _sample(self):
+        while not self._stop.wait(TRACE_INTERVAL):
+            rss = self.rss()
+            for stack in list(self.stacks.values()):
+                for span in list(stack):
+                    span[0] = max(span[0], rss)
+
+    @contextmanager
+    def span(self, name, cat, session=None, **args):
+        # The spans of the PNG encoder threads are nested in their own stack.
+        stack = self.stacks[threading.get_ident()]
+        if session is None and stack:
+            session = stack[-1][1]
+        span = [self.rss(), session]
+        stack.append(span)
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            t1 = time.time()
+            stack.pop()
+            peak = max(span[0], self.rss())
+            if stack:
+                stack[-1][0] = max(stack[-1][0], peak)
+            self.events.append(dict(
+                name=name, cat=cat, ph='X', ts=t0 * 1e6, dur=(t1 - t0) * 1e6, pid=self.pid,
+                tid=threading.get_native_id(), args=dict(session=session, rss_peak=round(peak / 2 ** 20, 1), **args)))
+
+    def wrap(self, func, cat):
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            # Session of the span: `pid` attribute of the DataLoader or Generator, or first string
+            # argument (pid or eid) of the loading functions.
+            session = getattr(args[0], 'pid', None) if args else None
+            if session is None:
+                session = next((arg for arg in args if isinstance(arg, str)), None)
+            with self.span(func.__name__, cat, session=session):
+                return func(*args, **kwargs)
+        return wrapped
+
+    def install(self):
+        """Replace the traced functions and methods by wrappers recording their spans."""
+        module = sys.modules[DataLoader.__module__]
+        targets = (
+            (module, TRACE_FUNCTIONS, 'load'),
+            (DataLoader, TRACE_METHODS, 'dataloader'),
+            (Generator, '|'.join(ARTIFACT_CODE.values()), 'generator'),
+        )
+        for owner, pattern, cat in targets:
+            for name, func in list(vars(owner).items()):
+                # Skip the functions imported in plots.static_plots.
+                if owner is module and getattr(func, '__module__', None) != module.__name__:
+                    continue
+                if inspect.isfunction(func) and re.fullmatch(pattern, name):
+                    setattr(owner, name, self.wrap(func, cat))
+        mpl.figure.Figure.savefig = self.wrap(mpl.figure.Figure.savefig, 'savefig')
+
+    def flush(self):
+        """Append the events recorded so far to the file of this process."""
+        if not self.events:
+            return
+        self.parts.mkdir(parents=True, exist_ok=True)
+        with open(self.parts / f'{self.pid}.jsonl', 'a') as f:
+            for event in self.events:
+                f.write(json.dumps(event) + '\n')
+        self.events = []
+
+    def finish(self):
+        """Merge the events of all processes into the trace file and return the summary."""
+        self._stop.set()
+        self._sampler.join()
+        self.flush()
+        events = []
+        for path in sorted(self.parts.glob('*.jsonl')):
+            with open(path, 'r') as f:
+                events.extend(json.loads(line) for line in f)
+        shutil.rmtree(self.parts, ignore_errors=True)
+        summary = trace_summary(events)
+        save_json(self.path, {'traceEvents': events, 'displayTimeUnit': 'ms', 'otherData': summary})
+        logger.info(f"Saved {len(events)} trace events to {self.path}")
+        return summary
+
+
+_tracer = None
+
+
+def start_trace(path):
+    """Trace the generation in this process and in the worker processes started afterwards."""
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer(path)
+        if TRACE_ENV not in os.environ:  # remove the events of a previous run
+            shutil.rmtree(_tracer.parts, ignore_errors=True)
+        _tracer.install()
+        os.environ[TRACE_ENV] = str(_tracer.path)
+    return _tracer
+
+
+def flush_trace():
+    if _tracer is not None:
+        _tracer.flush()
+
+
+def trace_span(name, cat, **kwargs):
+    return _tracer.span(name, cat, **kwargs) if _tracer is not None else nullcontext()
+
+
+def trace_summary(events):
+    """Count, total time (s) and peak RSS (MB) of the spans of each kind of artifact, of each
+    session (loading and artifacts), and of each traced function."""
+    kinds = {method: kind for kind, method in ARTIFACT_CODE.items()}
+    summary = {'artifacts': {}, 'sessions': {}, 'functions': {}}
+
+    def add(table, key, event):
+        row = table.setdefault(key, {'count': 0, 'time': 0., 'peak_rss': 0.})
+        row['count'] += 1
+        row['time'] += event['dur'] / 1e6
+        row['peak_rss'] = max(row['peak_rss'], event['args']['rss_peak'])
+
+    for event in events:
+        if event['ph'] != 'X':
+            continue
+        kind = kinds.get(event['name'], None)
+        session = event['args']['session']
+        if kind:
+            add(summary['artifacts'], kind, event)
+        if session and (kind or event['name'] in ('session_init', 'encode_png')):
+            add(summary['sessions'], session, event)
+        add(summary['functions'], event['name'], event)
+    return summary
+
+
+def print_trace_summary(summary, n_functions=20):
+    for title, table, n in (('artifact', summary['artifacts'], None), ('session', summary['sessions'], None),
+                            ('function', summary['functions'], n_functions)):
+        rows = sorted(table.items(), key=lambda item: item[1]['time'], reverse=True)[:n]
+        header = f"{title:<48s} {'n':>7s} {'total (s)':>10s} {'mean (ms)':>10s} {'peak RSS (MB)':>14s}"
+        print('\n' + header)
+        print('-' * len(header))
+        for key, row in rows:
+            print(f"{key:<48s} {row['count']:>7d} {row['time']:>10.1f} "
+                  f"{1000 * row['time'] / row['count']:>10.1f} {row['peak_rss']:>14.0f}")
+
+
+# Worker processes started with spawn or forkserver import this module again.
+if os.environ.get(TRACE_ENV, None):
+    start_trace(os.environ[TRACE_ENV])
+if os.environ.get(PNG_ENV, None):
+    _level, _optimize = os.environ[PNG_ENV].split(',')
+    set_png_options(int(_level) if _level else None, bool(int(_optimize)))
+
+
+# -------------------------------------------------------------------------------------------------
+# Entry point
+# -------------------------------------------------------------------------------------------------
+
+def figures_arg(value):
+    """Parse a comma-separated list of figure numbers, such as `1,3` (0 is the session details)."""
+    try:
+        nums = [int(num) for num in value.split(',')]
+    except ValueError:
+        nums = None
+    if not nums or any(num not in (0,) + FIGURES for num in nums):
+        raise argparse.ArgumentTypeError(f"invalid figure numbers `{value}`")
+    return nums
+
+
+def pid_arg(value):
+    if not is_valid_uuid(value):
+        raise argparse.ArgumentTypeError(f"invalid session id `{value}`")
+    return value
+
+
+def size_arg(value):
+    try:
+        return parse_size(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def parse_args(argv=None):
+    # Options of all the commands, accepted before or after the command.
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--trace', metavar='PATH', default=argparse.SUPPRESS,
+                        help='save a trace of the generation, and print the time and memory used')
+    common.add_argument('--png-level', type=int, choices=range(10), default=argparse.SUPPRESS,
+                        help='zlib compression level of the figures')
+    common.add_argument('--png-optimize', action='store_true', default=argparse.SUPPRESS,
+                        help='shrink the figures with an optimization pass')
+    common.add_argument('--priority', metavar='LOGS', default=argparse.SUPPRESS,
+                        help='generate the most requested artifacts first (comma-separated access logs)')
+    common.add_argument('--top', type=int, metavar='N', default=argparse.SUPPRESS,
+                        help='only generate the N most requested artifacts')
+    values = ('--trace', '--png-level', '--priority', '--top')
+
+    parser = argparse.ArgumentParser(
+        description='Generate the figures of the stale artifacts of all sessions.', parents=[common])
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.add_parser('fits', parents=[common], help='compute the behaviour fits of all sessions')
+    commands.add_parser('compute', parents=[common], help='compute the data products of all sessions')
+    render = commands.add_parser(
+        'render', parents=[common], help='render the figures of the sessions with data products')
+    render.add_argument('figures', nargs='?', type=figures_arg, default=(), help='figures to force, e.g. 1,3')
+    commands.add_parser(
+        'progressive', parents=[common], help='save previews of the missing figures, then the full figures')
+    commands.add_parser('watch', parents=[common], help='generate the sessions as they arrive in the data folder')
+    distributed = commands.add_parser(
+        'distributed', parents=[common], help='generate the sessions on several nodes sharing the cache')
+    distributed.add_argument('figures', nargs='?', type=figures_arg, default=(), help='figures to force, e.g. 1,3')
+    distributed.add_argument('--run', help='id of the run forcing the figures, the figures and the date by default')
+    gc = commands.add_parser('gc', parents=[common], help='remove the garbage of the cache folder')
+    gc.add_argument('budget', nargs='?', type=size_arg, default=CACHE_BUDGET,
+                    help='evict the sessions removed from the session table down to this size, e.g. 20G')
+    gc.add_argument('--dry-run', action='store_true', help='print what would be reclaimed')
+    force = commands.add_parser(
+        'force', parents=[common], help='force some figures of all sessions (`1,3` is a shortcut)')
+    force.add_argument('figures', type=figures_arg, help='figures to force, e.g. 1,3')
+    session = commands.add_parser(
+        'session', parents=[common], help='generate the stale figures of one session (`<pid>` is a shortcut)')
+    session.add_argument('pid', type=pid_arg)
+
+    # `python generator.py 1,3` and `python generator.py <pid>` are shortcuts of the force and
+    # session commands.
+    argv = list(sys.argv[1:] if argv is None else argv)
+    i = 0
+    while i < len(argv) and argv[i].startswith('-'):
+        i += 2 if argv[i] in values else 1
+    if i < len(argv) and argv[i] not in commands.choices:
+        if is_valid_uuid(argv[i]):
+            argv.insert(i, 'session')
+        elif re.fullmatch(r'[\d,]+', argv[i]):
+            argv.insert(i, 'force')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    if 'trace' in args:
+        start_trace(args.trace)
+    if 'png_level' in args or 'png_optimize' in args:
+        set_png_options(getattr(args, 'png_level', PNG_COMPRESS_LEVEL), getattr(args, 'png_optimize', PNG_OPTIMIZE))
+    priority = AccessPriority(args.priority.split(',')) if 'priority' in args else None
+    top = getattr(args, 'top', None)
+
+    # Regenerate the stale figures of all sessions, after fitting the behaviour of all sessions in
+    # parallel.
+    if args.command is None:
+        fit_all_sessions()
+        Scheduler(iter_session(), priority=priority, top=top).run()
+
+    # Batch stage only: compute the behaviour fits of all sessions.
+    elif args.command == 'fits':
+        fit_all_sessions()
+
+    # Compute stage only: save the data products of all sessions.
+    elif args.command == 'compute':
+        for pid in iter_session():
+            compute_products(pid)
+
+    # Render stage only: render the stale figures (or force some figures) of the sessions with
+    # data products, which does not need the ALF files.
+    elif args.command == 'render':
+        for pid in iter_products():
+            make_all_plots(pid, nums=args.figures, render_only=True)
+
+    # Progressive generation: low-resolution previews of the missing figures of all sessions first,
+    # then the full-quality figures.
+    elif args.command == 'progressive':
+        Scheduler(iter_session(), priority=priority, top=top, preview=True).run()
+        write_catalogue()
+        Scheduler(iter_session(), priority=priority, top=top).run()
+
+    # Watch mode: generate the sessions added to the data folder or modified as they arrive.
+    elif args.command == 'watch':
+        Watcher().run()
+
+    # Distributed generation: run the same command on several nodes sharing the data and cache
+    # folders. The nodes forcing the same figures on the same day join the same run, unless another
+    # run id is given with `--run ID`.
+    elif args.command == 'distributed':
+        run = args.run or f"{','.join(map(str, args.figures)) or 'stale'}-{date.today()}"
+        Scheduler(iter_session(), nums=args.figures, leases=Leases(run=run), priority=priority, top=top).run()
+
+    # Cache maintenance: remove the garbage of the cache folder, and evict the sessions removed
+    # from the session table while the cache is larger than the budget, e.g. `gc 20G`.
+    elif args.command == 'gc':
+        collect_garbage(budget=args.budget, dry_run=args.dry_run)
+
+    # Force the regeneration of some figures for all sessions.
+    elif args.command == 'force':
+        logger.info(f"Regenerating figures {', '.join('#%d' % _ for _ in args.figures)}")
+        Scheduler(iter_session(), nums=args.figures, priority=priority, top=top).run()
+
+    # Regenerate the stale figures of 1 session, using all cores for the trial and cluster plots.
+    elif args.command == 'session':
+        make_all_plots(args.pid, n_jobs=N_JOBS)
+
+    if args.command not in ('compute', 'gc', 'fits'):
+        write_catalogue()
+
+    if _tracer is not None:
+        print_trace_summary(_tracer.finish())
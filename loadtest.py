@@ -0,0 +1,275 @@
+# -------------------------------------------------------------------------------------------------
+# Imports
+# -------------------------------------------------------------------------------------------------
+
+import argparse
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen
+
+from flaskapp import *
+
+
+# -------------------------------------------------------------------------------------------------
+# CONSTANTS
+# -------------------------------------------------------------------------------------------------
+
+N_USERS = 8
+N_WALKS = 4  # number of session walks per synthetic user
+N_TRIALS_PER_WALK = 10
+N_CLUSTERS_PER_WALK = 10
+PERCENTILES = (50, 95, 99)
+TOLERANCE = .1  # relative latency increase flagged as a regression when comparing runs
+
+
+# -------------------------------------------------------------------------------------------------
+# Clients
+# -------------------------------------------------------------------------------------------------
+
+class LocalClient:
+    """Send requests to an in-process Flask application through its test client."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def get(self, url):
+        response = self.client.get(url)
+        data = response.get_data()
+        return response.status_code, data
+
+
+class RemoteClient:
+    """Send requests to a running server, for example `http://localhost:4321`."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def get(self, url):
+        try:
+            with urlopen(self.base_url + url) as response:
+                return response.status, response.read()
+        except HTTPError as e:
+            return e.code, b''
+        except URLError:
+            return 0, b''
+
+
+# -------------------------------------------------------------------------------------------------
+# Request sources
+# -------------------------------------------------------------------------------------------------
+
+def session_walk(client, pid, n_trials=N_TRIALS_PER_WALK, n_clusters=N_CLUSTERS_PER_WALK):
+    """Send the requests of a user browsing one session: some trials, and clusters of the dropdown and of the
+    scatter plot."""
+    status, data = client.get(f'/api/session/{pid}/details')
+    details = json.loads(data) if status == 200 and data else {}
+    status, data = client.get(f'/api/session/{pid}/arrays')
+    arrays = decode_arrays(data, details['_arrays']) if status == 200 and '_arrays' in details else {}
+    trial_ids = list(arrays.get('trial_ids', ())) or [0]
+    cluster_ids = list(arrays.get('cluster_ids', ())) or [0]
+
+    client.get(f'/api/session/{pid}/session_plot')
+    client.get(f'/api/session/{pid}/behaviour_plot')
+    client.get(f'/api/session/{pid}/trial_event_plot')
+
+    # The trial selector is usually browsed sequentially with the arrow buttons.
+    start = random.randrange(len(trial_ids))
+    for tid in trial_ids[start:start + n_trials]:
+        client.get(f'/api/session/{pid}/trial_plot/{tid}')
+        client.get(f'/api/session/{pid}/trial_details/{tid}')
+
+    cid = cluster_ids[0]
+    for _ in range(n_clusters):
+        if random.random() < .5:
+            cid = random.choice(cluster_ids)
+        else:
+            x, y = random.uniform(.02, .2), random.uniform(.3, .9)
+            status, data = client.get(f'/api/session/{pid}/cluster_plot_from_xy/{cid}/{x:.6f}_{y:.6f}')
+            if status == 200 and data:
+                cid = json.loads(data).get('cluster_idx', cid)
+        client.get(f'/api/session/{pid}/cluster_plot/{cid}')
+        client.get(f'/api/session/{pid}/cluster_details/{cid}')
+
+
+# -------------------------------------------------------------------------------------------------
+# Load test
+# -------------------------------------------------------------------------------------------------
+
+class LoadTest:
+    def __init__(self, app, base_url=None):
+        self.app = app
+        self.base_url = base_url
+        self.url_map = app.url_map.bind('localhost')
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.duration = 0
+
+    def make_client(self):
+        if self.base_url:
+            return RemoteClient(self.base_url)
+        return LocalClient(self.app)
+
+    def route(self, url):
+        """Return the Flask route matching a URL, used to aggregate the statistics."""
+        try:
+            rule, _ = self.url_map.match(url.split('?')[0], return_rule=True)
+            return rule.rule
+        except Exception:
+            return 'unknown'
+
+    def request(self, client, url):
+        t0 = time.perf_counter()
+        status, data = client.get(url)
+        dt = time.perf_counter() - t0
+        route = self.route(url)
+        with self._lock:
+            self.latencies[route].append(dt)
+            if status != 200:
+                self.errors[route] += 1
+        return status, data
+
+    def _run_users(self, target, n_users):
+        threads = [threading.Thread(target=target, args=(i,), daemon=True) for i in range(n_users)]
+        t0 = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.duration = time.perf_counter() - t0
+
+    def replay(self, urls, n_users=N_USERS):
+        """Replay a list of URLs with concurrent users pulling from a shared queue."""
+        urls = iter(urls)
+        lock = threading.Lock()
+
+        def user(i):
+            client = self.make_client()
+            while True:
+                with lock:
+                    url = next(urls, None)
+                if url is None:
+                    return
+                self.request(client, url)
+
+        self._run_users(user, n_users)
+
+    def synthesize(self, pids, n_users=N_USERS, n_walks=N_WALKS):
+        """Simulate concurrent users each browsing `n_walks` random sessions."""
+
+        def user(i):
+            client = _TimedClient(self, self.make_client())
+            for _ in range(n_walks):
+                session_walk(client, random.choice(pids))
+
+        self._run_users(user, n_users)
+
+    def report(self):
+        """Return the latency percentiles (in ms) and throughput of each route."""
+        out = {}
+        for route, latencies in sorted(self.latencies.items()):
+            latencies = np.array(latencies) * 1000
+            stats = {f'p{p}': float(np.percentile(latencies, p)) for p in PERCENTILES}
+            stats['mean'] = float(latencies.mean())
+            stats['count'] = int(latencies.size)
+            stats['errors'] = int(self.errors.get(route, 0))
+            stats['throughput'] = latencies.size / self.duration if self.duration else 0.
+            out[route] = stats
+        return out
+
+
+class _TimedClient:
+    """Client wrapper recording the latency of every request sent during a session walk."""
+
+    def __init__(self, load_test, client):
+        self.load_test = load_test
+        self.client = client
+
+    def get(self, url):
+        return self.load_test.request(self.client, url)
+
+
+# -------------------------------------------------------------------------------------------------
+# Reporting
+# -------------------------------------------------------------------------------------------------
+
+def print_report(report, duration):
+    header = f"{'route':<80s} {'n':>6s} {'err':>4s} {'p50':>8s} {'p95':>8s} {'p99':>8s} {'req/s':>8s}"
+    print(header)
+    print('-' * len(header))
+    for route, s in report.items():
+        print(f"{route:<80s} {s['count']:>6d} {s['errors']:>4d} "
+              f"{s['p50']:>8.1f} {s['p95']:>8.1f} {s['p99']:>8.1f} {s['throughput']:>8.1f}")
+    n = sum(s['count'] for s in report.values())
+    print(f"\n{n} requests in {duration:.1f} s ({n / (duration or 1):.1f} req/s), latencies in ms")
+
+
+def compare_reports(report, baseline, tolerance=TOLERANCE):
+    """Print the latency changes with respect to a baseline and return the regressed routes."""
+    regressions = []
+    print(f"\n{'route':<80s} {'p50':>16s} {'p95':>16s} {'p99':>16s}")
+    for route, s in report.items():
+        b = baseline.get(route, None)
+        if not b:
+            continue
+        cells = []
+        for p in PERCENTILES:
+            key = f'p{p}'
+            change = (s[key] - b[key]) / b[key] if b[key] else 0
+            cells.append(f'{b[key]:.1f}->{s[key]:.1f}'.rjust(12) + f' {change:+.0%}'.rjust(5))
+            if change > tolerance and key != 'p50':
+                regressions.append((route, key, change))
+        print(f"{route:<80s} {' '.join(cells)}")
+    return regressions
+
+
+# -------------------------------------------------------------------------------------------------
+# Entry point
+# -------------------------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test the Flask server.')
+    parser.add_argument('--url', help='base URL of a running server (in-process test client by default)')
+    parser.add_argument('--log', help='request log to replay instead of synthesizing session walks')
+    parser.add_argument('--pids', nargs='*', help='sessions used by the synthetic users')
+    parser.add_argument('--users', type=int, default=N_USERS, help='number of concurrent users')
+    parser.add_argument('--walks', type=int, default=N_WALKS, help='number of session walks per user')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic walks')
+    parser.add_argument('--save', help='save the report to this JSON file')
+    parser.add_argument('--baseline', help='compare the run with a report saved with --save')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='relative p95/p99 regression threshold')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    load_test = LoadTest(make_app(), base_url=args.url)
+
+    if args.log:
+        urls = load_request_log(args.log)
+        if not urls:
+            raise ValueError(f"no request found in {args.log}")
+        logger.info(f"Replaying {len(urls)} requests with {args.users} users")
+        load_test.replay(urls, n_users=args.users)
+    else:
+        pids = args.pids or [s['ID'] for s in sessions()] or [DEFAULT_PID]
+        logger.info(f"Simulating {args.users} users browsing {len(pids)} sessions")
+        load_test.synthesize(pids, n_users=args.users, n_walks=args.walks)
+
+    report = load_test.report()
+    print_report(report, load_test.duration)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare_reports(report, baseline, tolerance=args.tolerance)
+        for route, key, change in regressions:
+            logger.warning(f"{key} regression of {change:+.0%} on {route}")
+        if regressions:
+            raise SystemExit(1)
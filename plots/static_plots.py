@@ -2,14 +2,22 @@
 # Imports
 # -------------------------------------------------------------------------------------------------
 
+import functools
+import json
+import os
+import warnings
 import matplotlib.pyplot as plt
 from matplotlib.image import NonUniformImage
 from matplotlib.lines import Line2D
+from matplotlib.ticker import ScalarFormatter
 from pathlib import Path
 import numpy as np
 import pandas as pd
-import copy
+import pickle
+import shutil
+import zlib
 from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
 import seaborn as sns
 import yaml
 from scipy.stats import zscore
@@ -21,7 +29,9 @@ from brainbox.processing import bincount2D
 from brainbox.behavior.wheel import velocity
 from brainbox.ephys_plots import plot_brain_regions
 from brainbox.plot_base import arrange_channels2banks, ProbePlot
-from brainbox.behavior.training import plot_psychometric, plot_reaction_time, plot_reaction_time_over_trials
+from brainbox.behavior import pyschofit as psy
+from brainbox.behavior.training import (
+    compute_performance, compute_psychometric, compute_reaction_time, get_signed_contrast)
 from ibllib.plots import Density
 from ibllib.atlas.regions import BrainRegions
 from iblutil.util import Bunch
@@ -29,6 +39,11 @@ import time
 
 import one.alf.io as alfio
 
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
 
 # -------------------------------------------------------------------------------------------------
 # Constants
@@ -39,11 +54,97 @@ DATA_DIR = ROOT_DIR / 'static/data'
 CACHE_DIR = ROOT_DIR / 'static/cache'
 BRAIN_REGIONS = BrainRegions()
 
+# Session data saved in snapshots: ALF objects, arrays and other attributes of the DataLoader.
+SNAPSHOT_OBJECTS = ('spikes', 'clusters', 'clusters_good', 'trials', 'channels')
+SNAPSHOT_ARRAYS = ('trial_intervals', 'trial_idx', 'cluster_wfs', 'cluster_wf_chns', 'rms_chns', 'rms_ap', 'lfp',
+                   'session_raster', 't_vals', 'd_vals')
+SNAPSHOT_ATTRIBUTES = ('pid', 'eid', 'session_info', 'depth_lim', 'amp_lim')
+# Session data left out when rendering the figures from the data products, without the ALF files.
+SNAPSHOT_RENDER_EXCLUDE = ('spikes',)
+
+# Behaviour fits: probability-left blocks of the psychometric and chronometric curves (in drawing
+# order), and parameters of the psychometric model (erf with two lapse rates).
+BEHAVIOUR_BLOCKS = (0.5, 0.2, 0.8)
+PSYCHOMETRIC_PARAMETERS = ('bias', 'threshold', 'lapse_low', 'lapse_high')
+
+# Number of sessions (eid) whose trials, wheel, licks and camera data are kept in memory by the
+# loading functions, to share them between the probes (pid) of a session.
+EID_CACHE_SIZE = 1
+
+# Rasters aligned to trial events: time window around the events, raster and PSTH bin sizes (s).
+RASTER_PRE_TIME = 0.4
+RASTER_POST_TIME = 1
+RASTER_BIN = 0.01
+PSTH_BIN = 0.05
+
 
 # -------------------------------------------------------------------------------------------------
 # Loading functions
 # -------------------------------------------------------------------------------------------------
 
+_eid_cache = OrderedDict()  # {eid: {(function name, *args): data}}, most recently used last
+
+
+def eid_cache(func):
+    """Decorator of the loading functions of the session (eid) data, which is the same for all the
+    probes of the session: the data of the last EID_CACHE_SIZE sessions is kept in memory. The
+    cached objects are shared and must not be modified."""
+
+    @functools.wraps(func)
+    def wrapped(eid, *args):
+        data = _eid_cache.pop(eid, {})
+        _eid_cache[eid] = data
+        while len(_eid_cache) > EID_CACHE_SIZE:
+            _eid_cache.popitem(last=False)
+        key = (func.__name__, *args)
+        if key not in data:
+            data[key] = func(eid, *args)
+        return data[key]
+
+    return wrapped
+
+
+_tables = {}  # {file name: ((mtime, size), table)}, see shared_table()
+
+
+def shared_table(name, load):
+    """Return a table of the data folder loaded once per process (and again when the file
+    changes), shared by all the DataLoader instances. The table must not be modified."""
+    path = DATA_DIR / name
+    st = path.stat()
+    version = (st.st_mtime_ns, st.st_size)
+    if name not in _tables or _tables[name][0] != version:
+        _tables[name] = (version, load(path))
+    return _tables[name][1]
+
+
+def load_session_table(path):
+    return pd.read_parquet(path).set_index('pid')
+
+
+def load_features(path):
+    """Load the raw ephys features as read-only column arrays grouped by pid, with the rows
+    `offsets[pid]` (a slice) of each session."""
+    df = pd.read_parquet(path).reset_index()
+    order = np.argsort(df['pid'].values, kind='stable')
+    pids = df['pid'].values[order]
+    starts = np.flatnonzero(np.r_[True, pids[1:] != pids[:-1]]) if len(pids) else np.array([], dtype=int)
+    stops = np.r_[starts[1:], len(pids)]
+    columns = {}
+    for name in df.columns.drop('pid'):
+        columns[name] = df[name].values[order]
+        columns[name].flags.writeable = False
+    return Bunch(columns=columns, offsets={pid: slice(a, b) for pid, a, b in zip(pids[starts], starts, stops)})
+
+
+def session_table():
+    return shared_table('session.table.pqt', load_session_table)
+
+
+def features_table():
+    return shared_table('raw_ephys_features.pqt', load_features)
+
+
 def load_clusters(pid):
     clusters = alfio.load_object(DATA_DIR.joinpath(pid), object='clusters')
     return clusters
@@ -59,6 +160,7 @@ def load_spikes(pid):
     return spikes
 
 
+@eid_cache
 def load_trials(eid):
     trials = alfio.load_object(DATA_DIR.joinpath(eid), object='trials')
     return trials
@@ -85,16 +187,19 @@ def load_raw_data(pid):
     return raw_info, raw_data
 
 
+@eid_cache
 def load_camera(eid, camera):
     camera = alfio.load_object(DATA_DIR.joinpath(eid), object=f'{camera}Camera')
     return camera
 
 
+@eid_cache
 def load_licks(eid):
     licks = np.load(DATA_DIR.joinpath(eid, 'licks.times.npy'))
     return licks
 
 
+@eid_cache
 def load_wheel(eid):
     wheel = alfio.load_object(DATA_DIR.joinpath(eid), object='wheel')
     return wheel
@@ -106,11 +211,10 @@ def load_wheel(eid):
 
 
 def _filter(obj, idx):
-    obj = Bunch(copy.deepcopy(obj))
-    for key in obj.keys():
-        obj[key] = obj[key][idx]
-
-    return obj
+    # NOTE: fancy and boolean indexing return new writable arrays, and slices return views that
+    # are only read-only when the array is (such as the memory maps of a shared session). There is
+    # no need to copy the whole object, which may be memory-mapped.
+    return Bunch({key: obj[key][idx] for key in obj.keys()})
 
 
 def filter_spikes_by_good_clusters(spikes):
@@ -159,12 +263,11 @@ def filter_wfs_by_cluster_idx(waveforms, waveform_channels, clusters, cluster_id
 
 
 def filter_features_by_pid(features, pid, column):
-    feat = features[features['pid'] == pid]
-    values = feat[column].values
-    if len(values) == 0:
+    rows = features.offsets.get(pid, None)
+    if rows is None:
         return np.full(384, np.nan)
     else:
-        return feat[column].values
+        return features.columns[column][rows]
 
 
 # -------------------------------------------------------------------------------------------------
@@ -197,6 +300,27 @@ def bin_spikes(spike_times, align_times, pre_time, post_time, bin_size, weights=
     return bins, tscale
 
 
+def bin_raster(times, events, weights=None, fr=True, norm=False, bin_scale=1):
+    """Return the raster and PSTH of a series of timestamps (spikes, licks, or samples of a
+    behavioural signal when weights are given) aligned to trial events, with the bin sizes
+    multiplied by `bin_scale`."""
+    raster, t_raster = bin_spikes(
+        times, events, pre_time=RASTER_PRE_TIME, post_time=RASTER_POST_TIME, bin_size=RASTER_BIN * bin_scale,
+        weights=weights)
+    psth, t_psth = bin_spikes(
+        times, events, pre_time=RASTER_PRE_TIME, post_time=RASTER_POST_TIME, bin_size=PSTH_BIN * bin_scale,
+        weights=weights)
+
+    if fr:
+        psth = psth / (PSTH_BIN * bin_scale)
+
+    if norm:
+        psth = psth - np.repeat(psth[:, 0][:, np.newaxis], psth.shape[1], axis=1)
+        raster = raster - np.repeat(raster[:, 0][:, np.newaxis], raster.shape[1], axis=1)
+
+    return {'raster': raster, 't_raster': t_raster, 'psth': psth, 't_psth': t_psth}
+
+
 # Taken from phy
 def _compute_histogram(
         data, x_max=None, x_min=None, n_bins=None, normalize=True, ignore_zeros=False):
@@ -219,6 +343,70 @@ def _clip(x, a, b):
     return max(a, min(b, x))
 
 
+def _to_list(arr):
+    """Array as a JSON list, with null for NaN."""
+    return [None if np.isnan(x) else float(x) for x in np.asarray(arr, dtype=float).ravel()]
+
+
+def _reaction_time_ci(trials, signed_contrast, block, contrasts):
+    """Confidence interval (n, 2) of the median reaction time per contrast computed by
+    compute_reaction_time(), NaN for the contrasts with less than two trials which it cannot
+    bootstrap."""
+    in_block = np.asarray(trials['probabilityLeft'] == block)
+    values, counts = np.unique(signed_contrast[in_block], return_counts=True)
+    keep = in_block & np.isin(signed_contrast, values[counts > 1])
+    subset = Bunch({name: np.asarray(trials[name])[keep]
+                    for name in ('probabilityLeft', 'stimOn_times', 'response_times')})
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # degenerate bootstrap of identical reaction times
+        _, ci_contrasts, _, ci = compute_reaction_time(
+            subset, signed_contrast=signed_contrast[keep], block=block, compute_ci=True)
+    out = np.full((len(contrasts), 2), np.nan)
+    out[np.isin(contrasts, ci_contrasts)] = ci
+    return out
+
+
+def compute_behaviour_fits(trials):
+    """Fit the psychometric curve of each probability-left block of a session, and summarize the
+    choices and the reaction times per contrast with their confidence intervals, and the reaction
+    time of each trial, as a JSON-serializable dictionary."""
+    signed_contrast = get_signed_contrast(trials)
+    blocks = {}
+    for block in BEHAVIOUR_BLOCKS:
+        prob_right, contrasts, n_trials = compute_performance(
+            trials, signed_contrast=signed_contrast, block=block, prob_right=True)
+        out = compute_psychometric(trials, signed_contrast=signed_contrast, block=block, plotting=True,
+                                   compute_ci=True)
+        # Without trials in the block, only the (NaN) parameters are returned.
+        pars, ci = out if isinstance(out, tuple) else (out, np.full((2, len(contrasts)), np.nan))
+        reaction_time, rt_contrasts, _ = compute_reaction_time(trials, signed_contrast=signed_contrast, block=block)
+        rt_ci = _reaction_time_ci(trials, signed_contrast, block, rt_contrasts)
+        blocks[str(block)] = {
+            'psychometric': dict(zip(PSYCHOMETRIC_PARAMETERS, _to_list(pars))),
+            'contrasts': _to_list(contrasts),
+            'n_trials': [int(n) for n in n_trials],
+            'prob_right': _to_list(prob_right),
+            'prob_right_ci': [_to_list(prob_right + ci[0]), _to_list(prob_right + ci[1])],
+            'rt_contrasts': _to_list(rt_contrasts),
+            'reaction_time': _to_list(reaction_time),
+            'reaction_time_ci': [_to_list(rt_ci[:, 0]), _to_list(rt_ci[:, 1])],
+        }
+    reaction_times = np.asarray(trials['response_times'] - trials['stimOn_times'], dtype=float)
+    median = np.nanmedian(reaction_times) if np.any(~np.isnan(reaction_times)) else np.nan
+    return {'blocks': blocks, 'reaction_times': _to_list(reaction_times),
+            'median_reaction_time': _to_list([median])[0]}
+
+
+def _fits_array(values):
+    return np.array(values, dtype=float)
+
+
+def _error_bars(values, ci):
+    """Error bars (2, n) around values from the bounds of their confidence interval."""
+    values, low, high = _fits_array(values), _fits_array(ci[0]), _fits_array(ci[1])
+    return np.abs(np.vstack([values - low, high - values]))
+
+
 # -------------------------------------------------------------------------------------------------
 # Styling functions
 # -------------------------------------------------------------------------------------------------
@@ -256,25 +444,195 @@ def remove_frame(ax):
     return ax
 
 
+# -------------------------------------------------------------------------------------------------
+# Data products
+# -------------------------------------------------------------------------------------------------
+
+@contextmanager
+def _locked(f):
+    """Exclusive lock on an open file."""
+    if fcntl is None:
+        yield
+        return
+    fcntl.flock(f, fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class ProductStore:
+    """Per-session store of the data products of the figures: the compressed arrays of the products of
+    each compute function (for example the rasters of all trials) are appended to one file, with their
+    offsets in an index."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._entries = {}  # product name: (bytes of the index read, {key: {array name: descr}})
+
+    def _files(self, name):
+        return self.path / f'{name}.bin', self.path / f'{name}.idx'
+
+    def index(self):
+        path = self.path / 'index.json'
+        if not path.exists():
+            return {}
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def reset(self, fingerprint, **info):
+        """Discard the products made with other input files or compute code, return whether
+        the store was reset."""
+        if self.index().get('fingerprint', None) == fingerprint:
+            return False
+        shutil.rmtree(self.path, ignore_errors=True)
+        self._entries.clear()
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp = self.path / f'.index.{os.getpid()}.json'
+        with open(tmp, 'w') as f:
+            json.dump(dict(fingerprint=fingerprint, **info), f, indent=1)
+        os.replace(tmp, self.path / 'index.json')
+        return True
+
+    def _read_index(self, name, f=None):
+        """Read the index lines appended since the last read, as {key: {array name: descr}}."""
+        pos, entries = self._entries.get(name, (0, {}))
+        _, index = self._files(name)
+        if f is None and not index.exists():
+            return entries
+        with (open(index, 'rb') if f is None else nullcontext(f)) as fi:
+            fi.seek(pos)
+            # A last line without newline is being written, or was cut by a crash.
+            for line in fi.read().splitlines(keepends=True):
+                if not line.endswith(b'\n'):
+                    break
+                pos += len(line)
+                try:
+                    key, arrays = json.loads(line)
+                except ValueError:
+                    continue
+                entries[key] = arrays
+        self._entries[name] = (pos, entries)
+        return entries
+
+    def _entry(self, key):
+        name = key.split('.')[0]
+        return self._entries.get(name, (0, {}))[1].get(key, None) or self._read_index(name).get(key, None)
+
+    def __contains__(self, key):
+        return self._entry(key) is not None
+
+    def __getitem__(self, key):
+        data, _ = self._files(key.split('.')[0])
+        out = Bunch()
+        with open(data, 'rb') as f:
+            for name, d in self._entry(key).items():
+                f.seek(d['offset'])
+                buf = bytearray(zlib.decompress(f.read(d['size'])))
+                out[name] = np.frombuffer(buf, dtype=d['dtype']).reshape(d['shape'])
+        return out
+
+    def __setitem__(self, key, data):
+        name = key.split('.')[0]
+        arrays = {k: np.ascontiguousarray(v) for k, v in data.items()}
+        blobs = {k: zlib.compress(arr.tobytes(), 1) for k, arr in arrays.items()}
+        path, index = self._files(name)
+        # The products of a session are computed concurrently by several workers, which append
+        # them in turn. The arrays are written before their index line.
+        with open(index, 'ab+') as fi, _locked(fi):
+            if key in self._read_index(name, fi):
+                return
+            descr = {}
+            with open(path, 'ab') as f:
+                for k, blob in blobs.items():
+                    descr[k] = {'dtype': arrays[k].dtype.str, 'shape': list(arrays[k].shape),
+                                'offset': f.tell(), 'size': len(blob)}
+                    f.write(blob)
+            fi.seek(0, os.SEEK_END)
+            if fi.tell() > self._entries[name][0]:  # end of a line cut by a crash
+                fi.write(b'\n')
+            fi.write(json.dumps([key, descr]).encode() + b'\n')
+        self._read_index(name)
+
+
+def product(func):
+    """Decorator of the DataLoader methods computing the data of a figure as a dictionary of
+    arrays: the result is read from the product store of the session (the `store` attribute)
+    when available, and saved to it otherwise."""
+
+    @functools.wraps(func)
+    def wrapped(self, *args):
+        # The coarser products of the previews are not stored.
+        store = getattr(self, 'store', None) if self.bin_scale == 1 else None
+        key = '.'.join([func.__name__.replace('compute_', '', 1), *map(str, args)])
+        if store is not None and key in store:
+            return store[key]
+        # Arrays in both cases, as read back from the store.
+        data = Bunch({name: np.asarray(value) for name, value in func(self, *args).items()})
+        if store is not None:
+            store[key] = data
+        return data
+
+    return wrapped
+
+
+# -------------------------------------------------------------------------------------------------
+# Figure templates
+# -------------------------------------------------------------------------------------------------
+
+def _data_artists(ax):
+    return [*ax.lines, *ax.collections, *ax.patches, *ax.images, *ax.texts]
+
+
+class FigureTemplate:
+    """Figure reused for all trials or clusters of a session, whose `reset()` removes the artists drawn for the
+    previous item."""
+
+    def __init__(self, fig, axs):
+        self.fig = fig
+        self.axs = axs
+        self._static = {}
+
+    def freeze(self):
+        """Record the artists and the autoscaling state of the layout."""
+        for ax in self.fig.axes:
+            self._static[ax] = (set(_data_artists(ax)), ax.get_autoscalex_on(), ax.get_autoscaley_on())
+        return self
+
+    def reset(self):
+        for ax, (static, autoscalex, autoscaley) in self._static.items():
+            for artist in _data_artists(ax):
+                if artist not in static:
+                    artist.remove()
+            ax.relim()
+            ax.set_autoscalex_on(autoscalex)
+            ax.set_autoscaley_on(autoscaley)
+
+    def close(self):
+        plt.close(self.fig)
+
+
 # -------------------------------------------------------------------------------------------------
 # Plotting functions
 # -------------------------------------------------------------------------------------------------
 
 class DataLoader:
 
+    # Multiple of the bin sizes of the rasters and PSTHs, larger for the low-resolution previews.
+    bin_scale = 1
+
     # Loading functions
     # ---------------------------------------------------------------------------------------------
 
     def __init__(self):
-        self.session_df = pd.read_parquet(DATA_DIR.joinpath('session.table.pqt'))
-        self.session_df = self.session_df.set_index('pid')
+        # The session and features tables are shared by the DataLoader instances of the process.
+        self.session_df = session_table()
 
         # # Channels and brain acronyms.
         # self.channels_df = pd.read_parquet(DATA_DIR.joinpath('channels.pqt'))
 
         # load in the waveform tables
-        self.features = pd.read_parquet(DATA_DIR.joinpath('raw_ephys_features.pqt'))
-        self.features = self.features.reset_index()
+        self.features = features_table()
 
     def session_init(self, pid):
         assert self.session_df is not None
@@ -292,7 +650,7 @@ class DataLoader:
         :param pid:
         :return:
         """
-        self.session_info = self.session_df[self.session_df.index == pid].to_dict(orient='records')[0]
+        self.session_info = self.session_df.loc[[pid]].to_dict(orient='records')[0]
         self.eid = self.session_info['eid']
         self.spikes = filter_spikes_by_good_clusters(load_spikes(pid))
         self.trials = load_trials(self.eid)
@@ -314,6 +672,61 @@ class DataLoader:
         self.depth_lim = [0, 4000]
         self.amp_lim = [-10, 800]
 
+    def save_snapshot(self, path, exclude=()):
+        """
+        Save the loaded session data in a folder, as .npy files that can be memory-mapped
+        :param path:
+        :param exclude: names of the ALF objects or arrays left out of the snapshot
+        :return:
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        others = {'attributes': {name: getattr(self, name) for name in SNAPSHOT_ATTRIBUTES}, 'objects': {}}
+        for name in SNAPSHOT_OBJECTS:
+            if name in exclude:
+                continue
+            for key, value in getattr(self, name).items():
+                if isinstance(value, np.ndarray):
+                    np.save(path / f'{name}.{key}.npy', value)
+                else:
+                    others['objects'].setdefault(name, {})[key] = value
+        for name in SNAPSHOT_ARRAYS:
+            if name not in exclude:
+                np.save(path / f'{name}.npy', getattr(self, name))
+        with open(path / 'session.pkl', 'wb') as f:
+            pickle.dump(others, f)
+
+    @classmethod
+    def load_snapshot(cls, path, exclude=()):
+        """
+        Return a DataLoader attached read-only to the memory-mapped session data saved with
+        save_snapshot(), without reading the ALF files or the session tables
+        :param path:
+        :param exclude: names of the ALF objects or arrays not loaded, which are left unset
+        :return:
+        """
+        path = Path(path)
+        self = cls.__new__(cls)
+        with open(path / 'session.pkl', 'rb') as f:
+            others = pickle.load(f)
+        self.__dict__.update(others['attributes'])
+        for name in SNAPSHOT_OBJECTS:
+            if name not in exclude:
+                setattr(self, name, Bunch(others['objects'].get(name, {})))
+        for fn in sorted(path.glob('*.npy')):
+            if fn.name.split('.')[0] in exclude:
+                continue
+            try:
+                arr = np.load(fn, mmap_mode='r')
+            except ValueError:  # arrays of Python objects cannot be memory-mapped
+                arr = np.load(fn, allow_pickle=True)
+            name, _, key = fn.stem.partition('.')
+            if key:
+                getattr(self, name)[key] = arr
+            else:
+                setattr(self, name, arr)
+        return self
+
     def get_session_details(self):
         """
         Get dict of metadata for session
@@ -341,18 +754,12 @@ class DataLoader:
         # Sort by cluster depth.
         idx = np.argsort(self.clusters_good.depths)[::-1]
 
-        # Internal fields used by the frontend.
-        details['_trial_ids'] = [int(_) for _ in self.trial_idx]
-
-        # Trial intervals.
-        details['_trial_onsets'] = [float(_) if not np.isnan(_) else None for _ in self.trial_intervals[:, 0]]
-        details['_trial_offsets'] = [float(_) if not np.isnan(_) else None for _ in self.trial_intervals[:, 1]]
-
-        details['_cluster_ids'] = [int(_) for _ in self.clusters_good.cluster_id[idx]]
-        details['_acronyms'] = self.clusters_good.acronym[idx].tolist()
+        # Internal fields used by the frontend. The arrays of trial and cluster ids, trial
+        # intervals, acronym codes and colors are returned by get_session_arrays(), _acronyms is
+        # the dictionary of the acronym codes.
+        details['_acronyms'] = self._acronyms(idx)[0].tolist()
         # details['_brain_regions'] = self.brain_regions
         # details['_brain_regions'] = sorted(set(details['_acronyms']))
-        details['_colors'] = BRAIN_REGIONS.get(self.clusters_good.atlas_id[idx]).rgb.tolist()
 
         regions = sorted(set(BRAIN_REGIONS.get(self.clusters_good.atlas_id[idx]).name))
         regions_acronyms = sorted(set(BRAIN_REGIONS.get(self.clusters_good.atlas_id[idx]).acronym))
@@ -365,41 +772,90 @@ class DataLoader:
 
         return details
 
-    def get_trial_details(self, trial_idx):
-        trials = filter_trials_by_trial_idx(self.trials, trial_idx)
+    def _acronyms(self, idx):
+        """Dictionary encoding of the acronyms of the good clusters sorted with `idx`: the unique
+        acronyms in order of first appearance, and the code of each cluster."""
+        names, first, codes = np.unique(self.clusters_good.acronym[idx], return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(order.size)
+        return names[order], rank[codes.ravel()]
 
-        def _get_block_probability(pLeft):
-            if pLeft == 0.5:
-                return 'neutral'
-            elif pLeft == 0.8:
-                return 'left'
-            elif pLeft == 0.2:
-                return 'right'
+    def get_session_arrays(self):
+        """
+        Get the per-trial and per-cluster arrays of the session used by the frontend, with the
+        clusters sorted by depth
+        :return: dict of arrays
+        """
+        idx = np.argsort(self.clusters_good.depths)[::-1]
+        return {
+            'trial_ids': np.asarray(self.trial_idx, dtype=np.int32),
+            'trial_onsets': np.asarray(self.trial_intervals[:, 0], dtype=np.float64),
+            'trial_offsets': np.asarray(self.trial_intervals[:, 1], dtype=np.float64),
+            'cluster_ids': np.asarray(self.clusters_good.cluster_id[idx], dtype=np.int32),
+            'acronyms': self._acronyms(idx)[1].astype(np.uint16),
+            'colors': BRAIN_REGIONS.get(self.clusters_good.atlas_id[idx]).rgb.astype(np.uint8),
+        }
 
-        details = OrderedDict()
-        details['Trial #'] = trial_idx
-        details['Contrast'] = np.nanmean([trials.contrastLeft, trials.contrastRight]) * 100
-        details['Stim side'] = 'left' if np.isnan(trials.contrastRight) else 'right'
-        details['Block proba'] = _get_block_probability(trials.probabilityLeft)
-        details['Resp type'] = 'correct' if trials.feedbackType == 1 else 'incorrect'
-        details['Resp time'] = f'{np.round((trials.feedback_times - trials.stimOn_times) * 1e3, 0)} ms'
+    def get_trial_details(self, trial_idx):
+        return self.get_all_trial_details([trial_idx])[trial_idx]
 
-        return details
+    def get_all_trial_details(self, trial_idxs):
+        """
+        Get the details of several trials, computed in one vectorized pass
+        :param trial_idxs:
+        :return: dict {trial_idx: details}
+        """
+        trials = filter_trials_by_trial_idx(self.trials, np.asarray(trial_idxs, dtype=int))
+        blocks = {0.5: 'neutral', 0.8: 'left', 0.2: 'right'}
+
+        contrast = np.nanmean(np.c_[trials.contrastLeft, trials.contrastRight], axis=1) * 100
+        stim_side = np.where(np.isnan(trials.contrastRight), 'left', 'right')
+        resp_type = np.where(trials.feedbackType == 1, 'correct', 'incorrect')
+        resp_time = np.round((trials.feedback_times - trials.stimOn_times) * 1e3, 0)
+
+        out = {}
+        for i, trial_idx in enumerate(trial_idxs):
+            details = OrderedDict()
+            details['Trial #'] = trial_idx
+            details['Contrast'] = contrast[i]
+            details['Stim side'] = str(stim_side[i])
+            details['Block proba'] = blocks.get(float(trials.probabilityLeft[i]), None)
+            details['Resp type'] = str(resp_type[i])
+            details['Resp time'] = f'{resp_time[i]} ms'
+            out[trial_idx] = details
+        return out
 
     def get_cluster_details(self, cluster_idx):
-        cluster = filter_clusters_by_cluster_idx(self.clusters, cluster_idx)
-        if not cluster:
-            return
-
-        details = {
-            'Cluster #': cluster_idx,
-            'Brain region': BRAIN_REGIONS.id2acronym(cluster.atlas_id, mapping='Beryl')[0],
-            'N spikes': len(filter_spikes_by_cluster_idx(self.spikes, cluster_idx)['times']),
-            'Overall firing rate': f'{np.round(cluster["firing_rate"], 2)} Hz',
-            'Max amplitude': f'{np.round(cluster["amp_max"] * 1e6, 2)} uV'
-        }
+        return self.get_all_cluster_details([cluster_idx])[cluster_idx]
 
-        return details
+    def get_all_cluster_details(self, cluster_idxs):
+        """
+        Get the details of several clusters, computed in one vectorized pass (the spikes are
+        counted with a single bincount)
+        :param cluster_idxs:
+        :return: dict {cluster_idx: details}, with None for the clusters that do not exist
+        """
+        ids, rows = np.unique(self.clusters.cluster_id, return_index=True)
+        rows = dict(zip(ids.tolist(), rows))
+        found = [cluster_idx for cluster_idx in cluster_idxs if cluster_idx in rows]
+        idx = np.array([rows[cluster_idx] for cluster_idx in found], dtype=int)
+
+        n_spikes = np.bincount(self.spikes.clusters, minlength=max(found, default=0) + 1)
+        regions = BRAIN_REGIONS.id2acronym(self.clusters.atlas_id[idx], mapping='Beryl')
+        firing_rate = np.round(self.clusters.firing_rate[idx], 2)
+        amp_max = np.round(self.clusters.amp_max[idx] * 1e6, 2)
+
+        out = dict.fromkeys(cluster_idxs)
+        for i, cluster_idx in enumerate(found):
+            out[cluster_idx] = {
+                'Cluster #': cluster_idx,
+                'Brain region': regions[i],
+                'N spikes': int(n_spikes[cluster_idx]),
+                'Overall firing rate': f'{firing_rate[i]} Hz',
+                'Max amplitude': f'{amp_max[i]} uV'
+            }
+        return out
 
     def compute_trial_intervals(self):
         # Find the nan trials and remove these
@@ -417,6 +873,101 @@ class DataLoader:
 
         return np.c_[t0, t1], trial_no[~nan_idx]
 
+    # Data products
+    # ---------------------------------------------------------------------------------------------
+
+    @product
+    def compute_raw_data(self):
+        info, raw_ephys = load_raw_data(self.pid)
+        spikes = load_spikes(self.pid)
+
+        times = info['t']
+        ts = info['t_offset']
+        te = info['t_offset'] + info['t_display']
+        fs = info['fs']
+
+        data = {'times': np.array(times), 'fs': fs, 'raw': raw_ephys}
+        for iT, t in enumerate(times):
+            spike_idx = slice(*np.searchsorted(spikes['samples'], [int((t + ts) * fs), int((t + te) * fs)]))
+            data[f'spike_channels{iT}'] = self.clusters['channels'][spikes['clusters'][spike_idx]]
+            data[f'spike_times{iT}'] = (spikes['samples'][spike_idx] / fs - (t + ts)) * 1000
+            data[f'spike_labels{iT}'] = self.clusters['label'][spikes['clusters'][spike_idx]]
+        return data
+
+    @product
+    def compute_trial_raster(self, trial_idx):
+        t0 = self.trial_intervals[trial_idx, 0]
+        t1 = self.trial_intervals[trial_idx, 1]
+
+        spikes = filter_spikes_by_trial(self.spikes, t0, t1)
+
+        t_bin = 0.005 * self.bin_scale
+        d_bin = 5 * self.bin_scale
+        kp_idx = ~np.isnan(spikes.depths)
+
+        raster, t_vals, d_vals = bincount2D(spikes.times[kp_idx], spikes.depths[kp_idx], t_bin, d_bin, ylim=[0, 3840])
+        return {'raster': raster / t_bin, 't_vals': t_vals, 'd_vals': d_vals,
+                'xlim': [np.min(spikes.times), np.max(spikes.times)]}
+
+    @product
+    def compute_event_aligned_activity(self):
+        stim_events = {'Stim On': self.trials['stimOn_times'],
+                       'First Move': self.trials['firstMovement_times'],
+                       'Feedback': self.trials['feedback_times']}
+        kp_idx = ~np.isnan(self.spikes.depths)
+        return get_stim_aligned_activity(stim_events, self.spikes.times[kp_idx], self.spikes.depths[kp_idx],
+                                         pre_stim=RASTER_PRE_TIME, post_stim=RASTER_POST_TIME, y_lim=[0, 3840],
+                                         t_bin=0.01 * self.bin_scale, d_bin=20 * self.bin_scale)
+
+    @product
+    def compute_cluster_raster(self, cluster_idx, event):
+        spikes = filter_spikes_by_cluster_idx(self.spikes, cluster_idx)
+        return bin_raster(spikes.times, self.trials[event], bin_scale=self.bin_scale)
+
+    @product
+    def compute_dlc_raster(self, camera, feature, zscore_flag, norm):
+        camera = load_camera(self.eid, camera)
+        feature = camera.computedFeatures[feature]
+
+        if zscore_flag:
+            feature = zscore(feature, nan_policy='omit')
+
+        return bin_raster(camera.times, self.trials['stimOn_times'], weights=feature, fr=False, norm=norm,
+                          bin_scale=self.bin_scale)
+
+    @product
+    def compute_lick_raster(self):
+        licks = load_licks(self.eid)
+        return bin_raster(licks, self.trials['stimOn_times'], fr=False, bin_scale=self.bin_scale)
+
+    @product
+    def compute_wheel_raster(self):
+        wheel = load_wheel(self.eid)
+        speed = velocity(wheel.timestamps, wheel.position)
+        return bin_raster(wheel.timestamps, self.trials['firstMovement_times'], weights=speed, fr=False,
+                          bin_scale=self.bin_scale)
+
+    @product
+    def compute_cluster_spikes(self, cluster_idx):
+        spikes = filter_spikes_by_cluster_idx(self.spikes, cluster_idx)
+        return {key: spikes[key] for key in ('times', 'depths', 'sizes', 'amps')}
+
+    @product
+    def compute_session_duration(self):
+        return {'duration': np.max(self.spikes.times)}
+
+    @product
+    def compute_autocorrelogram(self, cluster_idx):
+        spikes = filter_spikes_by_cluster_idx(self.spikes, cluster_idx)
+        x_corr = xcorr(spikes.times, spikes.clusters, 1 / 1e3, 50 / 1e3)
+        return {'corr': x_corr[0, 0, :]}
+
+    @product
+    def compute_inter_spike_interval(self, cluster_idx):
+        spikes = filter_spikes_by_cluster_idx(self.spikes, cluster_idx)
+        isi, bins = _compute_histogram(np.diff(spikes.times), 0.01, 0, 50)
+        return {'isi': isi, 'bins': bins}
+
     # Plotting functions
     # ---------------------------------------------------------------------------------------------
 
@@ -554,13 +1105,9 @@ class DataLoader:
         else:
             fig = axs[0].get_figure()
 
-        info, raw_ephys = load_raw_data(self.pid)
-        spikes = load_spikes(self.pid)
-
-        times = info['t']
-        ts = info['t_offset']
-        te = info['t_offset'] + info['t_display']
-        fs = info['fs']
+        data = self.compute_raw_data()
+        times = data.times.tolist()
+        fs = data.fs.item()
 
         vmin = -0.000050
         vmax = 0.000050
@@ -573,14 +1120,13 @@ class DataLoader:
             ax0.vlines(times, *ax0.get_ylim(), color='k', ls='--')
 
         for iT, time in enumerate(times):
-            spike_idx = slice(*np.searchsorted(spikes['samples'], [int((time + ts) * fs), int((time + te) * fs)]))
-            spike_channels = self.clusters['channels'][spikes['clusters'][spike_idx]]
-            spike_times = (spikes['samples'][spike_idx] / fs - (time + ts)) * 1000
-            spike_labels = self.clusters['label'][spikes['clusters'][spike_idx]]
+            spike_channels = data[f'spike_channels{iT}']
+            spike_times = data[f'spike_times{iT}']
+            spike_labels = data[f'spike_labels{iT}']
 
             ax = axs[iT + 1] if raster else axs[iT]
 
-            _ = Density(-raw_ephys[:, :, iT], fs=fs, taxis=1, ax=ax, vmin=vmin, vmax=vmax, cmap=cmap)
+            _ = Density(-data.raw[:, :, iT], fs=fs, taxis=1, ax=ax, vmin=vmin, vmax=vmax, cmap=cmap)
             ax.scatter(spike_times[spike_labels != 1], spike_channels[spike_labels != 1], c='r', alpha=0.8, s=3)
             ax.scatter(spike_times[spike_labels == 1], spike_channels[spike_labels == 1], c='g', alpha=0.8, s=3)
             ax.set_title(f'T = {time} s')
@@ -593,24 +1139,26 @@ class DataLoader:
 
         return fig
 
-    def plot_session_raster(self, cluster_idx=None, trial_idx=None, ax=None, xlabel='Time (s)'):
+    def plot_session_raster(self, cluster_idx=None, trial_idx=None, ax=None, xlabel='Time (s)', layout=True):
+        # layout=False only adds the cluster spikes and trial marker to an existing session raster.
 
         if ax is None:
             fig, ax = plt.subplots(1, 1, figsize=(9, 6))
         else:
             fig = ax.get_figure()
 
-        ax.imshow(self.session_raster,
-                  extent=np.r_[np.min(self.t_vals), np.max(self.t_vals), np.min(self.d_vals), np.max(self.d_vals)],
-                  aspect='auto', origin='lower', vmax=50, cmap='binary')
+        if layout:
+            ax.imshow(self.session_raster,
+                      extent=np.r_[np.min(self.t_vals), np.max(self.t_vals), np.min(self.d_vals), np.max(self.d_vals)],
+                      aspect='auto', origin='lower', vmax=50, cmap='binary')
 
-        ax.set_xlim(0, np.max(self.t_vals))
-        ax.set_ylim(*self.depth_lim)
-        set_axis_style(ax, xlabel=xlabel, ylabel='Depth (um)')
+            ax.set_xlim(0, np.max(self.t_vals))
+            ax.set_ylim(*self.depth_lim)
+            set_axis_style(ax, xlabel=xlabel, ylabel='Depth (um)')
 
         if cluster_idx is not None:
             # TODO Allen colours
-            spikes = filter_spikes_by_cluster_idx(self.spikes, cluster_idx)
+            spikes = self.compute_cluster_spikes(cluster_idx)
             ax.scatter(spikes.times, spikes.depths, s=spikes.sizes,
                        facecolors='none', edgecolors='r')
 
@@ -630,26 +1178,17 @@ class DataLoader:
             fig = ax.get_figure()
 
         trials = filter_trials_by_trial_idx(self.trials, trial_idx)
-        t0 = self.trial_intervals[trial_idx, 0]
-        t1 = self.trial_intervals[trial_idx, 1]
+        data = self.compute_trial_raster(trial_idx)
 
-        spikes = filter_spikes_by_trial(self.spikes, t0, t1)
-
-        t_bin = 0.005
-        d_bin = 5
-        kp_idx = ~np.isnan(spikes.depths)
-
-        raster, t_vals, d_vals = bincount2D(spikes.times[kp_idx], spikes.depths[kp_idx], t_bin, d_bin, ylim=[0, 3840])
-        raster = raster / t_bin
-
-        ax.imshow(raster, extent=np.r_[np.min(t_vals), np.max(t_vals), np.min(d_vals), np.max(d_vals)],
+        ax.imshow(data.raster, extent=np.r_[np.min(data.t_vals), np.max(data.t_vals), np.min(data.d_vals),
+                                            np.max(data.d_vals)],
                   aspect='auto', origin='lower', vmax=50, cmap='binary')
 
         ax.set_ylim(*self.depth_lim)
-        ax.set_xlim(np.min(spikes.times), np.max(spikes.times))
+        ax.set_xlim(*data.xlim)
 
         if cluster_idx is not None:
-            spikes = filter_spikes_by_cluster_idx(spikes, cluster_idx)
+            spikes = filter_spikes_by_trial(self.compute_cluster_spikes(cluster_idx), *self.trial_intervals[trial_idx])
             ax.scatter(spikes.times, spikes.depths, s=spikes.sizes, c='r')
 
         self.add_trial_events_to_raster(ax, trials)
@@ -657,7 +1196,7 @@ class DataLoader:
 
         return fig
 
-    def plot_psychometric_curve(self, ax=None, ax_legend=None):
+    def plot_psychometric_curve(self, ax=None, ax_legend=None, fits=None):
 
         if ax is None:
             fig, axs = plt.subplots(1, 2, figsize=(6, 6), gridspec_kw={'width_ratios': [3, 1]})
@@ -666,11 +1205,21 @@ class DataLoader:
         else:
             fig = ax.get_figure()
 
-        plot_psychometric(self.trials, ax=ax)
+        # The fits are computed with compute_behaviour_fits() unless given.
+        fits = fits or compute_behaviour_fits(self.trials)
+        contrasts_fit = np.arange(-100, 100)
+        cmap = sns.diverging_palette(20, 220, n=3, center="dark")
+        for block, color in zip(BEHAVIOUR_BLOCKS, (cmap[1], cmap[0], cmap[2])):
+            data = fits['blocks'][str(block)]
+            pars = np.array([data['psychometric'][name] for name in PSYCHOMETRIC_PARAMETERS], dtype=float)
+            contrasts, prob_right = _fits_array(data['contrasts']), _fits_array(data['prob_right'])
+            ax.plot(contrasts_fit, psy.erf_psycho_2gammas(pars, contrasts_fit), color=color)
+            ax.scatter(contrasts, prob_right, color=color)
+            ax.errorbar(contrasts, prob_right, yerr=_error_bars(prob_right, data['prob_right_ci']), ecolor=color,
+                        fmt='none', capsize=5, alpha=0.4)
+        ax.set_ylim(-0.05, 1.05)
         set_axis_style(ax, xlabel='Contrasts', ylabel='Probability Choosing Right')
 
-        ax.get_legend().remove()
-
         legend_elements = [Line2D([0], [0], color='w', lw=0, label='20 % of trials on left side'),
                            Line2D([0], [0], color='w', lw=0, label='equal % of trials on both sides'),
                            Line2D([0], [0], color='w', lw=0, label='80 % of trials on left side'),
@@ -695,7 +1244,7 @@ class DataLoader:
 
         return fig
 
-    def plot_chronometric_curve(self, ax=None, ax_legend=None):
+    def plot_chronometric_curve(self, ax=None, ax_legend=None, fits=None):
 
         if ax is None:
             fig, axs = plt.subplots(1, 2, figsize=(6, 6), gridspec_kw={'width_rations': [3, 1]})
@@ -704,26 +1253,38 @@ class DataLoader:
         else:
             fig = ax.get_figure()
 
-        plot_reaction_time(self.trials, ax=ax)
+        fits = fits or compute_behaviour_fits(self.trials)
+        cmap = sns.diverging_palette(20, 220, n=3, center="dark")
+        h, l = [], []
+        for block, color in zip(BEHAVIOUR_BLOCKS, (cmap[1], cmap[0], cmap[2])):
+            data = fits['blocks'][str(block)]
+            contrasts, reaction_time = _fits_array(data['rt_contrasts']), _fits_array(data['reaction_time'])
+            h += ax.plot(contrasts, reaction_time, '-o', color=color)
+            ax.errorbar(contrasts, reaction_time, yerr=_error_bars(reaction_time, data['reaction_time_ci']),
+                        ecolor=color, fmt='none', capsize=5, alpha=0.4)
+            l.append(f'p_left={block} data')
         set_axis_style(ax, xlabel='Contrasts', ylabel='Reaction time (s)')
-        leg = ax.get_legend()
-        h = leg.legendHandles
-        l = [str(x._text) for x in leg.texts]
-        ax.get_legend().remove()
         if ax_legend is not None:
             ax_legend.legend(handles=h, labels=l, frameon=False, loc=7)
             remove_frame(ax_legend)
 
         return fig
 
-    def plot_reaction_time(self, ax=None):
+    def plot_reaction_time(self, ax=None, fits=None):
 
         if ax is None:
             fig, ax = plt.subplots(1, 1, figsize=(6, 6))
         else:
             fig = ax.get_figure()
 
-        plot_reaction_time_over_trials(self.trials, ax=ax)
+        fits = fits or compute_behaviour_fits(self.trials)
+        reaction_times = _fits_array(fits['reaction_times'])
+        rolled = pd.Series(reaction_times).rolling(window=10).median()
+        ax.scatter(np.arange(len(reaction_times)), reaction_times, s=16, color='darkgray')
+        ax.plot(np.arange(len(rolled)), rolled.values, color='k', linewidth=2)
+        ax.set_yscale('log')
+        ax.set_ylim(0.1, 100)
+        ax.yaxis.set_major_formatter(ScalarFormatter())
         set_axis_style(ax, xlabel='Trial number', ylabel='Reaction time (s)')
 
         return fig
@@ -789,28 +1350,32 @@ class DataLoader:
 
         return fig
 
-    def plot_spikes_amp_vs_depth(self, cluster_idx, ax=None, xlabel='Amplitude (uV)', ylabel=None):
+    def plot_spikes_amp_vs_depth(self, cluster_idx, ax=None, xlabel='Amplitude (uV)', ylabel=None, layout=True):
+        # cluster_idx=None only draws the layout, layout=False only the selected cluster.
         if ax is None:
             fig, ax = plt.subplots(1, 1, figsize=(4, 6))
         else:
             fig = ax.get_figure()
 
-        col = (BRAIN_REGIONS.get(self.clusters_good.atlas_id).rgb / 255).tolist()
-        scat = ax.scatter(self.clusters_good.amps * 1e6, self.clusters_good.depths, c=col, edgecolors='grey')
-        clusters = filter_clusters_by_cluster_idx(self.clusters_good, cluster_idx)
-        col_clus = (BRAIN_REGIONS.get(clusters.atlas_id).rgb / 255).tolist()
-        if clusters is not None:
-            ax.scatter(clusters.amps * 1e6, clusters.depths, c=col_clus, edgecolors='black',
-                       linewidths=2, s=80)
+        if layout:
+            col = (BRAIN_REGIONS.get(self.clusters_good.atlas_id).rgb / 255).tolist()
+            scat = ax.scatter(self.clusters_good.amps * 1e6, self.clusters_good.depths, c=col, edgecolors='grey')
+        if cluster_idx is not None:
+            clusters = filter_clusters_by_cluster_idx(self.clusters_good, cluster_idx)
+            col_clus = (BRAIN_REGIONS.get(clusters.atlas_id).rgb / 255).tolist()
+            if clusters is not None:
+                ax.scatter(clusters.amps * 1e6, clusters.depths, c=col_clus, edgecolors='black',
+                           linewidths=2, s=80)
 
-        _, region_labels, _ = self.get_brain_regions()
-        ax.set_yticks(region_labels[:, 0].astype(int))
-        ax.yaxis.set_tick_params(labelsize=10)
-        ax.set_yticklabels(region_labels[:, 1])
+        if layout:
+            _, region_labels, _ = self.get_brain_regions()
+            ax.set_yticks(region_labels[:, 0].astype(int))
+            ax.yaxis.set_tick_params(labelsize=10)
+            ax.set_yticklabels(region_labels[:, 1])
 
-        ax.set_ylim(*self.depth_lim)
-        ax.set_xlim(*self.amp_lim)
-        set_axis_style(ax, xlabel=xlabel, ylabel=ylabel)
+            ax.set_ylim(*self.depth_lim)
+            ax.set_xlim(*self.amp_lim)
+            set_axis_style(ax, xlabel=xlabel, ylabel=ylabel)
 
         return fig
 
@@ -839,14 +1404,9 @@ class DataLoader:
         else:
             fig = axs[0].get_figure()
 
-        stim_events = {'Stim On': self.trials['stimOn_times'],
-                       'First Move': self.trials['firstMovement_times'],
-                       'Feedback': self.trials['feedback_times']}
-        kp_idx = ~np.isnan(self.spikes.depths)
-        pre_stim = 0.4
-        post_stim = 1
-        data = get_stim_aligned_activity(stim_events, self.spikes.times[kp_idx], self.spikes.depths[kp_idx], pre_stim=pre_stim,
-                                         post_stim=post_stim, y_lim=[0, 3840])
+        pre_stim = RASTER_PRE_TIME
+        post_stim = RASTER_POST_TIME
+        data = self.compute_event_aligned_activity()
 
         for i, (key, d) in enumerate(data.items()):
             im = axs[i].imshow(d, aspect='auto', extent=np.r_[-1 * pre_stim, post_stim, 0, 3840], cmap='bwr', vmax=10, vmin=-10,
@@ -870,15 +1430,10 @@ class DataLoader:
     def plot_dlc_feature_raster(self, camera, feature, axs=None, xlabel='T from Stim On (s)', ylabel0='Speed (px/s)',
                                 ylabel1='Sorted Trial Number', title=None, zscore_flag=False, norm=False):
 
-        camera = load_camera(self.eid, camera)
-        feature = camera.computedFeatures[feature]
-
-        if zscore_flag:
-            feature = zscore(feature, nan_policy='omit')
+        data = self.compute_dlc_raster(camera, feature, zscore_flag, norm)
 
         trial_idx, dividers = find_trial_ids(self.trials, sort='choice')
-        fig, axs = self.single_cluster_raster(camera.times, self.trials['stimOn_times'], trial_idx, dividers, ['b', 'r'],
-                                              ['correct', 'incorrect'], weights=feature, axs=axs, fr=False, norm=norm)
+        fig, axs = self.single_cluster_raster(data, trial_idx, dividers, ['b', 'r'], ['correct', 'incorrect'], axs=axs)
 
         set_axis_style(axs[1], xlabel=xlabel, ylabel=ylabel1)
         set_axis_style(axs[0], ylabel=ylabel0, title=title)
@@ -888,11 +1443,10 @@ class DataLoader:
     def plot_lick_raster(self, axs=None, xlabel='T from Feedback (s)', ylabel0='Licks (count)',
                          ylabel1='Sorted Trial Number', title=None):
 
-        licks = load_licks(self.eid)
+        data = self.compute_lick_raster()
 
         trial_idx, dividers = find_trial_ids(self.trials, sort='choice')
-        fig, axs = self.single_cluster_raster(licks, self.trials['stimOn_times'], trial_idx, dividers, ['b', 'r'],
-                                              ['correct', 'incorrect'], axs=axs, fr=False)
+        fig, axs = self.single_cluster_raster(data, trial_idx, dividers, ['b', 'r'], ['correct', 'incorrect'], axs=axs)
 
         set_axis_style(axs[1], xlabel=xlabel, ylabel=ylabel1)
         set_axis_style(axs[0], ylabel=ylabel0, title=title)
@@ -902,13 +1456,10 @@ class DataLoader:
     def plot_wheel_raster(self, axs=None, xlabel='T from First Move (s)', ylabel0='Wheel velocity (rad/s)',
                           ylabel1='Sorted Trial Number', title=None):
 
-        wheel = load_wheel(self.eid)
-        speed = velocity(wheel.timestamps, wheel.position)
+        data = self.compute_wheel_raster()
 
         trial_idx, dividers = find_trial_ids(self.trials, sort='side')
-        fig, axs = self.single_cluster_raster(
-            wheel.timestamps, self.trials['firstMovement_times'], trial_idx, dividers, ['g', 'y'], ['left', 'right'],
-            weights=speed, fr=False, axs=axs)
+        fig, axs = self.single_cluster_raster(data, trial_idx, dividers, ['g', 'y'], ['left', 'right'], axs=axs)
 
         set_axis_style(axs[1], xlabel=xlabel, ylabel=ylabel1)
         set_axis_style(axs[0], ylabel=ylabel0, title=title)
@@ -916,12 +1467,12 @@ class DataLoader:
         return fig
 
     def plot_left_right_single_cluster_raster(self, cluster_idx, axs=None, xlabel='T from First Move (s)',
-                                              ylabel0='Firing Rate (Hz)', ylabel1='Sorted Trial Number'):
+                                              ylabel0='Firing Rate (Hz)', ylabel1='Sorted Trial Number', layout=True):
 
-        spikes = filter_spikes_by_cluster_idx(self.spikes, cluster_idx)
+        data = self._cluster_raster(cluster_idx, 'firstMovement_times')
         trial_idx, dividers = find_trial_ids(self.trials, sort='side')
         fig, axs = self.single_cluster_raster(
-            spikes.times, self.trials['firstMovement_times'], trial_idx, dividers, ['g', 'y'], ['left', 'right'], axs=axs)
+            data, trial_idx, dividers, ['g', 'y'], ['left', 'right'], axs=axs, layout=layout)
 
         set_axis_style(axs[1], xlabel=xlabel, ylabel=ylabel1)
         set_axis_style(axs[0], ylabel=ylabel0)
@@ -929,12 +1480,13 @@ class DataLoader:
         return fig
 
     def plot_correct_incorrect_single_cluster_raster(self, cluster_idx, axs=None, xlabel='T from Feedback (s)',
-                                                     ylabel0='Firing Rate (Hz)', ylabel1='Sorted Trial Number'):
+                                                     ylabel0='Firing Rate (Hz)', ylabel1='Sorted Trial Number',
+                                                     layout=True):
 
-        spikes = filter_spikes_by_cluster_idx(self.spikes, cluster_idx)
+        data = self._cluster_raster(cluster_idx, 'feedback_times')
         trial_idx, dividers = find_trial_ids(self.trials, sort='choice')
-        fig, axs = self.single_cluster_raster(spikes.times, self.trials['feedback_times'], trial_idx, dividers, ['b', 'r'],
-                                              ['correct', 'incorrect'], axs=axs)
+        fig, axs = self.single_cluster_raster(data, trial_idx, dividers, ['b', 'r'], ['correct', 'incorrect'], axs=axs,
+                                              layout=layout)
 
         set_axis_style(axs[1], xlabel=xlabel, ylabel=ylabel1)
         set_axis_style(axs[0], ylabel=ylabel0)
@@ -942,9 +1494,9 @@ class DataLoader:
         return fig
 
     def plot_block_single_cluster_raster(self, cluster_idx, axs=None, xlabel='T from Stim On (s)',
-                                         ylabel0='Firing Rate (Hz)', ylabel1='Sorted Trial Number'):
+                                         ylabel0='Firing Rate (Hz)', ylabel1='Sorted Trial Number', layout=True):
 
-        spikes = filter_spikes_by_cluster_idx(self.spikes, cluster_idx)
+        data = self._cluster_raster(cluster_idx, 'stimOn_times')
         trial_idx = np.arange(len(self.trials['probabilityLeft']))
         dividers = np.where(np.diff(self.trials['probabilityLeft']) != 0)[0]
 
@@ -954,8 +1506,7 @@ class DataLoader:
         colours[np.where(blocks == 0.5)] = np.array([*cmap[1]])
         colours[np.where(blocks == 0.8)] = np.array([*cmap[2]])
 
-        fig, axs = self.single_cluster_raster(spikes.times, self.trials['stimOn_times'], trial_idx, list(dividers), colours,
-                                              blocks, axs=axs)
+        fig, axs = self.single_cluster_raster(data, trial_idx, list(dividers), colours, blocks, axs=axs, layout=layout)
 
         set_axis_style(axs[1], xlabel=xlabel, ylabel=ylabel1)
         set_axis_style(axs[0], ylabel=ylabel0)
@@ -963,40 +1514,34 @@ class DataLoader:
         return fig
 
     def plot_contrast_single_cluster_raster(self, cluster_idx, axs=None, xlabel='T from Stim On (s)',
-                                            ylabel0='Firing Rate (Hz)', ylabel1='Sorted Trial Number'):
+                                            ylabel0='Firing Rate (Hz)', ylabel1='Sorted Trial Number', layout=True):
 
-        spikes = filter_spikes_by_cluster_idx(self.spikes, cluster_idx)
+        data = self._cluster_raster(cluster_idx, 'stimOn_times')
         contrasts = np.nanmean(np.c_[self.trials.contrastLeft, self.trials.contrastRight], axis=1)
         trial_idx = np.argsort(contrasts)
         dividers = list(np.where(np.diff(np.sort(contrasts)) != 0)[0])
         labels = [str(_ * 100) for _ in np.unique(contrasts)]
         colors = ['0.9', '0.7', '0.5', '0.3', '0.0']
-        fig, axs = self.single_cluster_raster(
-            spikes.times, self.trials['stimOn_times'], trial_idx, dividers, colors, labels, axs=axs)
+        fig, axs = self.single_cluster_raster(data, trial_idx, dividers, colors, labels, axs=axs, layout=layout)
 
         set_axis_style(axs[1], xlabel=xlabel, ylabel=ylabel1)
         set_axis_style(axs[0], ylabel=ylabel0)
 
         return fig
 
-    def single_cluster_raster(self, spike_times, events, trial_idx, dividers, colors, labels, weights=None, fr=True, norm=False,
-                              axs=None):
+    def _cluster_raster(self, cluster_idx, event):
+        if cluster_idx is None:
+            return None
+        return self.compute_cluster_raster(cluster_idx, event)
 
-        pre_time = 0.4
-        post_time = 1
-        raster_bin = 0.01
-        psth_bin = 0.05
-        raster, t_raster = bin_spikes(
-            spike_times, events, pre_time=pre_time, post_time=post_time, bin_size=raster_bin, weights=weights)
-        psth, t_psth = bin_spikes(
-            spike_times, events, pre_time=pre_time, post_time=post_time, bin_size=psth_bin, weights=weights)
+    def single_cluster_raster(self, data, trial_idx, dividers, colors, labels, axs=None, layout=True):
+        # data is the output of bin_raster(). data=None only draws the layout (trial groups and
+        # labels), layout=False only the PSTH and raster.
 
-        if fr:
-            psth = psth / psth_bin
-
-        if norm:
-            psth = psth - np.repeat(psth[:, 0][:, np.newaxis], psth.shape[1], axis=1)
-            raster = raster - np.repeat(raster[:, 0][:, np.newaxis], raster.shape[1], axis=1)
+        post_time = RASTER_POST_TIME
+        raster_bin = RASTER_BIN
+        if data is not None:
+            raster, t_raster, psth, t_psth = data.raster, data.t_raster, data.psth, data.t_psth
 
         dividers = [0] + dividers + [len(trial_idx)]
         if axs is None:
@@ -1016,38 +1561,44 @@ class DataLoader:
                     t_ids = np.r_[t_ids, trial_idx[dividers[idx[iD]] + 1:dividers[idx[iD] + 1] + 1]]
                     t_ints = np.r_[t_ints, dividers[idx[iD] + 1] - dividers[idx[iD]]]
 
-            psth_div = np.nanmean(psth[t_ids], axis=0)
-            std_div = np.nanstd(psth[t_ids], axis=0) / np.sqrt(len(t_ids))
+            if data is not None:
+                psth_div = np.nanmean(psth[t_ids], axis=0)
+                std_div = np.nanstd(psth[t_ids], axis=0) / np.sqrt(len(t_ids))
 
-            axs[0].fill_between(t_psth, psth_div - std_div,
-                                psth_div + std_div, alpha=0.4, color=colors[lid])
-            axs[0].plot(t_psth, psth_div, alpha=1, color=colors[lid])
+                axs[0].fill_between(t_psth, psth_div - std_div,
+                                    psth_div + std_div, alpha=0.4, color=colors[lid])
+                axs[0].plot(t_psth, psth_div, alpha=1, color=colors[lid])
 
             lab_max = idx[np.argmax(t_ints)]
             label_pos.append((dividers[lab_max + 1] - dividers[lab_max]) / 2 + dividers[lab_max])
 
-        axs[1].imshow(raster[trial_idx], cmap='binary', origin='lower',
-                      extent=[np.min(t_raster), np.max(t_raster), 0, len(trial_idx)], aspect='auto')
+        if data is not None:
+            axs[1].imshow(raster[trial_idx], cmap='binary', origin='lower',
+                          extent=[np.min(t_raster), np.max(t_raster), 0, len(trial_idx)], aspect='auto')
 
-        width = raster_bin * 4
-        for iD in range(len(dividers) - 1):
-            axs[1].fill_between([post_time + raster_bin / 2, post_time + raster_bin / 2 + width],
-                                [dividers[iD + 1], dividers[iD + 1]], [dividers[iD], dividers[iD]], color=colors[iD])
+        if layout:
+            width = raster_bin * 4
+            for iD in range(len(dividers) - 1):
+                axs[1].fill_between([post_time + raster_bin / 2, post_time + raster_bin / 2 + width],
+                                    [dividers[iD + 1], dividers[iD + 1]], [dividers[iD], dividers[iD]], color=colors[iD])
 
-        axs[1].set_xlim([-1 * pre_time, post_time + raster_bin / 2 + width])
-        secax = axs[1].secondary_yaxis('right')
+            axs[1].set_xlim([-1 * RASTER_PRE_TIME, post_time + raster_bin / 2 + width])
+            secax = axs[1].secondary_yaxis('right')
 
-        secax.set_yticks(label_pos)
-        secax.set_yticklabels(label, rotation=90,
-                              rotation_mode='anchor', ha='center')
-        for ic, c in enumerate(np.array(colors)[lidx]):
-            secax.get_yticklabels()[ic].set_color(c)
+            secax.set_yticks(label_pos)
+            secax.set_yticklabels(label, rotation=90,
+                                  rotation_mode='anchor', ha='center')
+            for ic, c in enumerate(np.array(colors)[lidx]):
+                secax.get_yticklabels()[ic].set_color(c)
 
-        remove_spines(axs[1], spines=['right', 'top'])
-        remove_spines(axs[0], spines=['right', 'top'])
+            remove_spines(axs[1], spines=['right', 'top'])
+            remove_spines(axs[0], spines=['right', 'top'])
 
-        axs[0].axvline(0, *axs[0].get_ylim(), c='k', ls='--', zorder=10)  # TODO this doesn't always work
-        axs[1].axvline(0, *axs[1].get_ylim(), c='k', ls='--', zorder=10)
+        if data is not None:
+            axs[0].axvline(0, *axs[0].get_ylim(), c='k', ls='--', zorder=10)  # TODO this doesn't always work
+        if layout:
+            # The raster extent, also when the layout is drawn before the raster itself.
+            axs[1].axvline(0, 0, len(trial_idx), c='k', ls='--', zorder=10)
 
         return fig, axs
 
@@ -1172,10 +1723,7 @@ class DataLoader:
         else:
             fig = ax.get_figure()
 
-        spikes = filter_spikes_by_cluster_idx(self.spikes, cluster_idx)
-
-        x_corr = xcorr(spikes.times, spikes.clusters, 1 / 1e3, 50 / 1e3)
-        corr = x_corr[0, 0, :]
+        corr = self.compute_autocorrelogram(cluster_idx).corr
         # m_corr = np.max(corr)
         # if m_corr == 0:
         #     m_corr = 1
@@ -1192,10 +1740,9 @@ class DataLoader:
         else:
             fig = ax.get_figure()
 
-        spikes = filter_spikes_by_cluster_idx(self.spikes, cluster_idx)
-
-        isi, bins = _compute_histogram(np.diff(spikes.times), 0.01, 0, 50)
-        bins = bins * 1e3
+        data = self.compute_inter_spike_interval(cluster_idx)
+        isi = data.isi
+        bins = data.bins * 1e3
         # m_isi = np.max(isi)
         # if m_isi == 0:
         #     m_isi = 1
@@ -1205,20 +1752,20 @@ class DataLoader:
 
         return fig
 
-    def plot_cluster_amplitude(self, cluster_idx, ax=None, xlabel='T in session (s)', ylabel='Amp (uV)'):
+    def plot_cluster_amplitude(self, cluster_idx, ax=None, ax_twin=None, xlabel='T in session (s)', ylabel='Amp (uV)'):
 
         if ax is None:
             fig, ax = plt.subplots(1, 1, figsize=(5, 5))
         else:
             fig = ax.get_figure()
 
-        spikes = filter_spikes_by_cluster_idx(self.spikes, cluster_idx)
+        spikes = self.compute_cluster_spikes(cluster_idx)
         clusters = filter_clusters_by_cluster_idx(self.clusters, cluster_idx)
         amp_norm = self.rms_chns[clusters.channels]
 
         ax.scatter(spikes.times, spikes.amps * 1e6, color='grey', s=2)
-        ax.set_xlim(-10, np.max(self.spikes.times))
-        ax2 = ax.twinx()
+        ax.set_xlim(-10, self.compute_session_duration().duration)
+        ax2 = ax.twinx() if ax_twin is None else ax_twin
         ax2.scatter(spikes.times, spikes.amps / amp_norm, color='grey', s=0)
 
         ax.spines['top'].set_visible(False)
@@ -0,0 +1,244 @@
+# -------------------------------------------------------------------------------------------------
+# Imports
+# -------------------------------------------------------------------------------------------------
+
+import argparse
+import shlex
+import subprocess
+import tarfile
+
+from generator import *
+from generator import _file_lock
+
+
+# -------------------------------------------------------------------------------------------------
+# CONSTANTS
+# -------------------------------------------------------------------------------------------------
+
+# Index of the published files {path: hash} in the cache folder of the server.
+INDEX_NAME = 'publish.json'
+
+# Command running this script on the server, in the folder where the website repository is
+# deployed (`--remote-repo`, or the environment variable REMOTE_REPO_ENV).
+REMOTE_COMMAND = 'cd {repo} && python3 publish.py'
+REMOTE_REPO_ENV = 'IBL_REMOTE_REPO'
+
+_OBJECT_REGEX = re.compile(r'_objects/[0-9a-f]{2}/([0-9a-f]{40})(\.\w+)?')
+
+
+# -------------------------------------------------------------------------------------------------
+# Index
+# -------------------------------------------------------------------------------------------------
+
+def local_index():
+    """Return the files published from the cache {path: hash}: the artifacts recorded in the
+    session manifests, the previews of the figures not generated yet, and the catalogue (last, so
+    that it only lists published sessions)."""
+    files = {}
+    for path in sorted(CACHE_DIR.glob('*/manifest.json')):
+        pid = path.parent.name
+        for name, entry in load_json(path).get('artifacts', {}).items():
+            if 'hash' in entry and (path.parent / name).exists():
+                files[f'{pid}/{name}'] = entry['hash']
+    # The previews are not recorded in the manifests, and are removed once the figure is saved.
+    for path in sorted(CACHE_DIR.glob('*/*.preview.png')):
+        if is_valid_uuid(path.parent.name):
+            files[f'{path.parent.name}/{path.name}'] = file_hash(path)
+    if catalogue_path().exists():
+        files[catalogue_path().name] = file_hash(catalogue_path())
+    return files
+
+
+def read_index(root):
+    path = Path(root) / INDEX_NAME
+    return load_json(path).get('files', {}) if path.exists() else {}
+
+
+def target_object(root, name, digest):
+    """Path of the stored object of a published file in a cache folder."""
+    return Path(root) / object_path(digest, Path(name).suffix).relative_to(CACHE_DIR)
+
+
+# -------------------------------------------------------------------------------------------------
+# Archive
+# -------------------------------------------------------------------------------------------------
+
+def _add_file(tar, name, f, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = time.time()
+    tar.addfile(info, f)
+
+
+def write_archive(f, files, remote):
+    """Write a tar stream with the objects of the files missing on the target, followed by the new
+    index. Return the number of bytes of the objects sent."""
+    known = {(digest, Path(name).suffix) for name, digest in remote.items()}
+    sent = 0
+    with tarfile.open(fileobj=f, mode='w|') as tar:
+        for name, digest in files.items():
+            key = (digest, Path(name).suffix)
+            if key in known:
+                continue
+            known.add(key)
+            # The artifacts are not linked to stored objects on file systems without hard links.
+            src = object_path(*key)
+            src = src if src.exists() else CACHE_DIR / name
+            size = src.stat().st_size
+            with open(src, 'rb') as fs:
+                _add_file(tar, str(target_object('', name, digest)), fs, size)
+            sent += size
+        data = json.dumps({'files': files}).encode()
+        _add_file(tar, INDEX_NAME, io.BytesIO(data), len(data))
+    return sent
+
+
+def receive(root, f):
+    """Apply a stream written by write_archive() to a cache folder: store the new objects, then
+    link the published files to them."""
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    files = None
+    with _file_lock(root / INDEX_NAME):
+        with tarfile.open(fileobj=f, mode='r|') as tar:
+            for member in tar:
+                if member.name == INDEX_NAME:
+                    files = json.load(tar.extractfile(member))['files']
+                    continue
+                m = _OBJECT_REGEX.fullmatch(member.name)
+                if not m or not member.isfile():
+                    raise ValueError(f"unexpected archive member `{member.name}`")
+                data = tar.extractfile(member).read()
+                if hashlib.sha1(data).hexdigest() != m.group(1):
+                    raise ValueError(f"corrupted object `{member.name}`")
+                path = root / member.name
+                path.parent.mkdir(parents=True, exist_ok=True)
+                with atomic_write(path) as tmp:
+                    tmp.write_bytes(data)
+        if files is None:
+            raise ValueError("the archive has no index")
+        apply_index(root, files)
+
+
+def apply_index(root, files):
+    """Link the changed files to their stored object, remove the files no longer published and
+    their objects, and replace the index last.
+
+    The server reads the files, not the index, and each file is replaced atomically so that it is
+    never served partially written. The publication as a whole is not atomic: during the update,
+    the server may serve some files of a session already updated next to older ones, and the
+    catalogue, linked after the artifacts, may still list removed sessions. The index only records
+    what was published for the next publication."""
+    old = read_index(root)
+    missing = [name for name, digest in files.items() if not target_object(root, name, digest).exists()]
+    if missing:
+        raise ValueError(f"{len(missing)} objects are missing on the target, for example the one of {missing[0]}")
+
+    changed = [name for name, digest in files.items() if old.get(name, None) != digest or not (root / name).exists()]
+    for name in changed:
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        link_file(target_object(root, name, files[name]), path)
+
+    removed = sorted(old.keys() - files.keys())
+    for name in removed:
+        path = root / name
+        path.unlink(missing_ok=True)
+        if path.parent != root and path.parent.exists() and not any(path.parent.iterdir()):
+            path.parent.rmdir()
+    save_json(root / INDEX_NAME, {'files': files, 'date': datetime.now()})
+
+    # Remove the objects of the previous versions that no published file refers to. The link count
+    # cannot tell, the files are copies of the objects on file systems without hard links.
+    published = {(digest, Path(name).suffix) for name, digest in files.items()}
+    for name in removed + changed:
+        if name in old and (old[name], Path(name).suffix) not in published:
+            target_object(root, name, old[name]).unlink(missing_ok=True)
+    logger.info(f"Published {len(changed)} changed files and removed {len(removed)} files in {root}")
+
+
+# -------------------------------------------------------------------------------------------------
+# Target
+# -------------------------------------------------------------------------------------------------
+
+class Target:
+    """Cache folder of the server, local or `host:path` reached with ssh, which receives the archive stream of
+    this script run in the website repository `remote_repo` of the host (see REMOTE_COMMAND)."""
+
+    def __init__(self, spec, remote_repo=None):
+        host, sep, path = spec.partition(':')
+        if sep and '/' not in host:
+            self.host, self.path = host, path
+        else:
+            self.host, self.path = None, str(Path(spec).resolve())
+        if self.host is not None and not remote_repo:
+            raise ValueError(f"the folder of the website repository on {self.host} is needed to publish there, "
+                             f"set it with --remote-repo or {REMOTE_REPO_ENV}")
+        self.remote_command = REMOTE_COMMAND.format(repo=shlex.quote(remote_repo)) if remote_repo else None
+
+    def command(self, *args):
+        if self.host is None:
+            return [sys.executable, str(Path(__file__).resolve()), *args]
+        return ['ssh', self.host, ' '.join([self.remote_command] + [shlex.quote(arg) for arg in args])]
+
+    def index(self):
+        out = subprocess.run(self.command('--print-index', self.path), stdout=subprocess.PIPE, check=True).stdout
+        return json.loads(out)
+
+    def send(self, files, remote):
+        proc = subprocess.Popen(self.command('--receive', self.path), stdin=subprocess.PIPE)
+        try:
+            sent = write_archive(proc.stdin, files, remote)
+            proc.stdin.close()
+        except BrokenPipeError:  # the receiving end failed, see its error
+            sent = 0
+        if proc.wait() != 0:
+            raise RuntimeError(f"publishing to {self.host or 'localhost'}:{self.path} failed")
+        return sent
+
+
+def publish(target, dry_run=False):
+    """Send the artifacts that changed since the last publication to the target."""
+    files = local_index()
+    remote = target.index()
+    changed = [name for name, digest in files.items() if remote.get(name, None) != digest]
+    removed = sorted(remote.keys() - files.keys())
+    logger.info(f"{len(changed)} changed and {len(removed)} removed files out of {len(files)} published files")
+    if dry_run:
+        for name in changed:
+            print(f"+ {name}")
+        for name in removed:
+            print(f"- {name}")
+        return
+    if not changed and not removed:
+        return
+    t0 = time.perf_counter()
+    sent = target.send(files, remote)
+    logger.info(f"Sent {format_size(sent)} in {time.perf_counter() - t0:.1f} s")
+
+
+# -------------------------------------------------------------------------------------------------
+# Entry point
+# -------------------------------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Publish the changed artifacts of the cache to the server.')
+    parser.add_argument('target', help='cache folder of the server, `host:path` on a remote host')
+    parser.add_argument('--dry-run', action='store_true', help='print the changed and removed files')
+    parser.add_argument('--remote-repo', default=os.environ.get(REMOTE_REPO_ENV, None),
+                        help=f'folder of the website repository on the host ({REMOTE_REPO_ENV} by default)')
+    parser.add_argument('--receive', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--print-index', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Receiving end, run on the target.
+    if args.receive:
+        receive(args.target, sys.stdin.buffer)
+    elif args.print_index:
+        sys.stdout.write(json.dumps(read_index(args.target)))
+    else:
+        try:
+            target = Target(args.target, remote_repo=args.remote_repo)
+        except ValueError as e:
+            parser.error(str(e))
+        publish(target, dry_run=args.dry_run)
@@ -38,6 +38,21 @@ function tob64(buffer) {
 
 
 
+function decodeArrays(buffer, descr) {
+    // Return typed array views on the arrays of a binary file, described by
+    // {name: {dtype, shape, offset}} (see save_arrays() in generator.py).
+    var arrays = {};
+    for (let name in descr) {
+        let d = descr[name];
+        let vt = _DTYPE_MAPPING[d.dtype][0];
+        let count = d.shape.reduce((a, b) => a * b, 1);
+        arrays[name] = new vt(buffer, d.offset, count);
+    }
+    return arrays;
+}
+
+
+
 /*************************************************************************************************/
 /*  Array class                                                                                  */
 /*************************************************************************************************/
@@ -585,18 +585,22 @@ async function selectSession(pid) {
     var r = await fetch(url);
     var details = await r.json();
 
-    // Pop the cluster ids into a new variable
+    // The per-trial and per-cluster arrays are in a binary file described by details["_arrays"].
+    r = await fetch(`/api/session/${pid}/arrays`);
+    var arrays = decodeArrays(await r.arrayBuffer(), details["_arrays"]);
 
     // NOTE: these fields start with a leading _ so will be ignored by tablefromjson
     // which controls which fields are displayed in the session details box.
-    var trial_ids = details['_trial_ids']
-    var cluster_ids = details["_cluster_ids"];
-    var acronyms = details["_acronyms"];
-    var colors = details["_colors"];
+    var trial_ids = Array.from(arrays["trial_ids"]);
+    var cluster_ids = Array.from(arrays["cluster_ids"]);
+    // The acronyms are encoded as indices in the dictionary details["_acronyms"].
+    var acronyms = Array.from(arrays["acronyms"], (i) => details["_acronyms"][i]);
+    var colors = cluster_ids.map((_, i) => arrays["colors"].subarray(3 * i, 3 * i + 3));
     CTX.dur = details["_duration"];
     CTX.trial_ids = trial_ids;
-    CTX.trial_onsets = details["_trial_onsets"];
-    CTX.trial_offsets = details["_trial_offsets"];
+    // NaN intervals of the trials without stimulus or feedback times are null as before.
+    CTX.trial_onsets = Array.from(arrays["trial_onsets"], (t) => isNaN(t) ? null : t);
+    CTX.trial_offsets = Array.from(arrays["trial_offsets"], (t) => isNaN(t) ? null : t);
 
     // Make table with session details.
     fillVerticalTable(details, 'sessionDetails')
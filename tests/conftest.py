@@ -0,0 +1,32 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import generator  # noqa: E402
+import plots.static_plots as static_plots  # noqa: E402
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    """Empty cache folder in a temporary directory, with the cache paths of the generator."""
+    root = tmp_path / 'cache'
+    root.mkdir()
+    paths = {
+        'CACHE_DIR': root,
+        'EID_CACHE_DIR': root / '_eids',
+        'OBJECTS_DIR': root / '_objects',
+        'FITS_DIR': root / '_fits',
+        'DIGESTS_DIR': root / '_digests',
+        'LEASE_DIR': root / '_leases',
+        'DATA_DIR': tmp_path / 'data',
+        'SHARED_DIR': tmp_path / 'shared',
+    }
+    for name, path in paths.items():
+        monkeypatch.setattr(generator, name, path)
+    monkeypatch.setattr(generator, '_digests', {})
+    monkeypatch.setattr(static_plots, 'DATA_DIR', paths['DATA_DIR'])
+    monkeypatch.setattr(static_plots, '_tables', {})
+    return root
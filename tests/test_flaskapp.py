@@ -0,0 +1,61 @@
+import os
+
+import pytest
+
+import flaskapp
+from generator import item_details_path, preview_path, save_json, trial_overview_path
+
+PID = 'decc8d40-cf74-4263-ae9d-a0cc68b47e86'
+
+
+@pytest.fixture
+def client(cache):
+    flaskapp._load_item_details.cache_clear()
+    yield flaskapp.make_app().test_client()
+    flaskapp._load_item_details.cache_clear()
+
+
+def _details(version):
+    return {'trials': {'0': {'version': version}, '4': {'trial_idx': 4}}, 'clusters': {'2': {'version': version}}}
+
+
+def test_item_details(client):
+    save_json(item_details_path(PID), _details(1))
+    assert client.get(f'/api/session/{PID}/trial_details/0').json == {'version': 1}
+    assert client.get(f'/api/session/{PID}/trial_details/4').json == {'trial_idx': 4}
+    assert client.get(f'/api/session/{PID}/cluster_details/2').json == {'version': 1}
+    assert client.get(f'/api/session/{PID}/trial_details/7').json == {}
+    # The file is loaded once.
+    info = flaskapp._load_item_details.cache_info()
+    assert info.misses == 1 and info.hits == 3
+
+
+def test_item_details_replaced(client):
+    path = item_details_path(PID)
+    save_json(path, _details(1))
+    assert client.get(f'/api/session/{PID}/trial_details/0').json == {'version': 1}
+    stat = path.stat()
+    save_json(path, _details(2))
+    # A new file with the same modification time is detected by its inode.
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert path.stat().st_ino != stat.st_ino
+    assert client.get(f'/api/session/{PID}/trial_details/0').json == {'version': 2}
+    assert client.get(f'/api/session/{PID}/cluster_details/2').json == {'version': 2}
+
+
+def test_item_details_missing(client):
+    assert client.get(f'/api/session/{PID}/trial_details/0').json == {}
+    assert client.get(f'/api/session/{PID}/cluster_details/0').json == {}
+    assert flaskapp.item_details(PID) == {}
+
+
+def test_figure_preview(client):
+    # The preview is served until the full-quality figure is saved.
+    url = f'/api/session/{PID}/trial_plot/3'
+    assert client.get(url).status_code == 404
+    path = trial_overview_path(PID, 3)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    preview_path(path).write_bytes(b'preview')
+    assert client.get(url).data == b'preview'
+    path.write_bytes(b'full')
+    assert client.get(url).data == b'full'
@@ -0,0 +1,800 @@
+import json
+import os
+import time
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import pytest
+from iblutil.util import Bunch
+from PIL import Image
+
+import generator
+from generator import (
+    AccessPriority, Generator, DataLoader, FIGURES, Leases, LEASE_RUN_RETENTION, LEASE_TIMEOUT, Manifest, PNGEncoder,
+    ProductStore, PREVIEW_DPI, Scheduler, SNAPSHOT_ARRAYS, SNAPSHOT_RENDER_EXCLUDE, Task, Tracer, Watcher,
+    atomic_write, behaviour_fits_key, cluster_pixels, code_fingerprint, collect_garbage, decode_arrays, fits_cache_path,
+    inputs_fingerprint, load_session, object_path, orphan_objects, parse_args, preview_path, products_fingerprint,
+    products_path, render_rgba, save_arrays, save_json, session_cache_path, store_object)
+
+PID = 'decc8d40-cf74-4263-ae9d-a0cc68b47e86'
+EID = 'aaaaaaaa-cf74-4263-ae9d-a0cc68b47e86'
+OTHER_PID = 'bbbbbbbb-cf74-4263-ae9d-a0cc68b47e86'
+
+
+def _write(path, data=b'data'):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    return path
+
+
+# -------------------------------------------------------------------------------------------------
+# Leases
+# -------------------------------------------------------------------------------------------------
+
+def _expire(path):
+    past = time.time() - LEASE_TIMEOUT - 10
+    os.utime(path, (past, past))
+
+
+def test_leases_acquire_exclusive(tmp_path):
+    a, b = Leases(tmp_path, node='a'), Leases(tmp_path, node='b')
+    assert a.acquire(PID)
+    assert not b.acquire(PID)
+    a.release(PID)
+    assert not (tmp_path / f'{PID}.lease').exists()
+    assert b.acquire(PID)
+    assert json.loads((tmp_path / f'{PID}.lease').read_text())['node'] == 'b'
+
+
+def test_leases_reclaim_expired(tmp_path):
+    a, b = Leases(tmp_path, node='a'), Leases(tmp_path, node='b')
+    assert a.acquire(PID)
+    _expire(tmp_path / f'{PID}.lease')
+    assert b.acquire(PID)
+    assert json.loads((tmp_path / f'{PID}.lease').read_text())['node'] == 'b'
+    assert sorted(p.name for p in tmp_path.iterdir()) == [f'{PID}.lease']
+
+
+def test_leases_reclaim_renewed(tmp_path):
+    # A lease renewed after the expiry check is put back.
+    a, b = Leases(tmp_path, node='a'), Leases(tmp_path, node='b')
+    assert a.acquire(PID)
+    path = tmp_path / f'{PID}.lease'
+    assert not b._reclaim(path)
+    assert json.loads(path.read_text())['node'] == 'a'
+    assert sorted(p.name for p in tmp_path.iterdir()) == [f'{PID}.lease']
+
+
+def test_leases_reclaim_removed(tmp_path):
+    # A lease released in the meantime can be acquired.
+    b = Leases(tmp_path, node='b')
+    assert b._reclaim(tmp_path / f'{PID}.lease')
+
+
+def test_leases_done_markers(tmp_path):
+    a = Leases(tmp_path, node='a', run='run-1')
+    assert a.acquire(PID)
+    a.release(PID, done=True)
+    assert a.is_done(PID)
+    assert not Leases(tmp_path, node='b', run='run-2').is_done(PID)
+    assert not Leases(tmp_path, node='b').is_done(PID)
+
+
+def test_leases_release_not_done(tmp_path):
+    a = Leases(tmp_path, node='a', run='run-1')
+    assert a.acquire(PID)
+    a.release(PID, done=False)
+    assert not a.is_done(PID)
+    assert not (tmp_path / f'{PID}.lease').exists()
+
+
+def test_leases_release_reclaimed(tmp_path):
+    # A stalled node does not remove the lease reclaimed by another node, nor mark the session as done.
+    a, b = Leases(tmp_path, node='a', run='run-1'), Leases(tmp_path, node='b', run='run-1')
+    assert a.acquire(PID)
+    path = tmp_path / f'{PID}.lease'
+    _expire(path)
+    assert b.acquire(PID)
+    assert not a.release(PID, done=True)
+    assert json.loads(path.read_text())['node'] == 'b'
+    assert not a.is_done(PID)
+    assert PID not in a.held and a.pop_lost() == {PID}
+    assert b.release(PID)
+    assert not path.exists()
+
+
+def test_leases_renew_reclaimed(tmp_path):
+    a, b = Leases(tmp_path, node='a'), Leases(tmp_path, node='b')
+    assert a.acquire(PID) and a.acquire(OTHER_PID)
+    path = tmp_path / f'{PID}.lease'
+    _expire(path)
+    assert b.acquire(PID)
+    _expire(path)
+    a.renew()
+    # The lease of the other node is not renewed, the lease still owned is.
+    assert time.time() - path.stat().st_mtime > LEASE_TIMEOUT
+    assert time.time() - (tmp_path / f'{OTHER_PID}.lease').stat().st_mtime < LEASE_TIMEOUT
+    assert a.held == {OTHER_PID}
+    assert a.pop_lost() == {PID} and a.pop_lost() == set()
+
+
+# -------------------------------------------------------------------------------------------------
+# Session arrays
+# -------------------------------------------------------------------------------------------------
+
+def test_save_arrays_roundtrip(tmp_path):
+    arrays = {
+        'trial_ids': np.arange(5, dtype=np.int64),
+        'codes': np.array([1, 2, 3], dtype=np.uint8),
+        'intervals': np.random.rand(4, 2).astype(np.float32),
+        'big_endian': np.arange(3, dtype='>i4'),
+        'empty': np.array([], dtype=np.float64),
+    }
+    path = tmp_path / 'session.bin'
+    descr = save_arrays(path, arrays)
+    # The arrays are aligned on 8 bytes for the typed arrays of the browser.
+    assert all(d['offset'] % 8 == 0 for d in descr.values())
+    out = decode_arrays(path.read_bytes(), json.loads(json.dumps(descr)))
+    assert sorted(out.keys()) == sorted(arrays.keys())
+    for name, arr in arrays.items():
+        assert out[name].shape == arr.shape
+        np.testing.assert_array_equal(out[name], arr)
+
+
+# -------------------------------------------------------------------------------------------------
+# Cluster pixels
+# -------------------------------------------------------------------------------------------------
+
+def _cluster_loader():
+    """Session with the data drawn in the layout of the cluster figure."""
+    rng = np.random.default_rng(0)
+    n_trials, n_clusters = 30, 20
+    contrast = rng.choice([0, 0.25, 1], n_trials)
+    left = rng.random(n_trials) < 0.5
+    dl = DataLoader.__new__(DataLoader)
+    dl.trials = Bunch(
+        probabilityLeft=np.repeat([0.5, 0.8, 0.2], 10), contrastLeft=np.where(left, contrast, np.nan),
+        contrastRight=np.where(left, np.nan, contrast), feedbackType=rng.choice([-1., 1.], n_trials),
+        choice=rng.choice([-1., 1.], n_trials), goCue_times=np.arange(n_trials) * 5.,
+        response_times=np.arange(n_trials) * 5. + 1)
+    dl.channels = Bunch(brainLocationIds_ccf_2017=np.repeat([382, 385, 726, 1020], 96),
+                        localCoordinates=np.c_[np.zeros(384), np.arange(384) * 10.])
+    dl.clusters_good = Bunch(
+        cluster_id=np.arange(n_clusters), amps=rng.uniform(2e-5, 6e-4, n_clusters),
+        depths=rng.uniform(0, 3800, n_clusters), atlas_id=rng.choice([382, 385, 726], n_clusters))
+    dl.amp_lim, dl.depth_lim = [-10, 800], [0, 4000]
+    return dl
+
+
+def test_cluster_pixels():
+    # The positions computed from the layout match those of the scatter plot of the cluster figure.
+    dl = _cluster_loader()
+    gen = Generator.__new__(Generator)
+    gen.dl = dl
+    template = gen.make_cluster_template()
+    fig, ax = template.fig, template.axs[0]
+    fig.canvas.draw()
+    idx = np.argsort(dl.clusters_good.depths)[::-1]
+    pixels = ax.transData.transform(np.c_[dl.clusters_good.amps[idx] * 1e6, dl.clusters_good.depths[idx]])
+    pixels /= fig.canvas.get_width_height()
+    df = cluster_pixels(dl)
+    template.close()
+    np.testing.assert_array_equal(df.cluster_id, dl.clusters_good.cluster_id[idx])
+    np.testing.assert_allclose(df[['x', 'y']].values, pixels, atol=1e-9)
+
+
+def test_cluster_pixels_code_fingerprint(monkeypatch):
+    # The cluster positions are stale when the layout of the cluster figure changes.
+    before = {kind: code_fingerprint(kind) for kind in ('cluster_pixels', 'session')}
+    code_fingerprint.cache_clear()
+    monkeypatch.setattr(generator, 'CLUSTER_GRID', dict(generator.CLUSTER_GRID, top=0.9))
+    try:
+        assert code_fingerprint('cluster_pixels') != before['cluster_pixels']
+        assert code_fingerprint('session') == before['session']
+    finally:
+        code_fingerprint.cache_clear()
+
+
+# -------------------------------------------------------------------------------------------------
+# Scheduler
+# -------------------------------------------------------------------------------------------------
+
+def test_scheduler_next_task_siblings():
+    # A worker done with a session takes another probe of the same session (eid) first.
+    pids = {'a1': 'a', 'a2': 'a', 'b1': 'b', 'b2': 'b', 'c1': 'c'}
+    scheduler = Scheduler(pids)
+    scheduler.eids = dict(pids)
+    scheduler.memory = {pid: 0 for pid in pids}
+    costs = {'a1': 4, 'a2': 3, 'b1': 5, 'b2': 1, 'c1': 10}
+    scheduler.tasks = {pid: [Task(pid=pid, fig=1, cost=cost)] for pid, cost in costs.items()}
+    assert scheduler.next_task(0).pid == 'c1'
+    assert scheduler.next_task(1).pid == 'b1'
+    assert scheduler.next_task(1).pid == 'b2'
+    assert scheduler.next_task(0).pid == 'a1'
+    assert scheduler.next_task(0).pid == 'a2'
+
+
+def test_scheduler_next_task_details():
+    # Only the first worker loading a session saves its details, the others wait until it is done.
+    scheduler = Scheduler(['a'])
+    scheduler.eids = {'a': 'a'}
+    scheduler.memory = {'a': 0}
+    scheduler.tasks = {'a': [Task(pid='a', fig=3, cost=1) for _ in range(3)]}
+    scheduler.running = {0: None, 1: None}
+    task = scheduler.next_task(0)
+    assert task.details
+    scheduler.running[0] = task
+    assert scheduler.next_task(1) is None
+    scheduler.opened.add('a')
+    assert not scheduler.next_task(1).details
+
+
+def test_make_all_plots_session_details(monkeypatch):
+    # Figure 0 saves the session, trial and cluster details again, although they are up to date.
+    calls = []
+    for name in ('save_session_details', 'save_item_details', 'save_cluster_pixels'):
+        monkeypatch.setattr(Generator, name, lambda self, force=False, name=name: calls.append((name, force)))
+    monkeypatch.setattr(Generator, 'save_manifest', lambda self: None)
+    gen = Generator.__new__(Generator)
+    gen.render_only = False
+    gen.make_figure(0)
+    assert calls == []
+    gen.make_all_plots(nums=[0])
+    assert calls == [('save_session_details', True), ('save_item_details', True), ('save_cluster_pixels', True)]
+
+
+def _priority(tmp_path):
+    log = tmp_path / 'access.log'
+    log.write_text('\n'.join([
+        f'127.0.0.1 - - [01/Jan/2024:00:00:00] "GET /api/session/{PID}/trial_plot/7 HTTP/1.1" 200 10',
+        json.dumps({'path': f'/api/session/{PID}/trial_plot/7?preview=1'}),
+        json.dumps({'url': f'/api/session/{PID}/trial_plot/3'}),
+        json.dumps({'path': f'/api/session/{PID}/session_plot'}),
+        json.dumps({'path': f'/api/session/{OTHER_PID}/cluster_plot/2'}),
+        json.dumps({'path': f'/api/session/{OTHER_PID}/unknown'}),
+        'not a request',
+    ]))
+    return AccessPriority([log])
+
+
+def test_access_priority(tmp_path):
+    priority = _priority(tmp_path)
+    assert priority.sessions == {PID: 4, OTHER_PID: 1}
+    assert priority.figures == {(PID, 3): 3, (PID, 1): 1, (OTHER_PID, 5): 1}
+    assert priority.hot_items(PID, 3) == [7, 3]
+    assert priority.hot_items(PID, 5) == []
+    assert priority.item_hits(PID, 3, [3, 7, 8]) == 3
+    # Most requested artifacts first.
+    assert priority.top(1) == {PID: {3: [7]}}
+    assert priority.top(10) == {PID: {3: [7, 3], 1: None}, OTHER_PID: {5: [2]}}
+
+
+def test_scheduler_session_tasks_priority(tmp_path, monkeypatch):
+    monkeypatch.setattr(generator, 'session_size', lambda pid, eid=None: (1000, 120, 10))
+    scheduler = Scheduler([PID], nums=[3], chunk_size=50, priority=_priority(tmp_path))
+    tasks = scheduler.session_tasks(PID, EID)
+    assert sorted({task.fig for task in tasks}) == list(FIGURES)
+    # The requested trials are generated first, and left out of the ranges of the trial tasks.
+    assert (tasks[0].fig, tasks[0].idxs, tasks[0].hits) == (3, [7, 3], 3)
+    assert tasks[1].fig == 1
+    trials = [task for task in tasks if task.fig == 3]
+    assert [(task.get('start', None), task.get('stop', None)) for task in trials] == [
+        (None, None), (0, 50), (50, 100), (100, None)]
+    assert sum(task.cost for task in tasks) == pytest.approx(1000 * 10)
+
+    # The ids of the tasks of a figure are the existing trials, each one in a single task.
+    gen = Bunch(trial_idxs=list(range(130)), cluster_idxs=[])
+    idxs = [task.resolve(gen) for task in trials]
+    assert idxs[0] == [7, 3]
+    assert sorted(sum(idxs, [])) == list(range(130))
+    gen.trial_idxs = [3, 8]
+    assert trials[0].resolve(gen) == [3]
+    assert Task(pid=PID, fig=1).resolve(gen) is None
+
+
+@pytest.mark.parametrize('argv, command, nums', [
+    ([], None, None),
+    (['1,3'], 'force', [1, 3]),
+    (['--top', '5', '0'], 'force', [0]),
+    ([PID], 'session', None),
+    (['--trace', 'trace.json', PID], 'session', None),
+    (['render', '1,3'], 'render', [1, 3]),
+    (['distributed'], 'distributed', ()),
+])
+def test_parse_args_shortcuts(monkeypatch, argv, command, nums):
+    args = parse_args(argv)
+    assert args.command == command
+    if command == 'session':
+        assert args.pid == PID
+    if nums is None:
+        return
+    assert args.figures == nums
+    # Forcing some figures lists the tasks of all figures (the others are only made if stale),
+    # and figure 0 only saves the session details.
+    monkeypatch.setattr(generator, 'session_size', lambda pid, eid=None: (1, 1, 1))
+    monkeypatch.setattr(generator, 'stale_artifacts', lambda pid: {})
+    tasks = Scheduler([PID], nums=nums).session_tasks(PID, EID)
+    assert sorted(task.fig for task in tasks) == ([0] if 0 in nums else list(FIGURES) if nums else [])
+
+
+# -------------------------------------------------------------------------------------------------
+# Manifest
+# -------------------------------------------------------------------------------------------------
+
+def _artifact(cache):
+    trials = generator.DATA_DIR / EID / 'trials.table.pqt'
+    trials.parent.mkdir(parents=True)
+    trials.write_bytes(b'trials')
+    path = session_cache_path(PID) / 'behaviour.png'
+    path.write_text('{}')
+    return trials, path
+
+
+def test_manifest_is_stale(cache):
+    trials, path = _artifact(cache)
+    manifest = Manifest(PID, EID)
+    assert manifest.is_stale(path, 'behaviour')
+    manifest.add(path, 'behaviour')
+    manifest.save()
+    assert not Manifest(PID, EID).is_stale(path, 'behaviour')
+
+    # A new modification time of the inputs without a change of their content.
+    os.utime(trials, (time.time() + 10, time.time() + 10))
+    assert not Manifest(PID, EID).is_stale(path, 'behaviour')
+
+    trials.write_bytes(b'new trials')
+    assert Manifest(PID, EID).is_stale(path, 'behaviour')
+
+
+def test_manifest_is_stale_code(cache):
+    _, path = _artifact(cache)
+    manifest = Manifest(PID, EID)
+    manifest.add(path, 'behaviour')
+    manifest.save()
+    data = json.loads(manifest.path.read_text())
+    data['artifacts'][path.name]['code'] = 'old'
+    manifest.path.write_text(json.dumps(data))
+    assert Manifest(PID, EID).is_stale(path, 'behaviour')
+
+
+def test_manifest_is_stale_missing(cache):
+    _, path = _artifact(cache)
+    manifest = Manifest(PID, EID)
+    manifest.add(path, 'behaviour')
+    manifest.save()
+    path.unlink()
+    assert Manifest(PID, EID).is_stale(path, 'behaviour')
+
+
+def _linked_artifacts(cache):
+    # The same figure of two probes recorded in their manifests.
+    _, path = _artifact(cache)
+    other = _write(session_cache_path(OTHER_PID) / 'behaviour.png', b'{}')
+    for pid, artifact in ((PID, path), (OTHER_PID, other)):
+        manifest = Manifest(pid, EID)
+        manifest.add(artifact, 'behaviour')
+        manifest.save()
+    return path, other
+
+
+def test_manifest_add_shared_object(cache):
+    # Identical artifacts are links to one stored object.
+    path, other = _linked_artifacts(cache)
+    digest = Manifest(PID, EID).artifacts[path.name]['hash']
+    assert Manifest(OTHER_PID, EID).artifacts[other.name]['hash'] == digest
+    obj = object_path(digest, '.png')
+    assert os.path.samefile(path, other) and os.path.samefile(path, obj)
+    assert obj.stat().st_nlink == 3
+    # Storing an artifact again does not change it.
+    assert store_object(path) == digest
+    assert obj.stat().st_nlink == 3
+
+
+def test_store_object_overwrite(cache):
+    # An artifact written again is replaced, which leaves the object and the other link untouched.
+    path, other = _linked_artifacts(cache)
+    obj = object_path(store_object(path), '.png')
+    with atomic_write(path) as tmp:
+        tmp.write_text('new')
+    assert other.read_text() == obj.read_text() == '{}'
+    new = object_path(store_object(path), '.png')
+    assert new != obj and os.path.samefile(path, new) and path.read_text() == 'new'
+    assert obj.stat().st_nlink == 2 and os.path.samefile(other, obj)
+
+
+def test_unlink_orphan_object(cache):
+    # An object is removed by the garbage collection once no artifact links to it.
+    generator.DATA_DIR.mkdir(parents=True, exist_ok=True)
+    pd.DataFrame({'pid': [PID, OTHER_PID], 'eid': [EID, EID]}).to_parquet(generator.DATA_DIR / 'session.table.pqt')
+    path, other = _linked_artifacts(cache)
+    obj = object_path(store_object(path), '.png')
+    path.unlink()
+    assert orphan_objects() == []
+    other.unlink()
+    assert orphan_objects() == [obj]
+    collect_garbage(budget=None)
+    assert not obj.exists() and not obj.parent.exists()
+
+
+# -------------------------------------------------------------------------------------------------
+# Table fingerprints
+# -------------------------------------------------------------------------------------------------
+
+def _tables(subjects, rms):
+    data = generator.DATA_DIR
+    data.mkdir(parents=True, exist_ok=True)
+    pd.DataFrame({'pid': [PID, OTHER_PID], 'eid': [EID, EID], 'subject': subjects}).to_parquet(
+        data / 'session.table.pqt')
+    index = pd.MultiIndex.from_product([[PID, OTHER_PID], range(3)], names=['pid', 'channel'])
+    pd.DataFrame({'rms_ap': rms, 'psd_delta': np.zeros(6)}, index=index).to_parquet(data / 'raw_ephys_features.pqt')
+
+
+def test_inputs_fingerprint_tables(cache):
+    # Only the rows of the session in the shared tables are fingerprinted.
+    _tables(['a', 'b'], np.arange(6.))
+    before = {kind: inputs_fingerprint(PID, EID, kind) for kind in ('session_details', 'session')}
+    _tables(['a', 'new'], np.r_[np.arange(3.), 10, 11, 12])
+    assert {kind: inputs_fingerprint(PID, EID, kind) for kind in before} == before
+    _tables(['new', 'new'], np.r_[np.arange(3.), 10, 11, 12])
+    assert inputs_fingerprint(PID, EID, 'session_details') != before['session_details']
+    assert inputs_fingerprint(PID, EID, 'session') == before['session']
+    _tables(['new', 'new'], np.r_[1, 1, 1, 10, 11, 12])
+    assert inputs_fingerprint(PID, EID, 'session') != before['session']
+
+
+# -------------------------------------------------------------------------------------------------
+# Garbage collection
+# -------------------------------------------------------------------------------------------------
+
+def _garbage_cache(cache):
+    generator.DATA_DIR.mkdir(parents=True, exist_ok=True)
+    pd.DataFrame({'pid': [PID], 'eid': [EID]}).to_parquet(generator.DATA_DIR / 'session.table.pqt')
+
+    kept = [
+        _write(session_cache_path(PID) / 'trial-0000.png', b'figure'),
+        _write(generator.EID_CACHE_DIR / EID / 'behaviour_overview.png', b'behaviour'),
+        _write(generator.LEASE_DIR / f'{PID}.lease'),
+        _write(generator.LEASE_DIR / 'run-2' / f'{PID}.done'),
+    ]
+    store_object(kept[0])
+    kept.append(object_path(generator.file_hash(kept[0]), '.png'))
+
+    orphan = _write(cache / 'orphan.png', b'orphan')
+    garbage = [
+        _write(cache / 'junk' / 'file'),
+        _write(cache / OTHER_PID / 'trial-0000.png'),
+        _write(generator.EID_CACHE_DIR / OTHER_PID / 'behaviour_overview.png'),
+        _write(generator.LEASE_DIR / f'{OTHER_PID}.lease'),
+        _write(generator.LEASE_DIR / 'run-1' / f'{OTHER_PID}.done'),
+        object_path(store_object(orphan), '.png'),
+    ]
+    orphan.unlink()
+    # An expired lease and a past run, and a run without activity but not finished yet.
+    for path, age in ((garbage[3], LEASE_TIMEOUT), (garbage[4].parent, LEASE_RUN_RETENTION),
+                      (kept[3].parent, LEASE_TIMEOUT)):
+        os.utime(path, (time.time() - age - 10,) * 2)
+    return kept, garbage
+
+
+def test_collect_garbage(cache):
+    kept, garbage = _garbage_cache(cache)
+    assert collect_garbage(budget=None) > 0
+    assert all(path.exists() for path in kept)
+    assert not any(path.exists() for path in garbage)
+    assert not (cache / 'junk').exists() and not (cache / OTHER_PID).exists()
+
+
+def test_collect_garbage_dry_run(cache):
+    kept, garbage = _garbage_cache(cache)
+    assert collect_garbage(budget=None, dry_run=True) > 0
+    assert all(path.exists() for path in kept + garbage)
+
+
+def test_collect_garbage_evict(cache):
+    kept, _ = _garbage_cache(cache)
+    # A session removed from the session table is only evicted over the budget.
+    removed = _write(session_cache_path(OTHER_PID) / 'session.json', b'{}')
+    collect_garbage(budget=None)
+    assert removed.exists()
+    collect_garbage(budget=0)
+    assert not removed.exists()
+    assert all(path.exists() for path in kept)
+
+
+def test_collect_garbage_fits(cache):
+    # Without the ALF files, the fits in use are those of the trials fingerprint of the product store.
+    _garbage_cache(cache)
+    ProductStore(products_path(PID)).reset('fingerprint', pid=PID, eid=EID, inputs={'behaviour_fits': 'trials'})
+    used = _write(fits_cache_path(behaviour_fits_key('trials')), b'{}')
+    old = _write(fits_cache_path(behaviour_fits_key('old trials')), b'{}')
+    collect_garbage(budget=None)
+    assert used.exists()
+    assert not old.exists()
+
+
+# -------------------------------------------------------------------------------------------------
+# PNG encoding
+# -------------------------------------------------------------------------------------------------
+
+def _figure(i):
+    fig, ax = plt.subplots(figsize=(2, 1.5), dpi=50)
+    ax.plot(np.arange(10) * i, color=f'C{i}')
+    return fig
+
+
+def test_png_encoder(tmp_path):
+    encoder = PNGEncoder(n_threads=3, queue_size=2)
+    figs = [_figure(i) for i in range(6)]
+    futures = [encoder.submit(fig, tmp_path / f'fig-{i}.png') for i, fig in enumerate(figs)]
+    for future in futures:
+        future.result(timeout=10)
+    for i, fig in enumerate(figs):
+        np.testing.assert_array_equal(np.asarray(Image.open(tmp_path / f'fig-{i}.png')), render_rgba(fig))
+        plt.close(fig)
+    assert sorted(p.name for p in tmp_path.iterdir()) == [f'fig-{i}.png' for i in range(6)]
+
+
+def test_render_rgba(tmp_path):
+    # Figure sizes that are not a whole number of pixels, at the figure and at another resolution.
+    fig, ax = plt.subplots(figsize=(3.33, 2.01), dpi=72)
+    ax.plot(np.arange(10))
+    for dpi in (None, PREVIEW_DPI, 101):
+        fig.savefig(tmp_path / 'fig.png', dpi=dpi or 'figure')
+        rgba = render_rgba(fig, dpi=dpi)
+        np.testing.assert_array_equal(np.asarray(Image.open(tmp_path / 'fig.png')), rgba)
+        assert fig.dpi == 72
+    plt.close(fig)
+
+
+def test_png_encoder_error(tmp_path):
+    # The error of an encoding is raised by its future, and its buffer slot is released: more figures
+    # than slots are submitted afterwards.
+    encoder = PNGEncoder(n_threads=2, queue_size=2)
+    fig = _figure(1)
+    futures = [encoder.submit(fig, tmp_path / 'missing' / f'fig-{i}.png') for i in range(3)]
+    for future in futures:
+        with pytest.raises(FileNotFoundError):
+            future.result(timeout=10)
+    futures = [encoder.submit(fig, tmp_path / f'fig-{i}.png') for i in range(3)]
+    for future in futures:
+        future.result(timeout=10)
+    assert sorted(p.name for p in tmp_path.iterdir()) == [f'fig-{i}.png' for i in range(3)]
+    plt.close(fig)
+
+
+def test_savefig_preview(cache):
+    # A preview is saved next to the missing figure, and replaced by the full-quality figure.
+    built = []
+    gen = Generator.__new__(Generator)
+    gen.pid, gen._encoding, gen._built = PID, {}, []
+    gen.manifest = Bunch(add=lambda path, kind: built.append(path), is_stale=lambda path, kind: True)
+    path = session_cache_path(PID) / 'trial-0003.png'
+    fig = _figure(1)
+
+    gen.preview = True
+    assert gen.is_stale(path, 'trial')
+    gen.savefig(fig, path)
+    gen.mark_built(path, 'trial')
+    gen.wait_figures()
+    assert not path.exists() and preview_path(path).parent == path.parent
+    assert Image.open(preview_path(path)).size == (2 * PREVIEW_DPI, 3 * PREVIEW_DPI // 2)
+    assert not gen.is_stale(path, 'trial')
+    assert built == []
+
+    gen.preview = False
+    gen.savefig(fig, path)
+    gen.mark_built(path, 'trial')
+    gen.wait_figures()
+    assert Image.open(path).size == (100, 75)
+    assert not preview_path(path).exists()
+    assert built == [path]
+    plt.close(fig)
+
+
+# -------------------------------------------------------------------------------------------------
+# Atomic writes
+# -------------------------------------------------------------------------------------------------
+
+def test_atomic_write_error(tmp_path):
+    # A failed write leaves the previous artifact untouched and removes the temporary file.
+    path = _write(tmp_path / 'session.json', b'old')
+    with pytest.raises(ValueError):
+        with atomic_write(path) as tmp:
+            tmp.write_bytes(b'partial')
+            raise ValueError
+    assert path.read_bytes() == b'old'
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['session.json']
+
+
+def test_atomic_write_stored_object(cache):
+    # Rewriting an artifact linked to a stored object replaces the link instead of modifying the object.
+    path = _write(session_cache_path(PID) / 'session.json', b'{}')
+    obj = object_path(store_object(path), '.json')
+    assert os.path.samefile(obj, path)
+    save_json(path, {'new': 1})
+    assert obj.read_bytes() == b'{}'
+    assert json.loads(path.read_text()) == {'new': 1}
+    assert not os.path.samefile(obj, path)
+
+
+# -------------------------------------------------------------------------------------------------
+# Session snapshots
+# -------------------------------------------------------------------------------------------------
+
+def _snapshot(cache, monkeypatch):
+    """Product store with a session snapshot saved from the current inputs, and the list of the
+    DataLoader methods called to load the session."""
+    trials, _ = _artifact(cache)
+    store = ProductStore(products_path(PID))
+    inputs = {kind: inputs_fingerprint(PID, EID, kind) for kind in generator.ARTIFACT_INPUTS}
+    store.reset(products_fingerprint(inputs), pid=PID, eid=EID, inputs=inputs)
+    _write(store.path / 'session' / 'session.pkl')
+    calls = []
+    monkeypatch.setattr(DataLoader, '__init__', lambda self: None)
+    monkeypatch.setattr(DataLoader, 'session_init', lambda self, pid: calls.append('session_init'))
+    monkeypatch.setattr(DataLoader, 'load_snapshot', lambda path: calls.append('load_snapshot') or DataLoader())
+    return trials, inputs, calls
+
+
+def test_load_session_snapshot(cache, monkeypatch):
+    trials, inputs, calls = _snapshot(cache, monkeypatch)
+    _, loaded = load_session(PID, ProductStore(products_path(PID)))
+    assert calls == ['load_snapshot'] and loaded == inputs
+    # A new modification time of the inputs without a change of their content.
+    os.utime(trials, (time.time() + 10, time.time() + 10))
+    _, loaded = load_session(PID, ProductStore(products_path(PID)))
+    assert calls == ['load_snapshot'] * 2 and loaded == inputs
+
+
+def test_load_session_snapshot_stale(cache, monkeypatch):
+    trials, _, calls = _snapshot(cache, monkeypatch)
+    trials.write_bytes(b'new trials')
+    _, loaded = load_session(PID, ProductStore(products_path(PID)))
+    assert calls == ['session_init'] and loaded is None
+
+
+# -------------------------------------------------------------------------------------------------
+# Watch mode
+# -------------------------------------------------------------------------------------------------
+
+class _Clock:
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_watcher_polling(cache, monkeypatch):
+    _tables(['a', 'b'], np.arange(6.))
+    clock = _Clock()
+    monkeypatch.setattr(generator, 'INotify', None)
+    monkeypatch.setattr(generator, 'time', clock)
+    watcher = Watcher(interval=10, settle=60)
+    assert watcher.inotify is None
+    watcher.scan()
+    watcher.changed.clear()
+
+    def poll():
+        watcher.scan(watcher.wait())
+        return watcher.affected(watcher.stable())
+
+    # A session folder landing in several steps is reported once its files have not changed for
+    # `settle` seconds.
+    spikes = _write(generator.DATA_DIR / PID / 'spikes.times.npy')
+    for _ in range(4):
+        assert poll() == []
+    _write(generator.DATA_DIR / PID / 'clusters.depths.npy')
+    _write(spikes, b'more data')
+    # Change recorded at the next poll, and reported 60 seconds later.
+    for _ in range(6):
+        assert poll() == []
+    assert poll() == [PID]
+    assert poll() == []
+
+
+# -------------------------------------------------------------------------------------------------
+# Data products
+# -------------------------------------------------------------------------------------------------
+
+def _products_loader():
+    """Session data with the objects and arrays saved in the snapshot."""
+    rng = np.random.default_rng(0)
+    n = 1000
+    dl = DataLoader.__new__(DataLoader)
+    dl.pid, dl.eid, dl.session_info = PID, EID, {'pid': PID, 'eid': EID}
+    dl.depth_lim, dl.amp_lim = [0, 4000], [-10, 800]
+    dl.spikes = Bunch(times=np.sort(rng.uniform(0, 100, n)), clusters=rng.choice(4, n), amps=rng.uniform(1e-5, 5e-4, n),
+                      depths=rng.uniform(0, 3800, n), sizes=rng.uniform(1, 10, n))
+    dl.clusters = Bunch(cluster_id=np.arange(4), channels=np.arange(4) * 10)
+    dl.clusters_good = Bunch(cluster_id=np.arange(4))
+    starts = np.arange(10) * 10.
+    dl.trials = Bunch(intervals=np.c_[starts, starts + 5], goCue_times=starts + 1, firstMovement_times=starts + 2,
+                      feedback_times=starts + 3)
+    dl.channels = Bunch(localCoordinates=np.c_[np.zeros(384), np.arange(384) * 10.])
+    for name in SNAPSHOT_ARRAYS:
+        setattr(dl, name, rng.random(384))
+    dl.session_raster, dl.t_vals, dl.d_vals = rng.random((380, 100)), np.arange(100) + .5, np.arange(380) * 10.
+    dl.trial_intervals = dl.trials.intervals
+    return dl
+
+
+def _scatter(fig):
+    return [c.get_offsets() for ax in fig.axes for c in ax.collections]
+
+
+def test_save_snapshot_exclude(tmp_path):
+    dl = _products_loader()
+    dl.save_snapshot(tmp_path, exclude=('spikes', 'lfp'))
+    assert not list(tmp_path.glob('spikes.*')) and not (tmp_path / 'lfp.npy').exists()
+    loaded = DataLoader.load_snapshot(tmp_path)
+    assert not hasattr(loaded, 'lfp') and loaded.spikes == {}
+    np.testing.assert_array_equal(loaded.clusters.channels, dl.clusters.channels)
+    loaded = DataLoader.load_snapshot(tmp_path, exclude=('spikes',))
+    assert not hasattr(loaded, 'spikes')
+
+
+def test_open_products_render(cache):
+    # Compute mode: the snapshot and the data products are saved from the session data.
+    dl = _products_loader()
+    dl.store = ProductStore(products_path(PID))
+    gen = Generator.__new__(Generator)
+    gen.pid, gen.dl = PID, dl
+    gen.manifest = Bunch(inputs_fingerprint=lambda kind: 'inputs')
+    gen.open_products()
+    figs = [dl.plot_cluster_amplitude(2), dl.plot_session_raster(cluster_idx=2),
+            dl.plot_trial_raster(3, cluster_idx=2)]
+    expected = [(_scatter(fig), fig.axes[0].get_xlim()) for fig in figs]
+
+    # Render mode: the figures are drawn from the snapshot without the spikes, and the products.
+    rendered = DataLoader.load_snapshot(products_path(PID) / 'session', exclude=SNAPSHOT_RENDER_EXCLUDE)
+    rendered.store = ProductStore(products_path(PID))
+    assert not hasattr(rendered, 'spikes')
+    figs += [rendered.plot_cluster_amplitude(2), rendered.plot_session_raster(cluster_idx=2),
+             rendered.plot_trial_raster(3, cluster_idx=2)]
+    for fig, (scatter, xlim) in zip(figs[3:], expected):
+        assert fig.axes[0].get_xlim() == xlim
+        for a, b in zip(_scatter(fig), scatter, strict=True):
+            np.testing.assert_array_equal(a, b)
+    assert len(expected[0][0][0]) == np.sum(dl.spikes.clusters == 2)
+    for fig in figs:
+        plt.close(fig)
+
+
+# -------------------------------------------------------------------------------------------------
+# Trace
+# -------------------------------------------------------------------------------------------------
+
+def test_tracer_summary(tmp_path):
+    tracer = Tracer(tmp_path / 'trace.json')
+    for pid in (PID, OTHER_PID):
+        with tracer.span('make_session_plot', 'generator', session=pid):
+            with tracer.span('load_spikes', 'load'):
+                data = np.ones(2 ** 20)
+            with tracer.span('savefig', 'savefig'):
+                pass
+    with tracer.span('make_cluster_plot', 'generator', session=PID):
+        pass
+    del data
+
+    # The nested spans end first and take the session of their parent.
+    spans = [event for event in tracer.events if event['ph'] == 'X']
+    assert [span['name'] for span in spans[:3]] == ['load_spikes', 'savefig', 'make_session_plot']
+    assert [span['args']['session'] for span in spans[:3]] == [PID] * 3
+    assert spans[2]['args']['rss_peak'] >= spans[0]['args']['rss_peak']
+    assert spans[2]['ts'] <= spans[0]['ts'] and spans[0]['dur'] <= spans[2]['dur']
+
+    summary = tracer.finish()
+    assert not tracer.parts.exists()
+    assert json.loads((tmp_path / 'trace.json').read_text())['otherData'] == summary
+    assert {key: row['count'] for key, row in summary['artifacts'].items()} == {'session': 2, 'cluster': 1}
+    assert {key: row['count'] for key, row in summary['sessions'].items()} == {PID: 2, OTHER_PID: 1}
+    assert {key: row['count'] for key, row in summary['functions'].items()} == {
+        'make_session_plot': 2, 'load_spikes': 2, 'savefig': 2, 'make_cluster_plot': 1}
+    session = [span for span in spans if span['name'] == 'make_session_plot']
+    assert summary['artifacts']['session']['time'] == pytest.approx(sum(span['dur'] for span in session) / 1e6)
+    assert summary['artifacts']['session']['peak_rss'] == max(span['args']['rss_peak'] for span in session)
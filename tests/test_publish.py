@@ -0,0 +1,111 @@
+import io
+import json
+
+import pytest
+
+import publish
+from generator import file_hash, session_cache_path, store_object
+from publish import INDEX_NAME, Target, apply_index, local_index, read_index, receive, target_object, write_archive
+
+PID = 'decc8d40-cf74-4263-ae9d-a0cc68b47e86'
+
+
+@pytest.fixture
+def local(cache, monkeypatch):
+    """Cache with two figures of the same content and a preview, recorded in the manifest."""
+    monkeypatch.setattr(publish, 'CACHE_DIR', cache)
+    folder = session_cache_path(PID)
+    artifacts = {}
+    for name, data in (('trial-0000.png', b'same'), ('trial-0001.png', b'same'), ('session.json', b'{}')):
+        (folder / name).write_bytes(data)
+        artifacts[name] = {'hash': store_object(folder / name)}
+    (folder / 'manifest.json').write_text(json.dumps({'artifacts': artifacts}))
+    (folder / 'trial-0002.preview.png').write_bytes(b'preview')
+    return cache
+
+
+def _send(files, target):
+    f = io.BytesIO()
+    sent = write_archive(f, files, read_index(target))
+    f.seek(0)
+    receive(target, f)
+    return sent
+
+
+def test_local_index(local):
+    files = local_index()
+    assert sorted(files) == [f'{PID}/session.json', f'{PID}/trial-0000.png', f'{PID}/trial-0001.png',
+                             f'{PID}/trial-0002.preview.png']
+    assert files[f'{PID}/trial-0002.preview.png'] == file_hash(local / PID / 'trial-0002.preview.png')
+
+
+def test_publish(local, tmp_path):
+    target = tmp_path / 'target'
+    files = local_index()
+    # The figures of the same content are sent once.
+    assert _send(files, target) == len(b'same') + len(b'{}') + len(b'preview')
+    for name in files:
+        assert (target / name).read_bytes() == (local / name).read_bytes()
+    assert read_index(target) == files
+    assert _send(files, target) == 0
+
+
+def test_receive_corrupted(local, tmp_path):
+    f = io.BytesIO()
+    write_archive(f, local_index(), {})
+    data = f.getvalue().replace(b'preview', b'PREVIEW')
+    with pytest.raises(ValueError, match='corrupted'):
+        receive(tmp_path / 'target', io.BytesIO(data))
+    assert read_index(tmp_path / 'target') == {}
+
+
+def test_apply_index_shared_object(local, tmp_path):
+    target = tmp_path / 'target'
+    files = local_index()
+    _send(files, target)
+    obj = target_object(target, f'{PID}/trial-0000.png', files[f'{PID}/trial-0000.png'])
+    # Copies of the objects, as on file systems without hard links.
+    for name in files:
+        data = (target / name).read_bytes()
+        (target / name).unlink()
+        (target / name).write_bytes(data)
+
+    # The object is kept while another file refers to it.
+    del files[f'{PID}/trial-0000.png']
+    apply_index(target, files)
+    assert obj.exists()
+    assert not (target / PID / 'trial-0000.png').exists()
+
+    del files[f'{PID}/trial-0001.png']
+    apply_index(target, files)
+    assert not obj.exists()
+
+
+def test_apply_index_changed(local, tmp_path):
+    target = tmp_path / 'target'
+    files = local_index()
+    _send(files, target)
+    old = target_object(target, f'{PID}/session.json', files[f'{PID}/session.json'])
+
+    path = local / PID / 'session.json'
+    path.write_text('{"new": 1}')
+    files[f'{PID}/session.json'] = store_object(path)
+    _send(files, target)
+    assert (target / PID / 'session.json').read_text() == '{"new": 1}'
+    assert not old.exists()
+
+
+def test_apply_index_missing_object(tmp_path):
+    with pytest.raises(ValueError, match='missing'):
+        apply_index(tmp_path, {f'{PID}/trial-0000.png': 'a' * 40})
+    assert not (tmp_path / INDEX_NAME).exists()
+
+
+def test_target_remote_repo(tmp_path):
+    target = Target('host:/mnt/cache', remote_repo='/srv/web site')
+    assert target.command('--receive', target.path) == [
+        'ssh', 'host', "cd '/srv/web site' && python3 publish.py --receive /mnt/cache"]
+    # The repository folder is only needed on a remote host.
+    with pytest.raises(ValueError, match='website repository on host'):
+        Target('host:/mnt/cache')
+    assert Target(str(tmp_path)).path == str(tmp_path)
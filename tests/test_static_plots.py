@@ -0,0 +1,197 @@
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import pytest
+from iblutil.util import Bunch
+
+import plots.static_plots as static_plots
+from plots.static_plots import (
+    BRAIN_REGIONS, DataLoader, ProductStore, features_table, filter_clusters_by_cluster_idx,
+    filter_features_by_pid, filter_spikes_by_cluster_idx, filter_trials_by_trial_idx)
+
+
+# -------------------------------------------------------------------------------------------------
+# Product store
+# -------------------------------------------------------------------------------------------------
+
+def _raster(i):
+    return {'raster': np.arange(12.).reshape(3, 4) * i, 'xlim': np.array([0, i]), 'labels': np.array(['a', 'bc'])}
+
+
+def _assert_equal(a, b):
+    assert sorted(a.keys()) == sorted(b.keys())
+    for name in a:
+        assert a[name].dtype == b[name].dtype
+        np.testing.assert_array_equal(a[name], b[name])
+
+
+def test_product_store(tmp_path):
+    store = ProductStore(tmp_path)
+    store.reset('fingerprint')
+    assert 'trial_raster.0' not in store
+    for i in range(3):
+        store[f'trial_raster.{i}'] = _raster(i)
+    store['autocorrelogram.5'] = {'corr': np.ones(10, dtype=np.int32)}
+    # One data file per product, whatever the number of items.
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        'autocorrelogram.bin', 'autocorrelogram.idx', 'index.json', 'trial_raster.bin', 'trial_raster.idx']
+    other = ProductStore(tmp_path)
+    for i in range(3):
+        _assert_equal(other[f'trial_raster.{i}'], _raster(i))
+    assert other['autocorrelogram.5'].corr.sum() == 10
+    # The arrays read back can be modified.
+    other['trial_raster.1'].raster[0, 0] = 1
+
+
+def test_product_store_concurrent(tmp_path):
+    # Products appended by another worker are found, and a product is stored once.
+    a, b = ProductStore(tmp_path), ProductStore(tmp_path)
+    a.reset('fingerprint')
+    assert 'trial_raster.0' not in b
+    a['trial_raster.0'] = _raster(1)
+    assert 'trial_raster.0' in b
+    b['trial_raster.0'] = _raster(2)
+    b['trial_raster.1'] = _raster(3)
+    _assert_equal(a['trial_raster.0'], _raster(1))
+    _assert_equal(a['trial_raster.1'], _raster(3))
+
+
+def test_product_store_cut_line(tmp_path):
+    # An index line cut by a crash is ignored.
+    store = ProductStore(tmp_path)
+    store.reset('fingerprint')
+    store['trial_raster.0'] = _raster(1)
+    with open(tmp_path / 'trial_raster.idx', 'ab') as f:
+        f.write(b'["trial_raster.1", {"raster"')
+    store = ProductStore(tmp_path)
+    assert 'trial_raster.1' not in store
+    store['trial_raster.2'] = _raster(2)
+    store = ProductStore(tmp_path)
+    _assert_equal(store['trial_raster.0'], _raster(1))
+    _assert_equal(store['trial_raster.2'], _raster(2))
+    assert 'trial_raster.1' not in store
+
+
+def test_product_store_reset(tmp_path):
+    store = ProductStore(tmp_path)
+    assert store.reset('fingerprint', pid='pid')
+    store['trial_raster.0'] = _raster(1)
+    assert not store.reset('fingerprint', pid='pid')
+    assert 'trial_raster.0' in store
+    assert store.reset('other', pid='pid')
+    assert 'trial_raster.0' not in store
+    assert store.index()['fingerprint'] == 'other'
+
+
+# -------------------------------------------------------------------------------------------------
+# Trial and cluster details
+# -------------------------------------------------------------------------------------------------
+
+def _loader():
+    """Session with trials on both sides in every block, and clusters without spikes."""
+    rng = np.random.default_rng(0)
+    n_trials, n_clusters = 40, 8
+    contrast = rng.choice([0, 0.0625, 0.125, 0.25, 1], n_trials)
+    left = rng.random(n_trials) < 0.5
+    stim_on = np.cumsum(rng.uniform(2, 4, n_trials))
+    trials = Bunch(
+        contrastLeft=np.where(left, contrast, np.nan), contrastRight=np.where(left, np.nan, contrast),
+        probabilityLeft=rng.choice([0.5, 0.8, 0.2], n_trials), feedbackType=rng.choice([-1., 1.], n_trials),
+        stimOn_times=stim_on, feedback_times=stim_on + rng.uniform(0.1, 2, n_trials))
+    clusters = Bunch(
+        cluster_id=np.arange(n_clusters) * 2, atlas_id=rng.choice([218, 382, 385, 726, 1020], n_clusters),
+        firing_rate=rng.uniform(0, 50, n_clusters), amp_max=rng.uniform(1e-5, 5e-4, n_clusters))
+    # The clusters 6 and 14 have no spikes.
+    spike_clusters = rng.choice([0, 2, 4, 8, 10, 12], 5000)
+    dl = DataLoader.__new__(DataLoader)
+    dl.trials, dl.clusters = trials, clusters
+    dl.spikes = Bunch(clusters=spike_clusters, times=np.sort(rng.uniform(0, stim_on[-1], 5000)))
+    return dl
+
+
+def _trial_details(dl, trial_idx):
+    # Per-trial code computing the trial details before get_all_trial_details().
+    trials = filter_trials_by_trial_idx(dl.trials, trial_idx)
+    blocks = {0.5: 'neutral', 0.8: 'left', 0.2: 'right'}
+    details = OrderedDict()
+    details['Trial #'] = trial_idx
+    details['Contrast'] = np.nanmean([trials.contrastLeft, trials.contrastRight]) * 100
+    details['Stim side'] = 'left' if np.isnan(trials.contrastRight) else 'right'
+    details['Block proba'] = blocks.get(trials.probabilityLeft, None)
+    details['Resp type'] = 'correct' if trials.feedbackType == 1 else 'incorrect'
+    details['Resp time'] = f'{np.round((trials.feedback_times - trials.stimOn_times) * 1e3, 0)} ms'
+    return details
+
+
+def _cluster_details(dl, cluster_idx):
+    # Per-cluster code computing the cluster details before get_all_cluster_details().
+    cluster = filter_clusters_by_cluster_idx(dl.clusters, cluster_idx)
+    if not cluster:
+        return
+    return {
+        'Cluster #': cluster_idx,
+        'Brain region': BRAIN_REGIONS.id2acronym(cluster.atlas_id, mapping='Beryl')[0],
+        'N spikes': filter_spikes_by_cluster_idx(dl.spikes, cluster_idx).times.size,
+        'Overall firing rate': f'{np.round(cluster["firing_rate"], 2)} Hz',
+        'Max amplitude': f'{np.round(cluster["amp_max"] * 1e6, 2)} uV'
+    }
+
+
+def test_all_trial_details():
+    dl = _loader()
+    trial_idxs = [5, 0, 39, 12, 12]
+    assert dl.get_all_trial_details(trial_idxs) == {idx: _trial_details(dl, idx) for idx in trial_idxs}
+    assert dl.get_trial_details(7) == _trial_details(dl, 7)
+
+
+def test_all_cluster_details():
+    dl = _loader()
+    # Clusters with spikes, without spikes, and a cluster that does not exist.
+    cluster_idxs = [4, 0, 6, 14, 3, 12]
+    out = dl.get_all_cluster_details(cluster_idxs)
+    assert list(out) == cluster_idxs
+    assert out == {idx: _cluster_details(dl, idx) for idx in cluster_idxs}
+    assert out[3] is None and out[14]['N spikes'] == 0
+    assert dl.get_cluster_details(2) == _cluster_details(dl, 2)
+
+
+# -------------------------------------------------------------------------------------------------
+# Shared tables
+# -------------------------------------------------------------------------------------------------
+
+def _features(path, pids):
+    rng = np.random.default_rng(0)
+    index = pd.MultiIndex.from_product([pids, range(4)], names=['pid', 'channel'])
+    df = pd.DataFrame({'rms_ap': rng.random(len(index)), 'psd_delta': rng.random(len(index))}, index=index)
+    # Rows of the sessions interleaved as in the concatenated tables.
+    df = df.sample(frac=1, random_state=0)
+    path.mkdir(parents=True, exist_ok=True)
+    df.to_parquet(path / 'raw_ephys_features.pqt')
+    return df.reset_index()
+
+
+def test_features_table(cache):
+    df = _features(static_plots.DATA_DIR, ['c', 'a', 'b'])
+    features = features_table()
+    for pid in ('a', 'b', 'c', 'missing'):
+        for column in ('rms_ap', 'psd_delta'):
+            # Same rows as the boolean filter of the whole table.
+            expected = df[df['pid'] == pid][column].values
+            if len(expected) == 0:
+                expected = np.full(384, np.nan)
+            np.testing.assert_array_equal(filter_features_by_pid(features, pid, column), expected)
+    values = filter_features_by_pid(features, 'a', 'rms_ap')
+    assert not values.flags.writeable
+    with pytest.raises(ValueError):
+        values[0] = 0
+
+
+def test_shared_table(cache):
+    _features(static_plots.DATA_DIR, ['a'])
+    features = features_table()
+    assert features_table() is features
+    # A new file is loaded again.
+    _features(static_plots.DATA_DIR, ['a', 'b'])
+    assert features_table() is not features
+    assert 'b' in features_table().offsets
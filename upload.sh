@@ -1 +1,7 @@
-rsync -avzh static/cache iblviz:/mnt/data/
+# Publish the cache to the server. IBL_REMOTE_REPO is the folder where the website repository is
+# deployed on the server, which runs publish.py to receive the files.
+if [ -z "$IBL_REMOTE_REPO" ]; then
+    echo "upload.sh: set IBL_REMOTE_REPO to the folder of the website repository on the server" >&2
+    exit 1
+fi
+python3 publish.py iblviz:/mnt/data/cache --remote-repo "$IBL_REMOTE_REPO" "$@"